@@ -1,32 +1,50 @@
 from django.contrib import admin
 from django.db.models import Count, F
-from .models import BotAnalytics,LocationsAnalytics
+from .models import BotAnalytics,CommandRollup,LocationsAnalytics,ProfileRun,UserLatencyStats
+from . import archive, export, profiling, rollups, series
+from .dashboard import dashboard_metrics
 from django.utils.timezone import now
 from datetime import timedelta
 from django.db.models import Max, Min
-from django.http import JsonResponse
-from django.urls import path
+from django.http import FileResponse, Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 from unfold.admin import ModelAdmin
-import requests
 import os
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
 from users.models import TelegramUser
+from users.usernames import update_usernames_in_background
 from .filters import UserStatusFilter
+from .spans import bottleneck
 
 
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-def get_username(user_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChat?chat_id={user_id}"
-    response = requests.get(url)
 
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("ok"):
-            return data["result"].get("username", "hidden")  # Return None if no username
-        return "Not Active"
-    return "Not Active" 
+
+def export_response(request, name):
+    """Stream the raw rows of export `name` selected by the request's filters as CSV or NDJSON."""
+    fmt = request.GET.get('format', 'csv')
+    compress = request.GET.get('gzip') in ('1', 'true')
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest(f"Unknown format: {fmt}")
+    try:
+        start = export.parse_bound(request.GET.get('startDate'))
+        end = export.parse_bound(request.GET.get('endDate'), end=True)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    filters = dict(start=start, end=end, user_id=request.GET.get('user_id'), province=request.GET.get('province'))
+    # archived=1 also reads the rows archive_analytics moved out of the database
+    rows = archive.history(name, **filters) if request.GET.get('archived') in ('1', 'true') else None
+    stream = export.export_stream(name, fmt, compress, rows=rows, **filters)
+    response = StreamingHttpResponse(
+        stream, content_type='application/gzip' if compress else export.FORMATS[fmt])
+    filename = export.export_filename(name, fmt, compress, start, end)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 class LogData(BotAnalytics):
@@ -39,25 +57,22 @@ class LogData(BotAnalytics):
 class LogAdmin(ModelAdmin):
     # change_list_template = "admin/botanalytics_changelist.html"
     list_filter = ['user_name','timestamp']
-    list_display = ['user_id','user_name','command','timestamp']
+    list_display = ['user_id','user_name','command','timestamp','response_time','slowest_stage']
     actions=['update_username']
     list_filter_sheet = True
     search_fields = ['user_name','user_id']
     compressed_fields = True
+
+    @admin.display(description='Slowest stage')
+    def slowest_stage(self, obj):
+        slowest = bottleneck(obj.stages)
+        return f"{slowest[0]} {_format_seconds(slowest[1])}" if slowest else '-'
+
     def update_username(modeladmin, request, queryset):
-        users_to_update = []
-        for user in queryset:
-            # print(user.user_name)  # Only update users with no username
-            username = get_username(user.user_id)
-            if username:
-                user.user_name = username
-                users_to_update.append(user)
-
-        if users_to_update:
-            LogData.objects.bulk_update(users_to_update, ["user_name"])
-            messages.success(request, f"Updated {len(users_to_update)} usernames successfully.")
+        if update_usernames_in_background(queryset, 'user_id', 'user_name'):
+            messages.success(request, "Updating usernames in the background; reload the page in a moment.")
         else:
-            messages.info(request, "No usernames needed updating.")
+            messages.warning(request, "A username update is already running; try again when it is done.")
     
 # admin.site.register(BotAnalytics,LogAdmin)
 
@@ -70,84 +85,193 @@ class BotAnalyticsAdmin(ModelAdmin):
     list_filter_sheet = True
     search_fields = ['user_name', 'user_id']
     # compressed_fields = True
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('export/', self.admin_site.admin_view(self.export_view), name='botanalytics_export'),
+        ]
+        return custom_urls + urls
+
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return export_response(request, 'botanalytics')
     
     def changelist_view(self, request, extra_context=None):
-        def get_min_response_time():
-            min_response_time = BotAnalytics.objects.aggregate(Min('response_time'))['response_time__min']
-            return round(min_response_time, 3) if min_response_time is not None else 'N/A'
-        
-
-        # Method to get the maximum response time
-        def get_max_response_time():
-            max_response_time = BotAnalytics.objects.aggregate(Max('response_time'))['response_time__max']
-            return round(max_response_time, 3) if max_response_time is not None else 'N/A'
-        # Total users
-        total_users = TelegramUser.objects.values('telegram_id').distinct().count()
-        all_users = BotAnalytics.objects.values('user_id','user_name').distinct()
-        
-
-        # Active users (last 7 days)
-        active_users = all_users.filter(timestamp__gte=now() - timedelta(days=3)).values('user_id','user_name').distinct()
-
-        # New users (last 7 days)
-        new_users = (
-            TelegramUser.objects.filter(joined_at__gte=now() - timedelta(days=3))
-            .values('telegram_id')
-            .distinct()
-            .count()
-        )
-
-        # Inactive users (last 30 days)
-        print(f"all users : {all_users} \n new Users : {new_users} \n active users { active_users}")
-        inactive_users = all_users.exclude(
-            user_id__in=BotAnalytics.objects.filter(
-                timestamp__gte=now() - timedelta(days=3)
-            ).values('user_id')
-        )
-        
-        # Engagement rate
-        engagement_rate = (len( active_users) / total_users) * 100 if total_users > 0 else 0
-
-        # Total commands
-        total_commands = BotAnalytics.objects.count()
-        
-        max_res_time = get_max_response_time()
-        min_res_time = get_min_response_time()
-
-        # Command usage
-        command_usage = (
-            BotAnalytics.objects.values('command')
-            .annotate(total=Count('command'))
-            .order_by('-total')
-        )
-
-        # ClimateNet-specific analytics
-        popular_devices = (
-            BotAnalytics.objects.values('device_location')
-            .annotate(total=Count('id'))
-            .order_by('-total')
-        )
+        # Every number comes from the cached metrics service, never from a queryset per render
+        metrics = dashboard_metrics.get()
+
+        def format_response_time(value):
+            return round(value, 3) if value is not None else 'N/A'
 
         # Add data to the context
         extra_context = extra_context or {}
         extra_context.update({
-            'total_users': total_users,
-            'active_users':  active_users,
-            'active_users_len': len(active_users),
-            'new_users': new_users,
-            'inactive_users': inactive_users,
-            'inactive_users_len': len(inactive_users),
-            'engagement_rate': engagement_rate,
-            'total_commands': total_commands,
-            'command_usage': list(command_usage),
-            'popular_devices': list(popular_devices),
-            'minimum_respone_time':min_res_time,
-            'maximum_response_time':max_res_time,
+            'total_users': metrics['total_users'],
+            'active_users_len': metrics['active_users'],
+            'new_users': metrics['new_users'],
+            'inactive_users_len': metrics['inactive_users'],
+            'engagement_rate': metrics['engagement_rate'],
+            'total_commands': metrics['total_commands'],
+            'command_usage': json.dumps(metrics['command_usage']),
+            'minimum_respone_time': format_response_time(metrics['min_response_time']),
+            'maximum_response_time': format_response_time(metrics['max_response_time']),
         })
         return super().changelist_view(request, extra_context=extra_context)
 
 
 
+def _format_seconds(value):
+    return f"{value:.3f}" if value is not None else '-'
+
+
+@admin.register(UserLatencyStats)
+class UserLatencyStatsAdmin(ModelAdmin):
+    list_display = ('user_id', 'count', 'mean', 'p50', 'p95', 'p99', 'min_time', 'max_time', 'updated_at')
+    search_fields = ['user_id']
+    ordering = ['-count']
+    readonly_fields = [field.name for field in UserLatencyStats._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Mean (s)')
+    def mean(self, obj):
+        return _format_seconds(obj.mean_response_time)
+
+    @admin.display(description='p50 (s)')
+    def p50(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.5))
+
+    @admin.display(description='p95 (s)')
+    def p95(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.95))
+
+    @admin.display(description='p99 (s)')
+    def p99(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.99))
+
+    @admin.display(description='Min (s)', ordering='min_response_time')
+    def min_time(self, obj):
+        return _format_seconds(obj.min_response_time)
+
+    @admin.display(description='Max (s)', ordering='max_response_time')
+    def max_time(self, obj):
+        return _format_seconds(obj.max_response_time)
+
+
+class CommandLatency(CommandRollup):
+    class Meta:
+        proxy = True
+        verbose_name = "Command latency"
+        verbose_name_plural = "Command latency"
+
+
+@admin.register(CommandLatency)
+class CommandLatencyAdmin(ModelAdmin):
+    """Response time percentiles per command and day, from the daily rollup sketches."""
+    list_display = ('day', 'command', 'count', 'mean', 'p50', 'p95', 'p99', 'max_time', 'stage_breakdown')
+    list_filter = ['command']
+    list_filter_sheet = True
+    date_hierarchy = 'bucket'
+    ordering = ['-bucket', 'command']
+    readonly_fields = [field.name for field in CommandRollup._meta.fields]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(period=rollups.DAY)
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Day', ordering='bucket')
+    def day(self, obj):
+        return rollups.floor_day(obj.bucket).date()
+
+    @admin.display(description='Mean (s)')
+    def mean(self, obj):
+        return _format_seconds(obj.mean_response_time)
+
+    @admin.display(description='p50 (s)')
+    def p50(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.5))
+
+    @admin.display(description='p95 (s)')
+    def p95(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.95))
+
+    @admin.display(description='p99 (s)')
+    def p99(self, obj):
+        return _format_seconds(obj.get_sketch().quantile(0.99))
+
+    @admin.display(description='Max (s)', ordering='max_response_time')
+    def max_time(self, obj):
+        return _format_seconds(obj.max_response_time)
+
+    @admin.display(description='Mean per stage (s)')
+    def stage_breakdown(self, obj):
+        means = obj.stage_means()
+        if not means:
+            return '-'
+        mean = obj.mean_response_time
+        if mean is not None and mean > sum(means.values()):
+            means['other'] = mean - sum(means.values())  # Handler time outside any span
+        return ', '.join(f"{stage} {_format_seconds(seconds)}" for stage, seconds in means.items())
+
+
+@admin.register(ProfileRun)
+class ProfileRunAdmin(ModelAdmin):
+    """Adding a run asks the bot process to profile itself; the result is downloadable once it is done."""
+    list_display = ('requested_at', 'kind', 'duration', 'status', 'requested_by', 'finished_at', 'download')
+    list_filter = ['kind', 'status']
+    actions = ['run_again']
+    fields = ('kind', 'duration', 'status', 'requested_by', 'requested_at', 'started_at', 'finished_at',
+              'download', 'summary', 'error')
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly = ['status', 'requested_by', 'requested_at', 'started_at', 'finished_at', 'download', 'summary', 'error']
+        return readonly + ['kind', 'duration'] if obj else readonly
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.requested_by = request.user.get_username()
+        super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('<int:object_id>/download/', self.admin_site.admin_view(self.download_view),
+                 name='botanalytics_profilerun_download'),
+        ]
+        return custom_urls + urls
+
+    def download_view(self, request, object_id):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        run = self.get_object(request, object_id)
+        if run is None or not run.artifact:
+            raise Http404
+        file_path = os.path.join(profiling.profile_dir(), os.path.basename(run.artifact))
+        if not os.path.exists(file_path):
+            raise Http404("The profile file is no longer on the server")
+        return FileResponse(open(file_path, 'rb'), as_attachment=True, filename=run.artifact)
+
+    @admin.display(description='Result')
+    def download(self, obj):
+        if not obj.artifact:
+            return '-'
+        url = reverse('admin:botanalytics_profilerun_download', args=[obj.pk])
+        return format_html('<a href="{}">{}</a>', url, obj.artifact)
+
+    @admin.action(description='Run again with the same settings')
+    def run_again(self, request, queryset):
+        runs = [ProfileRun(kind=run.kind, duration=run.duration, requested_by=request.user.get_username())
+                for run in queryset]
+        ProfileRun.objects.bulk_create(runs)
+        messages.success(request, f"Requested {len(runs)} profiles; the bot picks them up within a few seconds.")
+
+
+
 from datetime import datetime, timedelta
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware
@@ -157,6 +281,12 @@ from django.urls import path
 from django.contrib import admin
 from .models import LocationsAnalytics
 from django.template.response import TemplateResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.timezone import is_aware
+import hashlib
 
 @admin.register(LocationsAnalytics)
 class LocationsAnalyticsAdmin(ModelAdmin):
@@ -168,10 +298,17 @@ class LocationsAnalyticsAdmin(ModelAdmin):
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
-            path('analytics-data/', self.admin_site.admin_view(self.analytics_data), name='analytics_data'),
+            # cacheable: the view sets its own validators and Cache-Control
+            path('analytics-data/', self.admin_site.admin_view(self.analytics_data, cacheable=True), name='analytics_data'),
+            path('export/', self.admin_site.admin_view(self.export_view), name='locationsanalytics_export'),
         ]
         return custom_urls + urls
 
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return export_response(request, 'locations')
+
 
     
     def analytics_data(self, request):
@@ -210,26 +347,40 @@ class LocationsAnalyticsAdmin(ModelAdmin):
                 start_date = make_aware(datetime.combine(datetime(today.year, 1, 1), datetime.min.time()))
                 end_date = make_aware(datetime.combine(datetime(today.year, 12, 31), datetime.max.time()))
 
-        # Fetch province usage data with date range filtering
-        query = LocationsAnalytics.objects.filter(timestamp__range=(start_date, end_date)) \
-            .values('device_province').annotate(count=Count('device_province')).order_by('-count')
-
-        # If a specific province is selected, fetch device data for it
-        selected_province = request.GET.get('province')
-        device_data = []
-        if selected_province:
-            device_query = LocationsAnalytics.objects.filter(
-                device_province=selected_province,
-                timestamp__range=(start_date, end_date)
-            )
-
-            device_data = (
-                device_query.values('device_name')
-                .annotate(count=Count('device_name'))
-                .order_by('-count')
-            )
-
-        return JsonResponse({'province_data': list(query), 'device_data': list(device_data)})
+        selected_province = request.GET.get('province') or ''
+
+        # Rollups are hourly, so ranges that cover the same hours give the same answer.
+        # The watermark version changes when a new hour starts filling up or the rollups
+        # are rebuilt; events added to the current hour show up within one cache TTL.
+        start_date = rollups.floor_hour(start_date if is_aware(start_date) else make_aware(start_date))
+        end_date = end_date if is_aware(end_date) else make_aware(end_date)
+        end_key = 'now' if end_date >= now() else rollups.floor_hour(end_date).isoformat()
+        ttl = getattr(settings, 'ANALYTICS_DATA_CACHE_TTL', 300)
+        watermark = rollups.current_watermark()
+        version = watermark.version if watermark else 0
+        slot = int(watermark.last_event_at.timestamp() // ttl) if watermark and watermark.last_event_at else 0
+        key = f"{version}:{slot}:{start_date.isoformat()}:{end_key}:{selected_province}"
+        etag = quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            cache_key = f"botanalytics:analytics_data:{key}"
+            payload = cache.get(cache_key)
+            if payload is None:
+                # Province and device usage for the range, in one query over the location rollups
+                province_data, device_data = rollups.location_usage(
+                    selected_province, start_date, None if end_key == 'now' else end_date)
+                trend_end = now() if end_key == 'now' else end_date
+                trend = series.rollup_series('picks', series.unit_for(start_date, trend_end), start_date, trend_end,
+                                             province=selected_province)
+                payload = {'province_data': province_data, 'device_data': device_data, 'trend': trend}
+                cache.set(cache_key, payload, timeout=ttl)
+            response = JsonResponse(payload)
+
+        response['ETag'] = etag
+        # Let the browser keep the response but check back every time
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
     
 # admin.site.register(BotAnalytics, BotAnalyticsAdmin)
@@ -0,0 +1,222 @@
+"""
+Retention for the raw analytics events. Events older than the retention
+window are streamed into one gzip NDJSON file per export and local month
+(<ANALYTICS_ARCHIVE_DIR>/<name>/<YYYY-MM>.jsonl.gz), recorded in
+manifest.json, and then deleted from the database in small chunks. Later runs
+append another gzip member to the month's file. The rollups are left alone,
+so the dashboards keep their history; archived_rows() and history() answer
+queries over the raw events that were moved out.
+
+Each step is recorded before the next one starts, so an interrupted run is
+finished by the next: bytes past the size in the manifest are dropped before
+appending, and pending deletes are replayed from the manifest.
+"""
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from itertools import chain
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .export import EXPORTS, encode, export_rows, ndjson_lines
+from .series import floor_bucket, next_bucket
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+def archive_dir():
+    return getattr(settings, 'ANALYTICS_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'analytics_archive'))
+
+
+def load_manifest(directory=None):
+    path = os.path.join(directory or archive_dir(), MANIFEST)
+    if not os.path.exists(path):
+        return {'version': 1, 'files': {}, 'pending_deletes': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def archived_before(directory=None):
+    """Everything logged before this moment has been archived (and deleted); None before the first archive."""
+    value = load_manifest(directory).get('archived_before')
+    return parse_datetime(value) if value else None
+
+
+def save_manifest(manifest, directory=None):
+    """Write the manifest to a temporary file and rename it over the old one."""
+    directory = directory or archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.manifest-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path, os.path.join(directory, MANIFEST))
+
+
+class _Tally:
+    """Pass rows through while noting their count and time range."""
+
+    def __init__(self, rows, fields):
+        self.rows = rows
+        self.ts_index = fields.index('timestamp')
+        self.count = 0
+        self.first_timestamp = self.last_timestamp = None
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            ts = row[self.ts_index]
+            if self.first_timestamp is None or ts < self.first_timestamp:
+                self.first_timestamp = ts
+            if self.last_timestamp is None or ts > self.last_timestamp:
+                self.last_timestamp = ts
+            yield row
+
+
+def _append(path, lines, recorded_bytes):
+    """Append `lines` as one gzip member, first dropping anything a failed run left past `recorded_bytes`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        f.truncate(recorded_bytes)
+        for block in encode(lines, compress=True):
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def delete_archived(manifest, directory=None, chunk_size=2000, pause=0.0):
+    """
+    Delete the rows of every pending archive step, `chunk_size` ids per
+    transaction so the bot's writes are never blocked for long.
+    """
+    deleted = 0
+    while manifest['pending_deletes']:
+        step = manifest['pending_deletes'][0]
+        model, _ = EXPORTS[step['name']]
+        rows = model.objects.filter(
+            timestamp__gte=parse_datetime(step['start']), timestamp__lt=parse_datetime(step['end']),
+            id__lte=step['max_id'],
+        )
+        while True:
+            ids = list(rows.order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            with transaction.atomic():
+                model.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            if pause:
+                time.sleep(pause)
+        manifest['pending_deletes'].pop(0)
+        save_manifest(manifest, directory)
+    return deleted
+
+
+def archive_events(before, directory=None, chunk_size=2000, pause=0.0, dry_run=False):
+    """
+    Move every event with a timestamp before `before` into the monthly
+    archives and delete it. Returns {export name: rows archived}.
+    """
+    directory = directory or archive_dir()
+    manifest = load_manifest(directory)
+    if not dry_run:
+        delete_archived(manifest, directory, chunk_size, pause)
+
+    archived = {}
+    for name, (model, fields) in EXPORTS.items():
+        bounds = model.objects.filter(timestamp__lt=before).aggregate(oldest=Min('timestamp'), max_id=Max('id'))
+        archived[name] = 0
+        if bounds['oldest'] is None:
+            continue
+        month = floor_bucket(bounds['oldest'], 'month')
+        while timezone.make_aware(month) < before:
+            following = next_bucket(month, 'month')
+            start, end = timezone.make_aware(month), min(timezone.make_aware(following), before)
+            month_rows = model.objects.filter(timestamp__gte=start, timestamp__lt=end, id__lte=bounds['max_id'])
+            if dry_run or not month_rows.exists():
+                archived[name] += month_rows.count() if dry_run else 0
+                month = following
+                continue
+
+            key = f"{name}/{month:%Y-%m}.jsonl.gz"
+            entry = manifest['files'].get(key, {
+                'name': name, 'month': f"{month:%Y-%m}", 'start': start.isoformat(),
+                'end': timezone.make_aware(following).isoformat(), 'rows': 0, 'bytes': 0,
+                'first_timestamp': None, 'last_timestamp': None,
+            })
+            tally = _Tally(month_rows.order_by('id').values_list(*fields).iterator(chunk_size=chunk_size), fields)
+            size = _append(os.path.join(directory, key), ndjson_lines(fields, tally), entry['bytes'])
+            if tally.count:  # Rows deleted since exists() leave nothing to record
+                entry['rows'] += tally.count
+                entry['bytes'] = size
+                first, last = tally.first_timestamp.isoformat(), tally.last_timestamp.isoformat()
+                entry['first_timestamp'] = min(filter(None, [entry['first_timestamp'], first]))
+                entry['last_timestamp'] = max(filter(None, [entry['last_timestamp'], last]))
+                entry['updated_at'] = timezone.now().isoformat()
+                manifest['files'][key] = entry
+                manifest['pending_deletes'].append({
+                    'name': name, 'start': start.isoformat(), 'end': end.isoformat(), 'max_id': bounds['max_id'],
+                })
+                save_manifest(manifest, directory)
+                delete_archived(manifest, directory, chunk_size, pause)
+                archived[name] += tally.count
+                logger.info(f"Archived {tally.count} {name} rows to {key}")
+            month = following
+
+    if not dry_run:
+        before = timezone.localtime(before).isoformat()
+        manifest['archived_before'] = max(filter(None, [manifest.get('archived_before'), before]))
+        save_manifest(manifest, directory)
+    return archived
+
+
+def archived_rows(name, start=None, end=None, user_id=None, province=None, directory=None):
+    """
+    The archived rows of export `name` as value tuples in the export's field
+    order, read back from the monthly files that overlap [start, end].
+    """
+    directory = directory or archive_dir()
+    manifest = load_manifest(directory)
+    fields = EXPORTS[name][1]
+    entries = sorted(
+        (entry for key, entry in manifest['files'].items() if entry['name'] == name),
+        key=lambda entry: entry['month'],
+    )
+    for entry in entries:
+        if start is not None and parse_datetime(entry['end']) <= start:
+            continue
+        if end is not None and parse_datetime(entry['start']) > end:
+            continue
+        path = os.path.join(directory, f"{name}/{entry['month']}.jsonl.gz")
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                timestamp = parse_datetime(row['timestamp'])
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    continue
+                if user_id and row['user_id'] != user_id:
+                    continue
+                if province and row.get('device_province', province) != province:
+                    continue
+                row['timestamp'] = timestamp
+                yield tuple(row.get(field) for field in fields)  # Fields added later are None in old files
+
+
+def history(name, start=None, end=None, user_id=None, province=None, chunk_size=2000):
+    """Archived rows followed by the ones still in the database, as export_rows() returns them."""
+    return chain(
+        archived_rows(name, start, end, user_id, province),
+        export_rows(name, start, end, user_id, province, chunk_size=chunk_size),
+    )
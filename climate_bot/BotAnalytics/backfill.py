@@ -0,0 +1,180 @@
+"""
+Chunked, resumable backfills over large tables. A backfill walks its
+queryset in primary key order, chunk_size rows at a time (keyset pagination,
+never OFFSET), resolves whatever it needs for the chunk with one query,
+writes the changed rows with one bulk_update and records the last primary
+key in a BackfillCheckpoint, each chunk in its own short transaction. An
+interrupted run carries on from the checkpoint.
+"""
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from users.models import TelegramUser
+from . import archive
+from .export import EXPORTS
+from .models import BackfillCheckpoint, BotAnalytics
+
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    """
+    Subclasses set `model`, the `fields` they write, optionally the fields to
+    load (`only`), and implement lookup() and apply().
+    """
+
+    name = None
+    help = ''
+    model = None
+    fields = []
+    only = None
+
+    def queryset(self):
+        return self.model.objects.all()
+
+    def prepare(self) -> None:
+        """Called once at the start of every run."""
+
+    def lookup(self, rows) -> dict:
+        """Everything apply() needs for this chunk of rows, fetched at once."""
+        return {}
+
+    def apply(self, row, lookup) -> bool:
+        """Update `row` in place; return True if it changed and must be written."""
+        raise NotImplementedError
+
+
+class UserNameBackfill(Backfill):
+    name = 'user_names'
+    help = 'Fills BotAnalytics.user_name from the TelegramUser profile where it is empty'
+    model = BotAnalytics
+    fields = ['user_name']
+    only = ['id', 'user_id', 'user_name']
+
+    def lookup(self, rows):
+        telegram_ids = {int(row.user_id) for row in rows if not row.user_name and row.user_id.isdigit()}
+        return dict(
+            TelegramUser.objects.filter(telegram_id__in=telegram_ids).exclude(user_name__isnull=True)
+            .exclude(user_name='').values_list('telegram_id', 'user_name')
+        )
+
+    def apply(self, row, lookup):
+        if row.user_name or not row.user_id.isdigit():
+            return False
+        user_name = lookup.get(int(row.user_id))
+        if not user_name:
+            return False
+        row.user_name = user_name[:BotAnalytics._meta.get_field('user_name').max_length]
+        return True
+
+
+class UserActivityBackfill(Backfill):
+    name = 'user_activity'
+    help = "Sets TelegramUser.last_active_at and command_count from the user's BotAnalytics history"
+    model = TelegramUser
+    fields = ['last_active_at', 'command_count']
+    only = ['id', 'telegram_id', 'last_active_at', 'command_count']
+
+    def __init__(self):
+        self._archived = {}
+
+    def prepare(self):
+        # Archived events are no longer in BotAnalytics but still count; read them once per run
+        fields = EXPORTS['botanalytics'][1]
+        user_index, timestamp_index = fields.index('user_id'), fields.index('timestamp')
+        self._archived = {}
+        for row in archive.archived_rows('botanalytics'):
+            last_active_at, count = self._archived.get(row[user_index], (None, 0))
+            timestamp = row[timestamp_index]
+            self._archived[row[user_index]] = (max(filter(None, [last_active_at, timestamp])), count + 1)
+
+    def lookup(self, rows):
+        activity = (
+            BotAnalytics.objects.filter(user_id__in=[str(row.telegram_id) for row in rows])
+            .values('user_id').annotate(last_active_at=Max('timestamp'), command_count=Count('id'))
+            .order_by()
+        )
+        found = {row['user_id']: (row['last_active_at'], row['command_count']) for row in activity}
+        for row in rows:
+            user_id = str(row.telegram_id)
+            if user_id in self._archived:
+                archived_at, archived_count = self._archived[user_id]
+                last_active_at, count = found.get(user_id, (None, 0))
+                found[user_id] = (max(filter(None, [last_active_at, archived_at])), count + archived_count)
+        return found
+
+    def apply(self, row, lookup):
+        last_active_at, command_count = lookup.get(str(row.telegram_id), (None, 0))
+        if (row.last_active_at, row.command_count) == (last_active_at, command_count):
+            return False
+        row.last_active_at, row.command_count = last_active_at, command_count
+        return True
+
+
+BACKFILLS: Dict[str, Backfill] = {backfill.name: backfill for backfill in (UserNameBackfill(), UserActivityBackfill())}
+
+
+def run_backfill(backfill: Backfill, chunk_size: int = 2000, restart: bool = False,
+                 max_chunks: Optional[int] = None, progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Run `backfill` from its checkpoint (or from the start with `restart`),
+    calling `progress(report)` after every chunk. Returns the final report.
+    """
+    checkpoint, _ = BackfillCheckpoint.objects.get_or_create(name=backfill.name)
+    if restart or checkpoint.finished_at is not None:
+        checkpoint.last_pk = checkpoint.rows_seen = checkpoint.rows_updated = 0
+        checkpoint.started_at, checkpoint.finished_at = timezone.now(), None
+        checkpoint.save()
+
+    backfill.prepare()
+    rows = backfill.queryset().order_by('pk')
+    if backfill.only:
+        rows = rows.only(*backfill.only)
+    remaining = rows.filter(pk__gt=checkpoint.last_pk).count()
+    started = time.perf_counter()
+    seen = updated = chunks = 0
+
+    def report(finished=False):
+        elapsed = time.perf_counter() - started
+        rate = seen / elapsed if elapsed else 0.0
+        return {
+            'name': backfill.name, 'last_pk': checkpoint.last_pk, 'seen': seen, 'updated': updated,
+            'remaining': max(remaining - seen, 0), 'total_seen': checkpoint.rows_seen,
+            'total_updated': checkpoint.rows_updated, 'elapsed': elapsed, 'rows_per_s': rate,
+            'eta': (remaining - seen) / rate if rate and not finished else 0.0, 'finished': finished,
+        }
+
+    while max_chunks is None or chunks < max_chunks:
+        chunk = list(rows.filter(pk__gt=checkpoint.last_pk)[:chunk_size])
+        if not chunk:
+            checkpoint.finished_at = timezone.now()
+            checkpoint.save(update_fields=['finished_at'])
+            final = report(finished=True)
+            logger.info(f"Backfill {backfill.name} finished: {final['total_updated']} of "
+                        f"{final['total_seen']} rows updated")
+            if progress:
+                progress(final)
+            return final
+
+        lookup = backfill.lookup(chunk)
+        changed = [row for row in chunk if backfill.apply(row, lookup)]
+        with transaction.atomic():
+            if changed:
+                backfill.model.objects.bulk_update(changed, backfill.fields)
+            checkpoint.last_pk = chunk[-1].pk
+            checkpoint.rows_seen += len(chunk)
+            checkpoint.rows_updated += len(changed)
+            checkpoint.updated_at = timezone.now()
+            checkpoint.save(update_fields=['last_pk', 'rows_seen', 'rows_updated', 'updated_at'])
+
+        seen += len(chunk)
+        updated += len(changed)
+        chunks += 1
+        if progress:
+            progress(report())
+    return report()
@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+
+from users.models import TelegramUser
+from .models import CommandRollup
+from . import rollups
+
+logger = logging.getLogger(__name__)
+
+
+class DashboardMetrics:
+    """
+    The numbers on the BotAnalytics dashboard, computed with two aggregate
+    queries and cached. Within `ttl` seconds the cached copy is returned as is;
+    up to `stale_ttl` seconds it is still returned while one background thread
+    recomputes it; after that the caller waits for a fresh copy.
+    """
+
+    cache_key = 'botanalytics:dashboard_metrics'
+
+    def __init__(self, ttl: float = 60, stale_ttl: float = 600, active_days: int = 3):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.active_days = active_days
+        self._refreshing = threading.Lock()
+
+    def get(self) -> dict:
+        cached = cache.get(self.cache_key)
+        if cached is not None:
+            age = time.time() - cached['computed_at']
+            if age < self.ttl:
+                return cached
+            if age < self.stale_ttl:
+                self._refresh_in_background()
+                return cached
+        return self.refresh()
+
+    def refresh(self) -> dict:
+        metrics = self.compute()
+        cache.set(self.cache_key, metrics, timeout=self.stale_ttl)
+        return metrics
+
+    def invalidate(self) -> None:
+        cache.delete(self.cache_key)
+
+    def _refresh_in_background(self) -> None:
+        if not self._refreshing.acquire(blocking=False):
+            return  # Another request is already recomputing
+
+        def run():
+            try:
+                close_old_connections()
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Dashboard metrics refresh failed: {e}")
+            finally:
+                connection.close()
+                self._refreshing.release()
+
+        threading.Thread(target=run, name="DashboardMetricsRefresh", daemon=True).start()
+
+    def compute(self) -> dict:
+        since = timezone.now() - timedelta(days=self.active_days)
+
+        # last_active_at is None for users who never sent a command; they are neither active nor inactive
+        users = TelegramUser.objects.aggregate(
+            total=Count('id'),
+            new=Count('id', filter=Q(joined_at__gte=since)),
+            active=Count('id', filter=Q(last_active_at__gte=since)),
+            inactive=Count('id', filter=Q(last_active_at__lt=since)),
+        )
+        commands = list(
+            CommandRollup.objects.filter(rollups.rollup_filter())
+            .values('command')
+            .annotate(total=Sum('count'), min_response_time=Min('min_response_time'),
+                      max_response_time=Max('max_response_time'))
+            .order_by('-total')
+        )
+
+        total_users = users['total']
+        active_users = users['active']
+        min_times = [row['min_response_time'] for row in commands if row['min_response_time'] is not None]
+        max_times = [row['max_response_time'] for row in commands if row['max_response_time'] is not None]
+
+        return {
+            'computed_at': time.time(),
+            'total_users': total_users,
+            'new_users': users['new'],
+            'active_users': active_users,
+            'inactive_users': users['inactive'],
+            'engagement_rate': active_users / total_users * 100 if total_users else 0,
+            'total_commands': sum(row['total'] for row in commands),
+            'min_response_time': min(min_times) if min_times else None,
+            'max_response_time': max(max_times) if max_times else None,
+            'command_usage': [{'command': row['command'], 'total': row['total']} for row in commands],
+        }
+
+
+dashboard_metrics = DashboardMetrics(
+    ttl=getattr(settings, 'DASHBOARD_METRICS_TTL', 60),
+    stale_ttl=getattr(settings, 'DASHBOARD_METRICS_STALE_TTL', 600),
+)
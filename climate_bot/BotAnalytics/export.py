@@ -0,0 +1,132 @@
+"""
+Streaming exports of the raw analytics events. Rows are read with
+.iterator(chunk_size=...) and encoded one at a time, so memory use does not
+depend on how many rows are exported.
+"""
+import csv
+import json
+import zlib
+from datetime import datetime, time
+from typing import Iterable, Iterator, Optional
+
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+from .models import BotAnalytics, LocationsAnalytics
+
+EXPORTS = {
+    'botanalytics': (BotAnalytics, ['id', 'user_id', 'user_name', 'command', 'timestamp', 'success',
+                                    'device_location', 'response_time', 'stages']),
+    'locations': (LocationsAnalytics, ['id', 'user_id', 'timestamp', 'device_id', 'device_name',
+                                       'device_province']),
+}
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def parse_bound(value: Optional[str], end: bool = False) -> Optional[datetime]:
+    """
+    Parse an ISO date or datetime. A bare date used as the end of a range
+    means the end of that day. Raises ValueError for anything else.
+    """
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        parsed = datetime.combine(day, time.max if end else time.min)
+    return make_aware(parsed) if is_naive(parsed) else parsed
+
+
+def export_rows(name: str, start=None, end=None, user_id=None, province=None, chunk_size: int = 2000):
+    """The selected rows of export `name` as value tuples, in id order."""
+    model, fields = EXPORTS[name]
+    rows = model.objects.order_by('id')
+    if start is not None:
+        rows = rows.filter(timestamp__gte=start)
+    if end is not None:
+        rows = rows.filter(timestamp__lte=end)
+    if user_id:
+        rows = rows.filter(user_id=user_id)
+    if province and model is LocationsAnalytics:
+        rows = rows.filter(device_province=province)
+    return rows.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+class _Line:
+    """File-like object that hands back what csv.writer writes to it."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(fields, rows: Iterable[tuple]) -> Iterator[str]:
+    writer = csv.writer(_Line())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def ndjson_lines(fields, rows: Iterable[tuple]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), ensure_ascii=False, default=_json_default) + '\n'
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+
+def encode(lines: Iterable[str], compress: bool = False, buffer_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Encode lines to UTF-8, gzip them when `compress` is set, and yield
+    blocks of about `buffer_size` bytes instead of one tiny chunk per row.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31: gzip container
+    buffer, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            block = b''.join(buffer)
+            buffer, size = [], 0
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+    block = b''.join(buffer)
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+
+def export_stream(name: str, fmt: str = 'csv', compress: bool = False, rows=None, **filters) -> Iterator[bytes]:
+    """Encode `rows` (by default the database rows selected by `filters`) as a CSV or NDJSON byte stream."""
+    _, fields = EXPORTS[name]
+    if rows is None:
+        rows = export_rows(name, **filters)
+    lines = csv_lines(fields, rows) if fmt == 'csv' else ndjson_lines(fields, rows)
+    return encode(lines, compress=compress)
+
+
+def export_filename(name: str, fmt: str, compress: bool, start=None, end=None) -> str:
+    parts = [name]
+    if start is not None:
+        parts.append(start.strftime('%Y%m%d'))
+    if end is not None:
+        parts.append(end.strftime('%Y%m%d'))
+    return '_'.join(parts) + f".{fmt}" + ('.gz' if compress else '')
@@ -1,10 +1,32 @@
 from django.contrib.admin import SimpleListFilter
-from django.db.models import Max
+from django.db.models import CharField, OuterRef, Subquery
+from django.db.models.functions import Cast
 from datetime import timedelta
 from django.utils.timezone import now
+from users.models import TelegramUser
 from .models import BotAnalytics
 
 
+def latest_activity(queryset, status=None, days=3):
+    """
+    Each user's most recent BotAnalytics row, found through the denormalised
+    TelegramUser.last_active_at instead of a Max('timestamp') over all events.
+    `status` 'active' keeps users seen in the last `days` days, 'inactive' the rest.
+    """
+    cutoff = now() - timedelta(days=days)
+    users = TelegramUser.objects.exclude(last_active_at=None)
+    if status == 'active':
+        users = users.filter(last_active_at__gte=cutoff)
+    elif status == 'inactive':
+        users = users.filter(last_active_at__lt=cutoff)
+    # One (user_id, timestamp) index lookup per user, so ties between users cannot mix
+    latest_rows = users.annotate(row_id=Subquery(
+        BotAnalytics.objects.filter(
+            user_id=Cast(OuterRef('telegram_id'), CharField()),
+            timestamp=OuterRef('last_active_at'),
+        ).values('id')[:1]
+    )).values('row_id')
+    return queryset.filter(pk__in=latest_rows)
 
 
 class UserStatusFilter(SimpleListFilter):
@@ -19,21 +41,6 @@ class UserStatusFilter(SimpleListFilter):
         )
 
     def queryset(self, request, queryset):
-        # Get the latest activity for each user (latest timestamp)
-        latest_activities = BotAnalytics.objects.values('user_id').annotate(last_activity=Max('timestamp'))
-        print(f"==============:{latest_activities}")
-        # Get the most recent activity logs for active users (last activity more than 3 days ago)
-        if self.value() == 'inactive':
-            active_user_ids = latest_activities.filter(last_activity__lt=now() - timedelta(days=3)).values_list('user_id', flat=True)
-            # Now filter the queryset to get only the last activity for these active users
-            return queryset.filter(user_id__in=active_user_ids, timestamp__in=latest_activities.filter(user_id__in=active_user_ids).values('last_activity'))
-
-        # Get the most recent activity logs for inactive users (last activity within the last 3 days)
-        if self.value() == 'active':
-            inactive_user_ids = latest_activities.filter(last_activity__gte=now() - timedelta(days=3)).values_list('user_id', flat=True)
-            # Now filter the queryset to get only the last activity for these inactive users
-            return queryset.filter(user_id__in=inactive_user_ids, timestamp__in=latest_activities.filter(user_id__in=inactive_user_ids).values('last_activity'))
-
-        return queryset.filter(timestamp__in=latest_activities.values('last_activity'))
-
-
+        # Active: last command within the last 3 days; inactive: longer ago.
+        # Either way only each user's latest row is listed.
+        return latest_activity(queryset, self.value())
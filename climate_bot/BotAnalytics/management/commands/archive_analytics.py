@@ -0,0 +1,32 @@
+# BotAnalytics/management/commands/archive_analytics.py
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from BotAnalytics import archive, rollups
+
+
+class Command(BaseCommand):
+    help = 'Moves analytics events older than the retention window into monthly gzip archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'ANALYTICS_RETENTION_DAYS', 180),
+                            help='Keep this many days of raw events in the database')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between delete chunks')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be archived')
+
+    def handle(self, *args, **options):
+        # Whole local days only, so rebuilding the rollups from the cutoff stays exact
+        before = rollups.floor_day(timezone.now() - timedelta(days=options['days']))
+        archived = archive.archive_events(
+            before, chunk_size=options['chunk_size'], pause=options['pause'], dry_run=options['dry_run'],
+        )
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        for name, count in archived.items():
+            self.stdout.write(f"{verb} {count} {name} rows older than {before:%Y-%m-%d}")
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Archives are in {archive.archive_dir()}"))
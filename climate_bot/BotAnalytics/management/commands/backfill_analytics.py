@@ -0,0 +1,47 @@
+# BotAnalytics/management/commands/backfill_analytics.py
+
+from django.core.management.base import BaseCommand
+
+from BotAnalytics.backfill import BACKFILLS, run_backfill
+from BotAnalytics.models import BackfillCheckpoint
+
+
+class Command(BaseCommand):
+    help = 'Runs a chunked, resumable analytics backfill and reports its progress'
+
+    def add_arguments(self, parser):
+        parser.add_argument('backfill', nargs='?', choices=sorted(BACKFILLS),
+                            help='Backfill to run; without one, lists the backfills and their checkpoints')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read and written per transaction')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first row')
+        parser.add_argument('--max-chunks', type=int, help='Stop after this many chunks (resume later)')
+
+    def handle(self, *args, **options):
+        if not options['backfill']:
+            checkpoints = BackfillCheckpoint.objects.in_bulk(list(BACKFILLS), field_name='name')
+            for name, backfill in sorted(BACKFILLS.items()):
+                self.stdout.write(f"{name:<16}{backfill.help}")
+                if name in checkpoints:
+                    self.stdout.write(f"{'':<16}{checkpoints[name]}")
+            return
+
+        report = run_backfill(
+            BACKFILLS[options['backfill']], chunk_size=options['chunk_size'], restart=options['restart'],
+            max_chunks=options['max_chunks'], progress=self.print_progress,
+        )
+        self.stdout.write('')
+        if report['finished']:
+            self.stdout.write(self.style.SUCCESS(
+                f"{report['name']}: updated {report['total_updated']} of {report['total_seen']} rows"))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f"{report['name']}: stopped at pk {report['last_pk']}, {report['remaining']} rows left; "
+                f"run again to resume"))
+
+    def print_progress(self, report):
+        self.stdout.write(
+            f"\r{report['name']}: {report['seen']} rows ({report['updated']} updated), "
+            f"{report['remaining']} left, {report['rows_per_s']:.0f} rows/s, ETA {report['eta']:.0f}s   ",
+            ending='',
+        )
+        self.stdout.flush()
@@ -0,0 +1,16 @@
+# BotAnalytics/management/commands/backfill_user_activity.py
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Sets TelegramUser.last_active_at and command_count from the BotAnalytics history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        # Stop the bot first, otherwise commands logged during the backfill are counted twice
+        call_command('backfill_analytics', 'user_activity', chunk_size=options['chunk_size'], restart=True,
+                     stdout=self.stdout)
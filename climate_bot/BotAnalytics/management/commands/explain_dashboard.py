@@ -0,0 +1,162 @@
+# BotAnalytics/management/commands/explain_dashboard.py
+
+import os
+import random
+import re
+import tempfile
+import time
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from BotAnalytics import rollups
+from BotAnalytics.dashboard import dashboard_metrics
+from BotAnalytics.filters import latest_activity
+from BotAnalytics.models import BotAnalytics, LocationsAnalytics
+from users.models import TelegramUser
+
+# SQLite reports "SCAN <table>" for a full table scan and "SCAN ... USING INDEX"
+# for a full index scan ("SCAN subquery" just reads a co-routine's output);
+# PostgreSQL reports "Seq Scan on <table>"
+TABLE_SCAN = re.compile(r"\bSCAN (TABLE )?(?!subquery$)\S+$|Seq Scan on")
+INDEX_SCAN = re.compile(r"\bSCAN \S+ USING (COVERING )?INDEX")
+
+COMMANDS = ['/start', '/Current 📍', '/Change_location 🔄', '/Help ❓', '/Compare 🆚', '/Start_Comparing']
+PROVINCES = ['Yerevan', 'Shirak', 'Lori', 'Tavush', 'Gegharkunik', 'Kotayk', 'Armavir', 'Aragatsotn',
+             'Ararat', 'Vayots Dzor', 'Syunik']
+
+
+def dashboard_queries(province):
+    """The queries behind the BotAnalytics and LocationsAnalytics admin pages."""
+    day_ago = timezone.now() - timedelta(days=1)
+    return {
+        'dashboard_metrics': dashboard_metrics.compute,
+        'status_filter_active': lambda: list(latest_activity(BotAnalytics.objects.all(), 'active')[:100]),
+        'status_filter_inactive': lambda: list(latest_activity(BotAnalytics.objects.all(), 'inactive')[:100]),
+        'location_usage': lambda: rollups.location_usage(province, day_ago),
+    }
+
+
+def explain(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(connection.ops.explain_query_prefix() + " " + sql)
+        rows = cursor.fetchall()
+    # SQLite returns (id, parent, notused, detail); other backends return one text column
+    return [str(row[-1]) for row in rows]
+
+
+class Command(BaseCommand):
+    help = 'Prints the query plan and timing of every analytics dashboard query and warns on full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Benchmark on a throwaway database seeded with this many BotAnalytics rows '
+                                 '(e.g. 10000000) instead of the configured one')
+        parser.add_argument('--repeat', type=int, default=3, help='Time each query this many times, keep the best')
+        parser.add_argument('--province', default='Yerevan', help='Province used for the device usage query')
+        parser.add_argument('--no-plan', action='store_true', help='Only print timings')
+
+    def handle(self, *args, **options):
+        old_db_name = None
+        if options['seed']:
+            old_db_name = self._create_scratch_db()
+        try:
+            if options['seed']:
+                self.seed(options['seed'])
+            warnings = self.report(options)
+        finally:
+            if old_db_name is not None:
+                connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+        if warnings:
+            self.stdout.write(self.style.WARNING(f"{warnings} queries scan a whole table: {', '.join(self.scanned)}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No full table scans"))
+
+    def _create_scratch_db(self):
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            fd, path = tempfile.mkstemp(prefix='explain_', suffix='.sqlite3')
+            os.close(fd)
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        return old_name
+
+    def report(self, options):
+        self.scanned = []
+        for name, query in dashboard_queries(options['province']).items():
+            with CaptureQueriesContext(connection) as captured:
+                query()
+            best = None
+            for _ in range(max(1, options['repeat'])):
+                started = time.perf_counter()
+                query()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name}: {best * 1000:.1f} ms"))
+            for executed in captured.captured_queries:
+                plan = explain(executed['sql'])
+                table_scans = [line for line in plan if TABLE_SCAN.search(line)]
+                if table_scans and name not in self.scanned:
+                    self.scanned.append(name)
+                if options['no_plan']:
+                    continue
+                self.stdout.write(f"  {executed['sql']}")
+                for line in plan:
+                    if TABLE_SCAN.search(line):
+                        self.stdout.write(self.style.WARNING(f"    {line}  <- full table scan"))
+                    elif INDEX_SCAN.search(line):
+                        self.stdout.write(f"    {line}  <- full index scan")
+                    else:
+                        self.stdout.write(f"    {line}")
+        return len(self.scanned)
+
+    def seed(self, rows, batch_size=20000):
+        """Insert `rows` BotAnalytics events from rows // 100 users, a quarter as many device picks, over a year."""
+        rng = random.Random(0)
+        users = max(1, rows // 100)
+        now = timezone.now()
+        year = 365 * 24 * 3600
+        started = time.perf_counter()
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous = OFF')
+
+        with transaction.atomic():
+            TelegramUser.objects.bulk_create(
+                [TelegramUser(telegram_id=10 ** 9 + i, user_name=f"user{i}", first_name=f"User {i}")
+                 for i in range(users)],
+                batch_size=batch_size,
+            )
+            TelegramUser.objects.update(joined_at=now - timedelta(days=365))
+            for offset in range(0, rows, batch_size):
+                events, picks = [], []
+                for _ in range(min(batch_size, rows - offset)):
+                    user = rng.randrange(users)
+                    timestamp = now - timedelta(seconds=rng.random() * year)
+                    response_time = rng.lognormvariate(-2, 0.8)
+                    events.append(BotAnalytics(
+                        user_id=str(10 ** 9 + user), user_name=f"user{user}", command=rng.choice(COMMANDS),
+                        timestamp=timestamp, response_time=response_time,
+                    ))
+                    if rng.random() < 0.25:
+                        province = rng.choice(PROVINCES)
+                        picks.append(LocationsAnalytics(
+                            user_id=str(10 ** 9 + user), timestamp=timestamp, device_id=rng.randrange(200),
+                            device_name=f"{province} {rng.randrange(20)}", device_province=province,
+                        ))
+                BotAnalytics.objects.bulk_create(events, batch_size=batch_size)
+                LocationsAnalytics.objects.bulk_create(picks, batch_size=batch_size)
+                self.stdout.write(f"\rSeeded {offset + len(events)}/{rows} events", ending='')
+                self.stdout.flush()
+        rollups.rebuild_rollups()
+        call_command('backfill_user_activity', stdout=self.stdout)
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        self.stdout.write(f"\nSeeded {rows} events for {users} users in {time.perf_counter() - started:.0f}s")
@@ -0,0 +1,49 @@
+# BotAnalytics/management/commands/export_analytics.py
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BotAnalytics import archive, export
+
+
+class Command(BaseCommand):
+    help = 'Streams raw BotAnalytics or LocationsAnalytics rows to a CSV or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(export.EXPORTS))
+        parser.add_argument('--start', help='Only rows from this ISO date/datetime')
+        parser.add_argument('--end', help='Only rows up to this ISO date/datetime (a date includes the whole day)')
+        parser.add_argument('--user-id')
+        parser.add_argument('--province', help='Only picks in this province (locations export)')
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', '-o', help='Output file, defaults to stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--archived', action='store_true',
+                            help='Include rows already moved to the archives by archive_analytics')
+
+    def handle(self, *args, **options):
+        try:
+            start = export.parse_bound(options['start'])
+            end = export.parse_bound(options['end'], end=True)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        filters = dict(start=start, end=end, user_id=options['user_id'], province=options['province'],
+                       chunk_size=options['chunk_size'])
+        rows = archive.history(options['model'], **filters) if options['archived'] else None
+        stream = export.export_stream(options['model'], options['format'], options['gzip'], rows=rows, **filters)
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        written = 0
+        try:
+            for block in stream:
+                out.write(block)
+                written += len(block)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
+        if options['output']:
+            self.stderr.write(f"Wrote {written} bytes to {options['output']}")
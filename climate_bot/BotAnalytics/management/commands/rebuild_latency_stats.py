@@ -0,0 +1,44 @@
+# BotAnalytics/management/commands/rebuild_latency_stats.py
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from BotAnalytics import archive
+from BotAnalytics.export import EXPORTS
+from BotAnalytics.models import UserLatencyStats
+from BotAnalytics.sketch import LatencySketch
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds UserLatencyStats from the full BotAnalytics history, archived months included'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        stats = {}
+        sketches = {}
+        fields = EXPORTS['botanalytics'][1]
+        user_index, latency_index = fields.index('user_id'), fields.index('response_time')
+        # The stats cover every command ever logged, so archived events count too
+        for row in archive.history('botanalytics', chunk_size=options['chunk_size']):
+            user_id, response_time = row[user_index], row[latency_index]
+            if response_time is None:
+                continue
+            if user_id not in stats:
+                stats[user_id] = UserLatencyStats(user_id=user_id)
+                sketches[user_id] = LatencySketch()
+            stats[user_id].add(response_time, sketches[user_id])
+
+        updated_at = timezone.now()
+        for user_id, user_stats in stats.items():
+            user_stats.sketch = sketches[user_id].to_dict()
+            user_stats.updated_at = updated_at
+
+        # Stop the bot first, otherwise commands logged during the rebuild are lost
+        with transaction.atomic():
+            UserLatencyStats.objects.all().delete()
+            UserLatencyStats.objects.bulk_create(stats.values(), batch_size=options['chunk_size'])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt latency stats for {len(stats)} users"))
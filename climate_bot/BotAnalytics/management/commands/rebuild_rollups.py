@@ -0,0 +1,38 @@
+# BotAnalytics/management/commands/rebuild_rollups.py
+
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from BotAnalytics.rollups import rebuild_rollups, rebuild_start
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the hourly and daily analytics rollups from the raw events'
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--since', help='Rebuild from this date (YYYY-MM-DD) onwards')
+        group.add_argument('--days', type=int, help='Rebuild the last N days')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            day = parse_date(options['since'])
+            if day is None:
+                raise CommandError(f"Invalid --since date: {options['since']}")
+            since = timezone.make_aware(datetime.combine(day, time.min))
+        elif options['days']:
+            since = timezone.now() - timedelta(days=options['days'])
+
+        start = rebuild_start(since)
+        if start is not since:
+            self.stdout.write(self.style.WARNING(
+                f"Events before {timezone.localtime(start):%Y-%m-%d} are archived; their rollups are kept"))
+        since = start
+        written = rebuild_rollups(since=since, chunk_size=options['chunk_size'])
+        scope = f"since {timezone.localtime(since):%Y-%m-%d}" if since else "for all history"
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rollups {scope}: {written} rows"))
@@ -0,0 +1,246 @@
+"""
+In-process metrics for the bot: counters, gauges and histograms kept in a
+module-level registry and served in the Prometheus text format by serve(),
+which start_bot runs on METRICS_PORT. Code that records metrics imports the
+ones defined at the bottom of this module; values that already live elsewhere
+(queue depths, cache statistics, device refresh state) are read at scrape time
+through set_function().
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers a cached reply (ms) up to a slow render or upstream timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, float] = {}
+        self._functions: Dict[tuple, Callable[[], float]] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, func: Callable[[], float], **labels) -> None:
+        """Read the value of this label set from `func()` at scrape time."""
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                values[key] = float(func())
+            except Exception as e:
+                logger.warning(f"Metric {self.name}{key} could not be read: {e}")
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for name, labels, value in self.samples():
+            yield f"{name}{labels} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[tuple, list] = {}  # key -> [per-bucket counts..., sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        # NaN compares false with every bound and is counted in +Inf
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets) - 1)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, values[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = [line for metric in metrics for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the log
+
+
+def serve(port: int, host: str = '127.0.0.1') -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on host:port from a daemon thread; returns the server, or None if the port is taken."""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+updates = registry.counter(
+    'bot_updates_total', 'Telegram updates received, by content type', ('content_type',))
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', 'Time spent in each message handler', ('handler',))
+handler_calls = registry.counter(
+    'bot_handler_calls_total', 'Handler calls by outcome (ok or error)', ('handler', 'outcome'))
+upstream_latency = registry.histogram(
+    'bot_upstream_request_duration_seconds', 'Upstream HTTP request time', ('service', 'endpoint'))
+upstream_errors = registry.counter(
+    'bot_upstream_errors_total', 'Upstream requests that failed or returned an error status', ('service', 'endpoint'))
+cache_requests = registry.counter(
+    'bot_cache_requests_total', 'Cache lookups by result (hit or miss)', ('cache', 'result'))
+queue_depth = registry.gauge(
+    'bot_queue_depth', 'Items waiting in an in-process queue', ('queue',))
+writer_records = registry.counter(
+    'bot_analytics_writer_records_total', 'Analytics writer records by outcome', ('outcome',))
+device_refresh_age = registry.gauge(
+    'bot_device_list_age_seconds', 'Seconds since the device list was last refreshed')
+device_refresh_failures = registry.gauge(
+    'bot_device_list_consecutive_failures', 'Device list refreshes that failed in a row')
+devices = registry.gauge(
+    'bot_devices', 'Devices known to the bot, and those reporting issues', ('state',))
+renders_in_progress = registry.gauge(
+    'bot_renders_in_progress', 'Comparison images being rendered right now')
+renders_in_progress.set(0)
+render_latency = registry.histogram(
+    'bot_render_duration_seconds', 'Time to render a comparison image')
+broadcast_messages = registry.counter(
+    'bot_broadcast_messages_total', 'Broadcast send attempts by outcome', ('outcome',))
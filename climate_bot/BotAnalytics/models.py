@@ -1,4 +1,5 @@
 from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import User  # If you track specific users
 from django.utils import timezone
 import pytz
@@ -7,12 +8,21 @@ class BotAnalytics(models.Model):
     user_id = models.CharField(max_length=50)  # Telegram user ID
     user_name = models.CharField(max_length=40,blank=True)
     command = models.CharField(max_length=100)  # Command or action
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)  # Set when queued, not when flushed
     success = models.BooleanField(default=True)  # Track errors if needed
     device_location = models.CharField(max_length=255, blank=True, null=True)  # For ClimateNet-specific devices
     response_time = models.FloatField(null=True, blank=True)  # New field for response latency
     min_response_time = models.FloatField(null=True, blank=True)  # Minimum latency
     max_response_time = models.FloatField(null=True, blank=True)
+    stages = models.JSONField(null=True, blank=True)  # {stage: seconds} from BotAnalytics.spans
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'timestamp'], name='ba_user_timestamp_idx'),  # per-user activity
+            models.Index(fields=['timestamp'], name='ba_timestamp_idx'),  # active users, date ranges
+            models.Index(fields=['command'], name='ba_command_idx'),  # command usage group-by
+            models.Index(fields=['device_location'], name='ba_device_location_idx'),  # popular devices group-by
+        ]
 
     def __str__(self):
         return f"{self.user_id} - {self.user_name} - {self.command} - {self.timestamp}"
@@ -39,11 +49,179 @@ class BotAnalytics(models.Model):
 
 class LocationsAnalytics(models.Model):
     user_id = models.CharField(max_length=50)  # Telegram user ID
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     device_id = models.BigIntegerField(blank=True)
     device_name = models.CharField(blank=True,max_length=50)
     device_province = models.CharField(blank=True,max_length=50)
 
+    class Meta:
+        indexes = [
+            # Province usage over a date range, and device usage within one province
+            models.Index(fields=['timestamp', 'device_province'], name='la_timestamp_province_idx'),
+            models.Index(fields=['device_province', 'timestamp', 'device_name'], name='la_province_ts_device_idx'),
+            models.Index(fields=['device_province', 'user_id'], name='la_province_user_idx'),  # broadcast segments
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}  - {self.timestamp} - {self.device_id}"
+
+class UserLatencyStats(models.Model):
+    """Running response time statistics per user, updated as commands are logged."""
+    user_id = models.CharField(max_length=50, unique=True)  # Telegram user ID
+    count = models.PositiveIntegerField(default=0)
+    total_response_time = models.FloatField(default=0.0)
+    min_response_time = models.FloatField(null=True, blank=True)
+    max_response_time = models.FloatField(null=True, blank=True)
+    sketch = models.JSONField(default=dict, blank=True)  # LatencySketch.to_dict()
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = "User latency stats"
+
+    def __str__(self):
+        return f"{self.user_id} - {self.count} commands"
+
+    @property
+    def mean_response_time(self):
+        return self.total_response_time / self.count if self.count else None
+
+    def get_sketch(self):
+        from .sketch import LatencySketch
+        return LatencySketch.from_dict(self.sketch)
+
+    def add(self, response_time, sketch):
+        """Fold one response time into the totals and `sketch`; the caller stores the sketch."""
+        if response_time is None:
+            return
+        self.count += 1
+        self.total_response_time += response_time
+        self.min_response_time = response_time if self.min_response_time is None else min(self.min_response_time, response_time)
+        self.max_response_time = response_time if self.max_response_time is None else max(self.max_response_time, response_time)
+        sketch.add(response_time)
+
+
+ROLLUP_PERIODS = [('hour', 'Hour'), ('day', 'Day')]
+
+
+class CommandRollup(models.Model):
+    """Commands per hour/day bucket (Asia/Yerevan), with their latency sum, extrema and quantile sketch."""
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    bucket = models.DateTimeField()  # Start of the hour or day
+    command = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+    latency_count = models.PositiveIntegerField(default=0)
+    latency_sum = models.FloatField(default=0.0)
+    min_response_time = models.FloatField(null=True, blank=True)
+    max_response_time = models.FloatField(null=True, blank=True)
+    sketch = models.JSONField(default=dict, blank=True)  # LatencySketch.to_dict() of the bucket's response times
+    stages = models.JSONField(default=dict, blank=True)  # {stage: [events, total seconds]}
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'command'], name='command_rollup_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket} - {self.command}: {self.count}"
+
+    @property
+    def mean_response_time(self):
+        return self.latency_sum / self.latency_count if self.latency_count else None
+
+    def get_sketch(self):
+        from .sketch import LatencySketch
+        return LatencySketch.from_dict(self.sketch)
+
+    def stage_means(self):
+        """Mean seconds per stage, slowest first."""
+        means = {stage: total / count for stage, (count, total) in self.stages.items() if count}
+        return dict(sorted(means.items(), key=lambda item: -item[1]))
+
+
+class ActiveUserRollup(models.Model):
+    """One row per user active in an hour/day bucket, so distinct users can be counted over a range."""
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    bucket = models.DateTimeField()
+    user_id = models.CharField(max_length=50)
+    user_name = models.CharField(max_length=40, blank=True, null=True)
+    count = models.PositiveIntegerField(default=0)  # Commands sent in the bucket
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'user_id'], name='active_user_rollup_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket} - {self.user_id}: {self.count}"
+
+
+class LocationRollup(models.Model):
+    """Device picks per hour/day bucket."""
+    period = models.CharField(max_length=4, choices=ROLLUP_PERIODS)
+    bucket = models.DateTimeField()
+    device_province = models.CharField(blank=True, max_length=50)
+    device_name = models.CharField(blank=True, max_length=50)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'bucket', 'device_province', 'device_name'],
+                                    name='location_rollup_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket} - {self.device_name}: {self.count}"
+
+
+class RollupWatermark(models.Model):
+    """Bumped whenever rollups change, so cached dashboard data can tell it is stale."""
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    last_event_at = models.DateTimeField(null=True, blank=True)  # Newest event folded in
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+class BackfillCheckpoint(models.Model):
+    """How far a chunked backfill (BotAnalytics/backfill.py) has got, so it can resume after an interruption."""
+    name = models.CharField(max_length=50, unique=True)
+    last_pk = models.BigIntegerField(default=0)  # Every row up to this primary key is done
+    rows_seen = models.PositiveBigIntegerField(default=0)
+    rows_updated = models.PositiveBigIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        state = 'done' if self.finished_at else f"at pk {self.last_pk}"
+        return f"{self.name} ({state})"
+
+
+PROFILE_KINDS = [
+    ('sampling', 'Stack sampling (all threads)'),
+    ('cprofile', 'cProfile (handlers)'),
+    ('memory', 'Heap (tracemalloc)'),
+]
+PROFILE_STATUSES = [('requested', 'Requested'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')]
+
+
+class ProfileRun(models.Model):
+    """A time-boxed profile of the running bot, requested from the admin or a signal and collected by start_bot."""
+    kind = models.CharField(max_length=20, choices=PROFILE_KINDS, default='sampling')
+    duration = models.PositiveIntegerField(default=30, validators=[MinValueValidator(1), MaxValueValidator(600)])  # seconds
+    status = models.CharField(max_length=20, choices=PROFILE_STATUSES, default='requested', db_index=True)
+    requested_by = models.CharField(max_length=150, blank=True)
+    requested_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    summary = models.TextField(blank=True)
+    artifact = models.CharField(max_length=255, blank=True)  # File name under PROFILE_DIR
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-requested_at']
 
     def __str__(self):
-        return f"{self.user_id}  - {self.timestamp} - {self.device_id}"
\ No newline at end of file
+        return f"{self.get_kind_display()} {timezone.localtime(self.requested_at):%Y-%m-%d %H:%M} ({self.status})"
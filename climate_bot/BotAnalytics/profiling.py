@@ -0,0 +1,285 @@
+"""
+Profiles of the running bot, taken without restarting it. A ProfileRun is
+requested from the admin (or with SIGUSR1/SIGUSR2 sent to start_bot); the
+ProfileWorker thread in the bot process picks it up, profiles for the
+requested number of seconds and writes the result to PROFILE_DIR, where the
+admin offers it for download.
+
+- sampling: samples the stack of every thread (polling dispatcher, handler
+  workers, writer, ...) every few milliseconds and writes them in the folded
+  format flame graph tools read (flamegraph.pl, speedscope).
+- cprofile: runs cProfile around every handler call in the window and writes
+  the merged stats (load them with pstats or snakeviz).
+- memory: traces allocations with tracemalloc for the window and reports the
+  top allocation sites, what grew, and the size of the structures registered
+  with add_size_probe() (e.g. user_context). Tracing slows allocation-heavy
+  code down noticeably while it runs.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ProfileRun
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP = 25  # Lines in summaries
+
+_size_probes: Dict[str, Callable[[], int]] = {}
+
+
+def profile_dir():
+    return getattr(settings, 'PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def add_size_probe(name: str, func: Callable[[], int]) -> None:
+    """Report `func()` (e.g. the length of a long-lived dict) before and after each memory profile."""
+    _size_probes[name] = func
+
+
+def _probe_sizes() -> Dict[str, object]:
+    sizes = {}
+    for name, func in _size_probes.items():
+        try:
+            sizes[name] = func()
+        except Exception as e:
+            sizes[name] = f"error: {e}"
+    return sizes
+
+
+class _HandlerStats:
+    """cProfile stats of the handler calls made while a cprofile run is open."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Optional[pstats.Stats] = None
+        self.calls = 0
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.calls += 1
+
+
+_handler_stats: Optional[_HandlerStats] = None
+
+
+@contextmanager
+def handler_profile():
+    """Run cProfile around the block while a cprofile run is collecting; free otherwise."""
+    collecting = _handler_stats
+    if collecting is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        collecting.add(profile)
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(duration: float, interval: float = SAMPLE_INTERVAL, stop: Optional[threading.Event] = None):
+    """
+    Sample every other thread's stack for `duration` seconds. Returns a Counter
+    of (thread name, outermost frame, ..., innermost frame) and the number of
+    sampling rounds.
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    rounds = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline and not (stop and stop.is_set()):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stacks[(names.get(ident, str(ident)),) + tuple(reversed(stack))] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+
+def _sampling(run: ProfileRun, path: str, stop: threading.Event) -> str:
+    stacks, rounds = sample_stacks(run.duration, stop=stop)
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{';'.join(stack)} {count}\n")
+
+    own, total, threads = Counter(), Counter(), Counter()
+    for stack, count in stacks.items():
+        threads[stack[0]] += count
+        own[stack[-1]] += count
+        for frame in set(stack[1:]):
+            total[frame] += count
+    lines = [f"{rounds} sampling rounds over {run.duration}s, {len(threads)} threads", "", "Samples per thread:"]
+    lines += [f"  {count:>7}  {name}" for name, count in threads.most_common(TOP)]
+    lines += ["", "Innermost frames (where threads are, including waits):"]
+    lines += [f"  {count:>7}  {frame}" for frame, count in own.most_common(TOP)]
+    lines += ["", "Frames on the stack (inclusive):"]
+    lines += [f"  {count:>7}  {frame}" for frame, count in total.most_common(TOP)]
+    return '\n'.join(lines)
+
+
+def _cprofile(run: ProfileRun, path: str, stop: threading.Event) -> str:
+    global _handler_stats
+    collecting = _handler_stats = _HandlerStats()
+    try:
+        stop.wait(run.duration)
+    finally:
+        _handler_stats = None
+    time.sleep(0.5)  # Let handlers that started inside the window finish and add their stats
+    if collecting.stats is None:
+        open(path, 'wb').close()
+        return f"No handler ran during the {run.duration}s window."
+    collecting.stats.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(TOP)
+    return f"{collecting.calls} handler calls profiled over {run.duration}s\n{out.getvalue().strip()}"
+
+
+def _memory(run: ProfileRun, path: str, stop: threading.Event) -> str:
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(10)
+    sizes_before = _probe_sizes()
+    try:
+        first = tracemalloc.take_snapshot()
+        stop.wait(run.duration)
+        second = tracemalloc.take_snapshot()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+    first, second = first.filter_traces(ignore), second.filter_traces(ignore)
+
+    current = sum(stat.size for stat in second.statistics('filename'))
+    lines = [f"Traced memory after {run.duration}s: {current / 1024:.1f} KiB"]
+    if started_here:
+        lines.append("(tracing started with this run, so only allocations made during it are counted)")
+    lines += ["", "Structure sizes (before -> after):"]
+    lines += [f"  {name}: {sizes_before.get(name)} -> {size}" for name, size in _probe_sizes().items()]
+    lines += ["", "Top allocation sites:"]
+    lines += [f"  {stat}" for stat in second.statistics('lineno')[:TOP]]
+    growth = [stat for stat in second.compare_to(first, 'lineno') if stat.size_diff > 0]
+    lines += ["", "Growth during the run:"]
+    lines += [f"  {stat}" for stat in growth[:TOP]]
+    if growth:
+        biggest = second.compare_to(first, 'traceback')[0]
+        lines += ["", "Traceback of the largest growth:"] + [f"  {line}" for line in biggest.traceback.format()]
+    report = '\n'.join(lines)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(report + '\n')
+    return report
+
+
+EXTENSIONS = {'sampling': 'folded', 'cprofile': 'prof', 'memory': 'txt'}
+
+
+def run_profile(run: ProfileRun, stop: Optional[threading.Event] = None) -> ProfileRun:
+    """Collect `run` in this process, blocking for its duration, and record the result."""
+    stop = stop or threading.Event()
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    name = f"{run.kind}-{timezone.localtime():%Y%m%d-%H%M%S}-{run.pk}.{EXTENSIONS[run.kind]}"
+    path = os.path.join(directory, name)
+    logger.info(f"Profiling ({run.kind}) for {run.duration}s, writing {path}")
+    try:
+        if run.kind == 'sampling':
+            run.summary = _sampling(run, path, stop)
+        elif run.kind == 'cprofile':
+            run.summary = _cprofile(run, path, stop)
+        else:
+            run.summary = _memory(run, path, stop)
+        run.artifact = name
+        run.status = 'done'
+    except Exception as e:
+        logger.error(f"Profile {run.pk} failed: {e}")
+        run.status = 'failed'
+        run.error = str(e)
+    run.finished_at = timezone.now()
+    close_old_connections()
+    run.save(update_fields=['summary', 'artifact', 'status', 'error', 'finished_at'])
+    return run
+
+
+class ProfileWorker:
+    """
+    Thread in the bot process that runs requested profiles one at a time.
+    Requests come from the admin (ProfileRun rows, polled every
+    `poll_interval` seconds) or from request(), which a signal handler can call.
+    """
+
+    def __init__(self, poll_interval: float = 5):
+        self.poll_interval = poll_interval
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def request(self, kind: str, duration: Optional[int] = None, requested_by: str = 'signal') -> None:
+        self._requests.put((kind, duration or getattr(settings, 'PROFILE_DEFAULT_DURATION', 30), requested_by))
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ProfileWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        try:
+            # A run left 'running' was cut short by a restart
+            ProfileRun.objects.filter(status='running').update(
+                status='failed', error='The bot stopped during the run', finished_at=timezone.now())
+        except Exception as e:
+            logger.error(f"Profile worker could not reset interrupted runs: {e}")
+        while not self._stop.is_set():
+            try:
+                request = self._requests.get(timeout=self.poll_interval)
+            except queue.Empty:
+                request = None
+            try:
+                close_old_connections()
+                if request:
+                    kind, duration, requested_by = request
+                    ProfileRun.objects.create(kind=kind, duration=duration, requested_by=requested_by)
+                for run in ProfileRun.objects.filter(status='requested').order_by('requested_at'):
+                    # Claim it, so a second bot process would not run it too
+                    if ProfileRun.objects.filter(pk=run.pk, status='requested').update(
+                            status='running', started_at=timezone.now()):
+                        run_profile(run, self._stop)
+            except Exception as e:
+                logger.error(f"Profile worker error: {e}")
+
+
+profile_worker = ProfileWorker(poll_interval=getattr(settings, 'PROFILE_POLL_INTERVAL', 5))
@@ -0,0 +1,401 @@
+"""
+Hourly and daily rollups of the analytics events. The analytics writer folds
+every batch into them as it is inserted, rebuild_rollups() recomputes them
+from the raw events, and the dashboards read them so their cost depends on
+the time range instead of the size of the event tables. Buckets start on
+local (TIME_ZONE) hours and days.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from . import archive
+from .models import (ActiveUserRollup, BotAnalytics, CommandRollup, LocationRollup, LocationsAnalytics,
+                     RollupWatermark)
+from .sketch import LatencySketch
+from .writer import analytics_writer
+
+logger = logging.getLogger(__name__)
+
+HOUR = 'hour'
+DAY = 'day'
+WATERMARK = 'analytics'
+UNKNOWN_COMMAND = '<unknown>'  # For events queued without one; log_command_decorator stores '<content_type>'
+
+
+def floor_hour(moment):
+    return timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(moment):
+    return floor_hour(moment).replace(hour=0)
+
+
+def _buckets(moment):
+    hour = floor_hour(moment)
+    return ((HOUR, hour), (DAY, hour.replace(hour=0)))
+
+
+def _merge_min(current, value):
+    if value is None:
+        return current
+    return value if current is None else min(current, value)
+
+
+def _merge_max(current, value):
+    if value is None:
+        return current
+    return value if current is None else max(current, value)
+
+
+def _fold(model, key_fields, deltas, combine, update_fields):
+    """
+    Add `deltas` ({key tuple: partial row}) into the rollup rows of `model`,
+    reading the existing rows for those keys once and writing them back with
+    one bulk_create and one bulk_update.
+    """
+    if not deltas:
+        return
+    lookup = {f"{field}__in": {key[i] for key in deltas} for i, field in enumerate(key_fields)}
+    existing = {
+        tuple(getattr(row, field) for field in key_fields): row
+        for row in model.objects.filter(**lookup)
+    }
+    new_rows, changed_rows = [], []
+    for key, delta in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            new_rows.append(model(**dict(zip(key_fields, key)), **delta))
+        else:
+            combine(row, delta)
+            changed_rows.append(row)
+    model.objects.bulk_create(new_rows)
+    model.objects.bulk_update(changed_rows, update_fields)
+
+
+def _combine_commands(row, delta):
+    row.count += delta['count']
+    row.latency_count += delta['latency_count']
+    row.latency_sum += delta['latency_sum']
+    row.min_response_time = _merge_min(row.min_response_time, delta['min_response_time'])
+    row.max_response_time = _merge_max(row.max_response_time, delta['max_response_time'])
+    sketch = row.get_sketch()
+    sketch.merge(LatencySketch.from_dict(delta['sketch']))
+    row.sketch = sketch.to_dict()
+    row.stages = _merge_stages(dict(row.stages), delta['stages'])
+
+
+def _merge_stages(current, stages):
+    """Add `stages` ({stage: [events, seconds]}) into `current` in place."""
+    for stage, (count, total) in stages.items():
+        merged = current.setdefault(stage, [0, 0.0])
+        merged[0] += count
+        merged[1] += total
+    return current
+
+
+def _add_stages(current, breakdown):
+    """Add one event's {stage: seconds} breakdown into `current` in place."""
+    for stage, seconds in (breakdown or {}).items():
+        merged = current.setdefault(stage, [0, 0.0])
+        merged[0] += 1
+        merged[1] += seconds
+    return current
+
+
+def _combine_users(row, delta):
+    row.count += delta['count']
+    row.user_name = delta['user_name'] or row.user_name
+
+
+def _combine_locations(row, delta):
+    row.count += delta['count']
+
+
+def current_watermark():
+    """The rollup watermark, or None before anything has been rolled up."""
+    return RollupWatermark.objects.filter(name=WATERMARK).first()
+
+
+def bump_watermark(last_event_at=None, rebuilt=False):
+    """
+    Record new rolled-up events. The version only changes when they open a new
+    hour bucket or the rollups were rebuilt, so caches keyed on it survive the
+    batches that keep adding to the current hour.
+    """
+    watermark, _ = RollupWatermark.objects.get_or_create(name=WATERMARK)
+    opened = last_event_at is not None and (
+        watermark.last_event_at is None or floor_hour(last_event_at) > floor_hour(watermark.last_event_at))
+    if rebuilt or opened:
+        watermark.version += 1
+    watermark.last_event_at = _merge_max(watermark.last_event_at, last_event_at)
+    watermark.updated_at = timezone.now()
+    watermark.save()
+
+
+def fold_events(objs):
+    """Writer listener: add a batch of new BotAnalytics rows to the command and user rollups."""
+    commands, users, sketches = {}, {}, {}
+    for obj in objs:
+        # Set on the event too, so the stored row and rebuild_rollups() use the same key
+        obj.command = obj.command or UNKNOWN_COMMAND
+        latency = obj.response_time
+        for period, bucket in _buckets(obj.timestamp):
+            key = (period, bucket, obj.command)
+            delta = commands.setdefault(key, {
+                'count': 0, 'latency_count': 0, 'latency_sum': 0.0,
+                'min_response_time': None, 'max_response_time': None, 'stages': {},
+            })
+            delta['count'] += 1
+            _add_stages(delta['stages'], obj.stages)
+            if latency is not None:
+                delta['latency_count'] += 1
+                delta['latency_sum'] += latency
+                delta['min_response_time'] = _merge_min(delta['min_response_time'], latency)
+                delta['max_response_time'] = _merge_max(delta['max_response_time'], latency)
+                sketches.setdefault(key, LatencySketch()).add(latency)
+
+            user = users.setdefault((period, bucket, obj.user_id), {'count': 0, 'user_name': None})
+            user['count'] += 1
+            user['user_name'] = obj.user_name or user['user_name']
+
+    for key, delta in commands.items():
+        delta['sketch'] = sketches[key].to_dict() if key in sketches else {}
+    _fold(CommandRollup, ('period', 'bucket', 'command'), commands, _combine_commands,
+          ['count', 'latency_count', 'latency_sum', 'min_response_time', 'max_response_time', 'sketch', 'stages'])
+    _fold(ActiveUserRollup, ('period', 'bucket', 'user_id'), users, _combine_users, ['count', 'user_name'])
+    bump_watermark(max(obj.timestamp for obj in objs))
+
+
+def fold_picks(objs):
+    """Writer listener: add a batch of new LocationsAnalytics rows to the location rollups."""
+    picks = {}
+    for obj in objs:
+        for period, bucket in _buckets(obj.timestamp):
+            key = (period, bucket, obj.device_province or '', obj.device_name or '')
+            picks.setdefault(key, {'count': 0})['count'] += 1
+
+    _fold(LocationRollup, ('period', 'bucket', 'device_province', 'device_name'), picks, _combine_locations,
+          ['count'])
+    bump_watermark(max(obj.timestamp for obj in objs))
+
+
+analytics_writer.add_listener(BotAnalytics, fold_events)
+analytics_writer.add_listener(LocationsAnalytics, fold_picks)
+
+
+def rebuild_start(since=None):
+    """
+    The day rebuild_rollups(since) really starts from: never before the first
+    whole day whose raw events are all still in the database, because the
+    rollups are the only record left of archived events.
+    """
+    cutoff = archive.archived_before()
+    if cutoff is None:
+        return since
+    first_day = floor_day(cutoff)
+    if first_day < cutoff:
+        first_day = floor_day(first_day + timedelta(days=1, hours=1))
+    if since is None or floor_day(since) < first_day:
+        return first_day
+    return since
+
+
+def rebuild_rollups(since=None, chunk_size=2000):
+    """
+    Recompute the rollups from the raw events, for every bucket from the day
+    containing `since` (or for all history), but never for days that were
+    archived (see rebuild_start). Returns the number of rollup rows written.
+    """
+    requested, since = since, rebuild_start(since)
+    if since is not requested:
+        logger.warning(f"Events before {since:%Y-%m-%d} are archived; keeping the rollups before that day")
+    events = BotAnalytics.objects.all()
+    picks = LocationsAnalytics.objects.all()
+    rollups = [CommandRollup.objects.all(), ActiveUserRollup.objects.all(), LocationRollup.objects.all()]
+    if since is not None:
+        since = floor_day(since)
+        events = events.filter(timestamp__gte=since)
+        picks = picks.filter(timestamp__gte=since)
+        rollups = [rollup.filter(bucket__gte=since) for rollup in rollups]
+
+    written = 0
+    with transaction.atomic():
+        for rollup in rollups:
+            rollup.delete()
+
+        # Quantile sketches and stage totals need every event, so they are built in one pass
+        sketches, stages = {}, {}
+        latencies = (
+            events.filter(Q(response_time__isnull=False) | Q(stages__isnull=False))
+            .values_list('timestamp', 'command', 'response_time', 'stages')
+        )
+        for timestamp, command, latency, breakdown in latencies.iterator(chunk_size=chunk_size):
+            for period, bucket in _buckets(timestamp):
+                key = (period, bucket, command)
+                if latency is not None:
+                    sketches.setdefault(key, LatencySketch()).add(latency)
+                if breakdown:
+                    _add_stages(stages.setdefault(key, {}), breakdown)
+
+        for period, trunc in ((HOUR, TruncHour), (DAY, TruncDay)):
+            command_rows = (
+                events.annotate(bucket=trunc('timestamp')).values('bucket', 'command')
+                .annotate(count=Count('id'), latency_count=Count('response_time'), latency_sum=Sum('response_time'),
+                          min_response_time=Min('response_time'), max_response_time=Max('response_time'))
+                .order_by()
+            )
+            written += _bulk_insert(
+                CommandRollup, period, command_rows, chunk_size,
+                lambda row, period=period: {
+                    **row, 'latency_sum': row['latency_sum'] or 0.0,
+                    'sketch': _sketch_dict(sketches.get((period, row['bucket'], row['command']))),
+                    'stages': stages.get((period, row['bucket'], row['command']), {}),
+                },
+            )
+
+            user_rows = (
+                events.annotate(bucket=trunc('timestamp')).values('bucket', 'user_id')
+                .annotate(count=Count('id'), user_name=Max('user_name'))
+                .order_by()
+            )
+            written += _bulk_insert(ActiveUserRollup, period, user_rows, chunk_size)
+
+            location_rows = (
+                picks.annotate(bucket=trunc('timestamp')).values('bucket', 'device_province', 'device_name')
+                .annotate(count=Count('id'))
+                .order_by()
+            )
+            written += _bulk_insert(LocationRollup, period, location_rows, chunk_size)
+
+        bump_watermark(events.aggregate(latest=Max('timestamp'))['latest'], rebuilt=True)
+    return written
+
+
+def _sketch_dict(sketch):
+    return sketch.to_dict() if sketch is not None else {}
+
+
+def _bulk_insert(model, period, rows, chunk_size, prepare=dict):
+    written = 0
+    batch = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        batch.append(model(period=period, **prepare(row)))
+        if len(batch) >= chunk_size:
+            model.objects.bulk_create(batch)
+            written += len(batch)
+            batch = []
+    model.objects.bulk_create(batch)
+    return written + len(batch)
+
+
+def rollup_filter(start=None, end=None):
+    """
+    Select the rollup rows covering [start, end]: daily rows for whole days
+    and hourly rows for the partial days at either end. Accuracy is one hour.
+    Naive datetimes are taken as local time.
+    """
+    if start is not None and timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if end is not None and timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    if end is not None and end >= timezone.now():
+        end = None  # Nothing is logged in the future, so today's daily row is complete
+    first_day = None
+    if start is not None:
+        first_day = floor_day(start)
+        if first_day < start:
+            first_day += timedelta(days=1)
+    last_day = floor_day(end) if end is not None else None
+
+    if first_day is not None and last_day is not None and first_day >= last_day:
+        return Q(period=HOUR, bucket__gte=floor_hour(start), bucket__lte=end)
+
+    days = Q(period=DAY)
+    if first_day is not None:
+        days &= Q(bucket__gte=first_day)
+    if last_day is not None:
+        days &= Q(bucket__lt=last_day)
+    query = days
+    if first_day is not None and first_day > start:
+        query |= Q(period=HOUR, bucket__gte=floor_hour(start), bucket__lt=first_day)
+    if last_day is not None:
+        query |= Q(period=HOUR, bucket__gte=last_day, bucket__lte=end)
+    return query
+
+
+def command_usage(start=None, end=None):
+    return list(
+        CommandRollup.objects.filter(rollup_filter(start, end)).values('command')
+        .annotate(total=Sum('count')).order_by('-total')
+    )
+
+
+def latency_summary(start=None, end=None):
+    summary = CommandRollup.objects.filter(rollup_filter(start, end)).aggregate(
+        commands=Sum('count'), latency_count=Sum('latency_count'), latency_sum=Sum('latency_sum'),
+        min_response_time=Min('min_response_time'), max_response_time=Max('max_response_time'),
+    )
+    summary['commands'] = summary['commands'] or 0
+    summary['mean_response_time'] = (
+        summary['latency_sum'] / summary['latency_count'] if summary['latency_count'] else None
+    )
+    return summary
+
+
+def latency_percentiles(start=None, end=None, quantiles=(0.5, 0.95, 0.99)):
+    """
+    Response time quantiles per command over the range, from the merged
+    sketches of its rollup rows: {command: {quantile: seconds}}.
+    """
+    merged = {}
+    rows = CommandRollup.objects.filter(rollup_filter(start, end)).values_list('command', 'sketch')
+    for command, sketch in rows:
+        merged.setdefault(command, LatencySketch()).merge(LatencySketch.from_dict(sketch))
+    return {command: {q: sketch.quantile(q) for q in quantiles} for command, sketch in merged.items()}
+
+
+def active_users(start=None, end=None):
+    return list(
+        ActiveUserRollup.objects.filter(rollup_filter(start, end)).values('user_id')
+        .annotate(user_name=Max('user_name')).order_by('user_id')
+    )
+
+
+def province_usage(start=None, end=None):
+    return list(
+        LocationRollup.objects.filter(rollup_filter(start, end)).values('device_province')
+        .annotate(count=Sum('count')).order_by('-count')
+    )
+
+
+def device_usage(province=None, start=None, end=None):
+    rows = LocationRollup.objects.filter(rollup_filter(start, end))
+    if province:
+        rows = rows.filter(device_province=province)
+    return list(rows.values('device_name').annotate(count=Sum('count')).order_by('-count'))
+
+
+def location_usage(province=None, start=None, end=None):
+    """
+    Province totals and, when `province` is given, its device totals, from one
+    grouped query over the location rollups.
+    """
+    rows = (
+        LocationRollup.objects.filter(rollup_filter(start, end))
+        .values('device_province', 'device_name').annotate(count=Sum('count'))
+    )
+    provinces, devices = {}, {}
+    for row in rows:
+        provinces[row['device_province']] = provinces.get(row['device_province'], 0) + row['count']
+        if province and row['device_province'] == province:
+            devices[row['device_name']] = devices.get(row['device_name'], 0) + row['count']
+    province_data = [{'device_province': name, 'count': count}
+                     for name, count in sorted(provinces.items(), key=lambda item: -item[1])]
+    device_data = [{'device_name': name, 'count': count}
+                   for name, count in sorted(devices.items(), key=lambda item: -item[1])]
+    return province_data, device_data
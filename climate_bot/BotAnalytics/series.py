@@ -0,0 +1,128 @@
+"""
+Time series for charts: counts grouped by hour, day, week or month in SQL,
+with empty buckets filled in and bucket boundaries in local time
+(TIME_ZONE, Asia/Yerevan). Results are {'labels': [...], 'counts': [...]},
+ready to hand to Chart.js.
+"""
+from datetime import timedelta
+
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .models import ActiveUserRollup, CommandRollup, LocationRollup
+
+UNITS = ('hour', 'day', 'week', 'month')
+LABEL_FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+MAX_BUCKETS = 5000
+
+
+def _local(moment):
+    """Naive local time, which bucket arithmetic is done in."""
+    if timezone.is_naive(moment):
+        return moment
+    return timezone.localtime(moment).replace(tzinfo=None)
+
+
+def floor_bucket(moment, unit):
+    local = _local(moment).replace(minute=0, second=0, microsecond=0)
+    if unit == 'hour':
+        return local
+    local = local.replace(hour=0)
+    if unit == 'week':
+        return local - timedelta(days=local.weekday())
+    if unit == 'month':
+        return local.replace(day=1)
+    return local
+
+
+def next_bucket(bucket, unit):
+    if unit == 'hour':
+        return bucket + timedelta(hours=1)
+    if unit == 'day':
+        return bucket + timedelta(days=1)
+    if unit == 'week':
+        return bucket + timedelta(days=7)
+    return (bucket.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def bucket_range(start, end, unit):
+    """Every local bucket start from the one containing `start` to the one containing `end`."""
+    if unit not in UNITS:
+        raise ValueError(f"Unknown unit: {unit}")
+    buckets = []
+    bucket, last = floor_bucket(start, unit), floor_bucket(end, unit)
+    while bucket <= last:
+        buckets.append(bucket)
+        if len(buckets) > MAX_BUCKETS:
+            raise ValueError(f"More than {MAX_BUCKETS} {unit} buckets requested")
+        bucket = next_bucket(bucket, unit)
+    return buckets
+
+
+def fill(rows, start, end, unit):
+    """Turn (bucket, value) rows into Chart.js arrays with a zero for every empty bucket."""
+    values = {}
+    for bucket, value in rows:
+        key = floor_bucket(bucket, unit)
+        values[key] = values.get(key, 0) + (value or 0)
+    buckets = bucket_range(start, end, unit)
+    return {
+        'labels': [bucket.strftime(LABEL_FORMATS[unit]) for bucket in buckets],
+        'counts': [values.get(bucket, 0) for bucket in buckets],
+    }
+
+
+def _aware(moment):
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+def series(queryset, field, unit, start, end, value=None):
+    """
+    Group `queryset` by `field` truncated to `unit`, counting rows unless
+    another aggregate `value` is given. Covers whole buckets, from the one
+    containing `start` to the one containing `end`.
+    """
+    first = _aware(floor_bucket(start, unit))
+    after = _aware(next_bucket(floor_bucket(end, unit), unit))
+    rows = (
+        queryset.filter(**{f"{field}__gte": first, f"{field}__lt": after})
+        .annotate(series_bucket=Trunc(field, unit))
+        .values('series_bucket')
+        .annotate(series_value=value or Count('pk'))
+        .order_by()
+        .values_list('series_bucket', 'series_value')
+    )
+    return fill(rows, start, end, unit)
+
+
+def rollup_series(metric, unit, start, end, province=None):
+    """
+    Series of 'commands', 'active_users' or 'picks' read from the rollup
+    tables: hourly rows for hours, daily rows for anything coarser.
+    """
+    period = 'hour' if unit == 'hour' else 'day'
+    if metric == 'commands':
+        rows, value = CommandRollup.objects.all(), Sum('count')
+    elif metric == 'active_users':
+        # Distinct users per bucket; a user active on several days counts once per week/month
+        rows, value = ActiveUserRollup.objects.all(), Count('user_id', distinct=True)
+    elif metric == 'picks':
+        rows, value = LocationRollup.objects.all(), Sum('count')
+        if province:
+            rows = rows.filter(device_province=province)
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+    return series(rows.filter(period=period), 'bucket', unit, start, end, value=value)
+
+
+def unit_for(start, end):
+    """A bucket size that gives a readable number of points for the range."""
+    span = end - start
+    if span <= timedelta(days=2):
+        return 'hour'
+    if span <= timedelta(days=92):
+        return 'day'
+    if span <= timedelta(days=2 * 366):
+        return 'week'
+    return 'month'
@@ -0,0 +1,72 @@
+"""
+Per-stage timing of a bot interaction. log_command_decorator opens a trace
+around the handler; code it calls marks its stages with `with span('fetch'):`
+(or @traced('render')). Each stage records its own time, excluding nested
+spans, so the stages of a trace add up to at most its response time. The
+breakdown is stored on the BotAnalytics row as {stage: seconds}.
+
+Traces live in a ContextVar, so concurrent handler threads never see each
+other's stages, and span() costs next to nothing when no trace is open.
+"""
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+_trace: ContextVar[Optional["_Trace"]] = ContextVar('analytics_trace', default=None)
+
+
+class _Trace:
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.child_time = [0.0]  # Time spent in nested spans, one entry per open span
+
+    def breakdown(self, precision: int = 4) -> Dict[str, float]:
+        return {name: round(seconds, precision) for name, seconds in self.stages.items()}
+
+
+@contextmanager
+def trace():
+    """Collect the spans run inside the block; yields the trace."""
+    current = _Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    current = _trace.get()
+    if current is None:
+        yield
+        return
+    current.child_time.append(0.0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        nested = current.child_time.pop()
+        current.child_time[-1] += elapsed
+        current.stages[name] = current.stages.get(name, 0.0) + elapsed - nested
+
+
+def traced(name: str):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bottleneck(stages: Optional[dict]):
+    """The slowest stage of a breakdown as (name, seconds), or None."""
+    if not stages:
+        return None
+    return max(stages.items(), key=lambda item: item[1])
@@ -1,3 +1,110 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db import OperationalError
 from django.test import TestCase
+from django.utils import timezone
+
+from users.models import TelegramUser
+from .models import ActiveUserRollup, BotAnalytics, CommandRollup, LocationRollup, LocationsAnalytics
+from .rollups import DAY, HOUR, UNKNOWN_COMMAND, current_watermark, floor_hour
+from .writer import analytics_writer
+from . import views  # noqa: F401 - registers the latency and user activity listeners on the writer
+
+
+def event(user_id='1', command='/start', response_time=0.2, timestamp=None, **fields):
+    return BotAnalytics(user_id=user_id, command=command, response_time=response_time,
+                        timestamp=timestamp or timezone.now(), **fields)
+
+
+def pick(device_id=7, timestamp=None):
+    return LocationsAnalytics(user_id='1', device_id=device_id, device_name='Yerevan',
+                              device_province='Yerevan', timestamp=timestamp or timezone.now())
+
+
+class AnalyticsWriterTest(TestCase):
+    # _write() is what the writer thread runs for each batch; calling it directly keeps the tests synchronous
+
+    def setUp(self):
+        self.stats = analytics_writer.stats()
+
+    def delta(self, outcome):
+        return analytics_writer.stats()[outcome] - self.stats[outcome]
+
+    def test_bad_record_only_loses_itself(self):
+        # device_id is NOT NULL, so this pick fails the insert
+        analytics_writer._write([event(), pick(device_id=None), pick()])
+
+        self.assertEqual(BotAnalytics.objects.count(), 1)
+        self.assertEqual(LocationsAnalytics.objects.count(), 1)
+        self.assertEqual(self.delta('written'), 2)
+        self.assertEqual(self.delta('failed'), 1)
+        # The failed record's rollup fold was rolled back with it
+        self.assertEqual(LocationRollup.objects.get(period=HOUR).count, 1)
+
+    def test_operational_error_retries_the_batch(self):
+        bulk_create = BotAnalytics.objects.bulk_create
+        calls = []
+
+        def locked_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(BotAnalytics.objects, 'bulk_create', side_effect=locked_once), \
+                mock.patch('BotAnalytics.writer.time.sleep'), \
+                mock.patch('BotAnalytics.writer.connection.close_if_unusable_or_obsolete'):
+            analytics_writer._write([event(), event(user_id='2')])
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(BotAnalytics.objects.count(), 2)
+        self.assertEqual(self.delta('written'), 2)
+        self.assertEqual(self.delta('failed'), 0)
+        # The first attempt's rollup fold was rolled back, so the events are counted once
+        self.assertEqual(CommandRollup.objects.get(period=HOUR).count, 2)
+
+    def test_upserts_are_written_before_listeners(self):
+        # The event is queued first, but update_user_activity must find the user its batch creates
+        analytics_writer._write([
+            event(user_id='42'),
+            TelegramUser(telegram_id=42, first_name='Ani', user_name='ani'),
+        ])
+
+        user = TelegramUser.objects.get(telegram_id=42)
+        self.assertEqual(user.command_count, 1)
+        self.assertIsNotNone(user.last_active_at)
+
+
+class RollupTest(TestCase):
+
+    def test_fold_events_adds_into_existing_rows(self):
+        now = timezone.now()
+        analytics_writer._write([event(response_time=0.5, timestamp=now), event(response_time=0.1, timestamp=now)])
+        analytics_writer._write([event(user_id='2', response_time=None, timestamp=now)])
+
+        for period in (HOUR, DAY):
+            rollup = CommandRollup.objects.get(period=period, command='/start')
+            self.assertEqual(rollup.count, 3)
+            self.assertEqual(rollup.latency_count, 2)
+            self.assertAlmostEqual(rollup.latency_sum, 0.6)
+            self.assertEqual(rollup.min_response_time, 0.1)
+            self.assertEqual(rollup.max_response_time, 0.5)
+        hour_users = ActiveUserRollup.objects.filter(period=HOUR, bucket=floor_hour(now))
+        self.assertEqual({row.user_id: row.count for row in hour_users}, {'1': 2, '2': 1})
+
+    def test_missing_command_is_folded_as_unknown(self):
+        analytics_writer._write([event(command=None), event(command='')])
+
+        self.assertEqual(set(BotAnalytics.objects.values_list('command', flat=True)), {UNKNOWN_COMMAND})
+        self.assertEqual(CommandRollup.objects.get(period=HOUR).command, UNKNOWN_COMMAND)
+        self.assertEqual(CommandRollup.objects.get(period=HOUR).count, 2)
 
-# Create your tests here.
+    def test_watermark_version_changes_with_the_hour(self):
+        now = floor_hour(timezone.now())
+        analytics_writer._write([event(timestamp=now)])
+        version = current_watermark().version
+        analytics_writer._write([event(timestamp=now + timedelta(minutes=5))])
+        self.assertEqual(current_watermark().version, version)
+        analytics_writer._write([event(timestamp=now + timedelta(hours=1))])
+        self.assertEqual(current_watermark().version, version + 1)
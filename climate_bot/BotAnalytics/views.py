@@ -1,58 +1,120 @@
+import functools
+import logging
 import time
-from django.db import models  # Import models for aggregation
+from django.db import close_old_connections
 from django.utils import timezone  # For accurate timestamping
-from .models import BotAnalytics,LocationsAnalytics
+from .models import BotAnalytics,LocationsAnalytics,UserLatencyStats
+from .writer import analytics_writer
+from . import rollups  # noqa: F401 - registers the rollup listeners on the writer
+from . import metrics, profiling, spans
+from users.models import TelegramUser
 from users.utils import save_telegram_user
 
+logger = logging.getLogger(__name__)
+
+
 def log_command_decorator(func):
+    @functools.wraps(func)
     def wrapper(message):
+        # Handlers are not requests, so CONN_MAX_AGE and health checks are applied here instead of by signals
+        close_old_connections()
         start_time = time.perf_counter()  # Start timing
-        try:
-            func(message)
-            success = True
-        except Exception as e:
-            success = False
+        with spans.trace() as trace:  # Stages marked with spans.span() inside the handler
+            try:
+                with profiling.handler_profile():  # Only while a cprofile run is collecting
+                    func(message)
+                success = True
+            except Exception as e:
+                success = False
         end_time = time.perf_counter()  # End timing
         latency = end_time - start_time
+        close_old_connections()
+        metrics.handler_latency.observe(latency, handler=func.__name__)
+        metrics.handler_calls.inc(handler=func.__name__, outcome='ok' if success else 'error')
 
-        # Save analytics data
-        # print(message.from_user)
-        
+        # Queue analytics data; the writer thread saves it in batches
         save_telegram_user(message.from_user)
-        BotAnalytics.objects.create(
-            user_id=message.from_user.id,
-            user_name=message.from_user.username,
-            command=message.text,
+        analytics_writer.submit(BotAnalytics(
+            user_id=str(message.from_user.id),
+            user_name=message.from_user.username or '',
+            command=message.text or f'<{message.content_type}>',  # Locations, photos, ... have no text
             success=success,
             response_time=latency,
-        )
+            stages=trace.breakdown() or None,
+            timestamp=timezone.now(),
+        ))
 
-        # Update min/max response times
-        analytics = BotAnalytics.objects.filter(user_id=message.from_user.id)
-        min_latency = analytics.aggregate(models.Min('response_time'))['response_time__min']
-        max_latency = analytics.aggregate(models.Max('response_time'))['response_time__max']
+    return wrapper
 
-        BotAnalytics.objects.filter(id=analytics.latest('timestamp').id).update(
-            min_response_time=min_latency,
-            max_response_time=max_latency,
-        )
 
-    return wrapper
+def update_latency_stats(objs):
+    """
+    Fold the batch into UserLatencyStats and stamp each new row with the
+    user's running min/max, reading one stats row per user instead of their
+    whole history.
+    """
+    stats = UserLatencyStats.objects.in_bulk({obj.user_id for obj in objs}, field_name='user_id')
+    sketches = {}
+    for obj in objs:
+        user_stats = stats.get(obj.user_id)
+        if user_stats is None:
+            user_stats = stats[obj.user_id] = UserLatencyStats(user_id=obj.user_id)
+        if obj.user_id not in sketches:
+            sketches[obj.user_id] = user_stats.get_sketch()
+        user_stats.add(obj.response_time, sketches[obj.user_id])
+        obj.min_response_time = user_stats.min_response_time
+        obj.max_response_time = user_stats.max_response_time
+
+    updated_at = timezone.now()
+    new_stats, changed_stats = [], []
+    for user_id, sketch in sketches.items():
+        user_stats = stats[user_id]
+        user_stats.sketch = sketch.to_dict()
+        user_stats.updated_at = updated_at
+        (changed_stats if user_stats.pk else new_stats).append(user_stats)
+    UserLatencyStats.objects.bulk_create(new_stats)
+    UserLatencyStats.objects.bulk_update(
+        changed_stats,
+        ['count', 'total_response_time', 'min_response_time', 'max_response_time', 'sketch', 'updated_at'],
+    )
+
 
+analytics_writer.add_listener(BotAnalytics, update_latency_stats)
+
+
+def update_user_activity(objs):
+    """Move each user's last_active_at and command_count forward for the batch."""
+    activity = {}
+    for obj in objs:
+        try:
+            telegram_id = int(obj.user_id)
+        except (TypeError, ValueError):
+            continue
+        last_active_at, count = activity.get(telegram_id, (None, 0))
+        if last_active_at is None or obj.timestamp > last_active_at:
+            last_active_at = obj.timestamp
+        activity[telegram_id] = (last_active_at, count + 1)
+
+    users = TelegramUser.objects.in_bulk(activity.keys(), field_name='telegram_id')
+    for telegram_id, user in users.items():
+        last_active_at, count = activity[telegram_id]
+        if user.last_active_at is None or last_active_at > user.last_active_at:
+            user.last_active_at = last_active_at
+        user.command_count += count
+    TelegramUser.objects.bulk_update(users.values(), ['last_active_at', 'command_count'])
+
+
+analytics_writer.add_listener(BotAnalytics, update_user_activity)
 
 
 def save_selected_device_to_db(user_id=None, context=None,device_id = None):
-    print(f"save_selected_device_to_db called with user_id={user_id} and context={context}")
     if user_id is not None and context is not None and device_id is not None:
-        try:
-            LocationsAnalytics.objects.create(
-                user_id=user_id,
-                device_id=context.get('device_id'),
-                device_name=context.get('selected_device'),
-                device_province=context.get('selected_country')
-            )
-            print("Device saved successfully!")
-        except Exception as e:
-            print(f"Failed to save device: {e}")
+        analytics_writer.submit(LocationsAnalytics(
+            user_id=user_id,
+            device_id=context.get('device_id'),
+            device_name=context.get('selected_device'),
+            device_province=context.get('selected_country'),
+            timestamp=timezone.now(),
+        ))
     else:
-        print("Missing user_id or context in save_selected_device_to_db")
\ No newline at end of file
+        logger.warning("Missing user_id or context in save_selected_device_to_db")
@@ -0,0 +1,292 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection, transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _Call:
+    """A write that is not a plain insert, run on the writer thread with the batch."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        self.func(*self.args, **self.kwargs)
+
+
+_STOP = object()
+
+
+class AnalyticsWriter:
+    """
+    Bounded in-memory queue of unsaved model instances, written by a
+    background thread with one bulk_create per model every `batch_size`
+    records or `flush_interval` seconds, whichever comes first. When the queue
+    is full new records are dropped and counted instead of blocking handlers.
+    Other writes can be queued with call(), so the bot process writes to the
+    database from this one thread.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.5,
+                 max_queue_size: int = 10000, max_retries: int = 3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._options: Dict[type, dict] = {}
+        self._listeners: Dict[type, List[Callable]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def register(self, model, unique_field: Optional[str] = None, **bulk_create_kwargs) -> None:
+        """
+        Set how a model is written. With `unique_field` only the newest record
+        per key is kept in a batch, which upserts need; upserts are written
+        before the batch's other models.
+        """
+        self._options[model] = {"unique_field": unique_field, "kwargs": bulk_create_kwargs}
+
+    def add_listener(self, model, callback: Callable[[list], None]) -> None:
+        """Call `callback(objs)` before each insert of `model`, in the same transaction."""
+        self._listeners[model].append(callback)
+
+    def submit(self, obj) -> bool:
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(obj)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning(f"Analytics queue full, {dropped} records dropped so far")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def call(self, func: Callable, *args, **kwargs) -> bool:
+        """Run `func(*args, **kwargs)` on the writer thread, in the transaction of the next batch."""
+        return self.submit(_Call(func, args, kwargs))
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "queue_depth": self._queue.qsize(),
+            }
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything submitted so far has been written."""
+        if not self._thread or not self._thread.is_alive():
+            return True
+        request = _FlushRequest()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def stop(self, timeout: float = 10) -> None:
+        """Drain the queue and stop the background thread."""
+        with self._lock:
+            thread = self._thread
+        if not thread or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.error(f"Analytics writer did not drain within {timeout}s, {self._queue.qsize()} records left")
+        else:
+            logger.info(f"Analytics writer stopped: {self.stats()}")
+
+    def _ensure_started(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="AnalyticsWriter", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._drain_into(batch)
+                self._flush(batch)
+                connection.close()  # The writer's connection persists (CONN_MAX_AGE) until it stops
+                return
+            if isinstance(item, _FlushRequest):
+                self._flush(batch)
+                batch, deadline = [], None
+                item.done.set()
+                continue
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch, deadline = [], None
+
+    def _flush(self, batch: list) -> None:
+        # No request signals on this thread: recycle a connection past CONN_MAX_AGE or broken before each batch
+        if batch:
+            close_old_connections()
+        self._write(batch)
+
+    def _drain_into(self, batch: list) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, _FlushRequest):
+                item.done.set()
+            elif item is not _STOP:
+                batch.append(item)
+
+    def _group(self, batch: list) -> Dict[type, list]:
+        groups: Dict[type, list] = {}
+        for obj in batch:
+            if not isinstance(obj, _Call):
+                groups.setdefault(type(obj), []).append(obj)
+        upserts = {}
+        for model, objs in groups.items():
+            unique_field = self._options.get(model, {}).get("unique_field")
+            if unique_field:
+                latest = {getattr(obj, unique_field): obj for obj in objs}
+                upserts[model] = list(latest.values())
+        # Upserts go first, so listeners of the other models find the rows they create
+        return {**upserts, **{model: objs for model, objs in groups.items() if model not in upserts}}
+
+    def _write(self, batch: list) -> None:
+        if not batch:
+            return
+        groups = self._group(batch)
+        calls = [item for item in batch if isinstance(item, _Call)]
+        isolate = False
+        for attempt in range(self.max_retries):
+            failed = []
+            try:
+                with transaction.atomic():
+                    for model, objs in groups.items():
+                        if isolate:
+                            failed += self._insert_isolated(model, objs)
+                        else:
+                            self._insert(model, objs)
+                    for call in calls:
+                        self._run_call(call)
+                with self._lock:
+                    self.written += len(batch) - len(failed)
+                    self.failed += len(failed)
+                return
+            except OperationalError as e:
+                logger.warning(f"Analytics flush failed (attempt {attempt + 1}/{self.max_retries}): {e}")
+                connection.close_if_unusable_or_obsolete()
+                time.sleep(min(2, 0.1 * 2 ** attempt))
+            except Exception as e:
+                if isolate:
+                    logger.error(f"Analytics flush failed, discarding {len(batch)} records: {e}")
+                    break
+                # Write the batch again a model, then a record, at a time so one bad record only loses itself
+                logger.error(f"Analytics flush failed, writing the {len(batch)} records one by one: {e}")
+                isolate = True
+            for objs in groups.values():
+                self._reset(objs)
+        with self._lock:
+            self.failed += len(batch)
+
+    def _insert(self, model, objs: list) -> None:
+        for listener in self._listeners.get(model, []):
+            listener(objs)
+        model.objects.bulk_create(objs, **self._options.get(model, {}).get("kwargs", {}))
+
+    def _insert_isolated(self, model, objs: list) -> list:
+        """Insert `objs` in a savepoint, or each one in its own if that fails; returns the records that failed."""
+        try:
+            with transaction.atomic():
+                self._insert(model, objs)
+            return []
+        except OperationalError:
+            raise
+        except Exception:
+            self._reset(objs)
+        failed = []
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    self._insert(model, [obj])
+            except OperationalError:
+                raise
+            except Exception as e:
+                logger.error(f"Analytics record {model.__name__} discarded: {e}")
+                self._reset([obj])
+                failed.append(obj)
+        return failed
+
+    @staticmethod
+    def _reset(objs: list) -> None:
+        # bulk_create may have set primary keys before the transaction rolled back
+        for obj in objs:
+            obj.pk = None
+            obj._state.adding = True
+
+    def _run_call(self, call: _Call) -> None:
+        # A failing call only loses its own savepoint; a locked database retries the whole batch
+        try:
+            with transaction.atomic():
+                call.run()
+        except OperationalError:
+            raise
+        except Exception as e:
+            logger.error(f"Queued write {getattr(call.func, '__name__', call.func)} failed: {e}")
+            with self._lock:
+                self.failed += 1
+
+
+analytics_writer = AnalyticsWriter(
+    batch_size=getattr(settings, "ANALYTICS_WRITER_BATCH_SIZE", 200),
+    flush_interval=getattr(settings, "ANALYTICS_WRITER_FLUSH_INTERVAL", 0.5),
+    max_queue_size=getattr(settings, "ANALYTICS_WRITER_MAX_QUEUE", 10000),
+)
+atexit.register(analytics_writer.stop)
+
+metrics.queue_depth.set_function(analytics_writer.queue_depth, queue='analytics_writer')
+for _outcome in ('submitted', 'written', 'dropped', 'failed'):
+    metrics.writer_records.set_function(lambda outcome=_outcome: analytics_writer.stats()[outcome], outcome=_outcome)
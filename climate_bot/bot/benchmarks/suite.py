@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import platform
+import statistics
+import timeit
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from bot.loadtest.fake_servers import FakeClimateNetServer, make_devices
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_SIZES = (10, 100, 1000)
+# compare(): how many interquartile ranges of slack a median gets, and the
+# smallest slowdown in microseconds that can count as a regression
+NOISE_FACTOR = 2
+MIN_DELTA_US = 1.0
+REGIONS = 11
+
+# A typical /latest/ payload after fetch_latest_measurement has normalised it
+MEASUREMENT = {
+    "timestamp": "2025-03-01 12:15:00",
+    "uv": 6,
+    "lux": 24150.5,
+    "temperature": 17.8,
+    "pressure": 912.4,
+    "humidity": 41.2,
+    "pm1": 9,
+    "pm2_5": 14,
+    "pm10": 31,
+    "wind_speed": 3.4,
+    "rain": 0.0,
+    "wind_direction": "NW",
+}
+
+
+def measure(fn: Callable, repeat: int = 15) -> dict:
+    """Median time per call over `repeat` runs in microseconds, with the interquartile range as a fraction of it."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    runs = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    median = statistics.median(runs)
+    q1, _, q3 = statistics.quantiles(runs, n=4)
+    return {"us": median, "spread": (q3 - q1) / median if median else 0.0}
+
+
+def _fresh_measurement(offset_min: int) -> dict:
+    measurement = dict(MEASUREMENT)
+    stamp = datetime.now(timezone.utc) - timedelta(minutes=offset_min)
+    measurement["timestamp"] = stamp.strftime("%Y-%m-%d %H:%M:%S")
+    return measurement
+
+
+def _handler_filters(views) -> Dict[str, Callable]:
+    filters = {}
+    for handler in views.bot.message_handlers:
+        func = handler["filters"].get("func")
+        if func is not None:
+            filters[handler["function"].__name__] = func
+    return filters
+
+
+def size_independent_benchmarks(views) -> Dict[str, Callable]:
+    uv_values = [None, 1, 4, 7, 9, 12]
+    pm_values = [None, 5, 40, 120, 400, 900]
+
+    def uv_all():
+        for uv in uv_values:
+            views.uv_index(uv)
+            views.uv_index(uv, with_emoji=False)
+
+    def pm_all():
+        for pm in pm_values:
+            for pollutant in ("PM1.0", "PM2.5", "PM10"):
+                views.pm_level(pm, pollutant)
+
+    return {"uv_index": uv_all, "pm_level": pm_all}
+
+
+def sized_benchmarks(views, devices: List[dict]) -> Dict[str, Callable]:
+    issue_device = next((d["name"] for d in devices if d["issues"]), devices[0]["name"])
+    last_device = devices[-1]["name"]
+    region = devices[-1]["parent_name"]
+    compared = [{"name": d["name"], "id": d["generated_id"]} for d in devices[-5:]]
+    measurements = [_fresh_measurement(i * 10) for i in range(len(compared))]
+    filters = _handler_filters(views)
+    messages = {
+        "region": SimpleNamespace(text=region),
+        "device": SimpleNamespace(text=last_device),
+        "text": SimpleNamespace(text="hello"),
+    }
+
+    benchmarks = {
+        "get_formatted_data": lambda: views.get_formatted_data(MEASUREMENT, issue_device),
+        "get_comparison_formatted_data": lambda: views.get_comparison_formatted_data(compared, measurements),
+        "format_device_issues": lambda: views.format_device_issues(issue_device),
+        "format_device_issues_html": lambda: views.format_device_issues(issue_device, html_format=True),
+    }
+    for name, func in filters.items():
+        for kind, message in messages.items():
+            benchmarks[f"filter_{name}_{kind}"] = lambda func=func, message=message: func(message)
+    return benchmarks
+
+
+def run_suite(sizes=DEFAULT_SIZES, repeat: int = 15, name_filter: Optional[str] = None,
+              retry: Optional[Callable[[str, dict], bool]] = None, retries: int = 0,
+              progress: Optional[Callable[[str, dict], None]] = None) -> Dict[str, dict]:
+    """
+    Import bot.views against a local fake device API and time every hot path.
+    A benchmark for which retry(name, result) is true is timed again, up to
+    `retries` more times, and keeps its fastest median.
+    """
+    server = FakeClimateNetServer(make_devices(REGIONS, regions=REGIONS))
+    server.start()
+    try:
+        os.environ["CLIMATENET_API_URL"] = server.api_url
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:benchmark")
+        from bot import views  # imported late: the module fetches the device list on import
+        logging.getLogger().setLevel(logging.WARNING)
+        views.device_manager.stop_auto_update()
+
+        results = {}
+
+        def record(name, fn):
+            if name_filter and name_filter not in name:
+                return
+            results[name] = measure(fn, repeat=repeat)
+            for _ in range(retries if retry else 0):
+                if not retry(name, results[name]):
+                    break
+                again = measure(fn, repeat=repeat)
+                if again["us"] < results[name]["us"]:
+                    results[name] = again
+            if progress:
+                progress(name, results[name])
+
+        for name, fn in size_independent_benchmarks(views).items():
+            record(name, fn)
+        for size in sizes:
+            devices = make_devices(size, regions=REGIONS)
+            server.devices = devices
+            views.device_manager.force_update()
+            for name, fn in sized_benchmarks(views, devices).items():
+                record(f"{name}[{size}]", fn)
+        return results
+    finally:
+        server.stop()
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Dict[str, dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        results = json.load(f)["results"]
+    # Baselines written before the spread was recorded hold a bare number
+    return {name: value if isinstance(value, dict) else {"us": value, "spread": 0.0}
+            for name, value in results.items()}
+
+
+def save_baseline(results: Dict[str, dict], path: str = BASELINE_PATH) -> None:
+    payload = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "unit": "us/call (median), spread = IQR / median",
+        },
+        "results": {name: {"us": round(value["us"], 3), "spread": round(value["spread"], 3)}
+                    for name, value in sorted(results.items())},
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+        f.write("\n")
+
+
+def allowed_slowdown(current: dict, base: dict, threshold: float) -> float:
+    """Slowdown ratio above which a benchmark counts as regressed: the threshold widened by the noise of both runs."""
+    return 1 + threshold + NOISE_FACTOR * (current["spread"] + base["spread"])
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float,
+            min_delta: float = MIN_DELTA_US) -> List[dict]:
+    """
+    A benchmark regresses when its median is slower than the baseline by more
+    than allowed_slowdown() and by at least `min_delta` microseconds; below that
+    the timer and scheduler jitter of sub-microsecond paths dominates.
+    """
+    rows = []
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        ratio = current["us"] / base["us"] if base and base["us"] else None
+        if ratio is None:
+            status = "new"
+        elif ratio > allowed_slowdown(current, base, threshold) and current["us"] - base["us"] >= min_delta:
+            status = "REGRESSION"
+        elif ratio < 1 - threshold:
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append({"name": name, "baseline": base["us"] if base else None, "current": current["us"],
+                     "ratio": ratio, "status": status})
+    return rows
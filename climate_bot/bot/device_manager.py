@@ -1,24 +1,128 @@
+import hashlib
 import requests
 import threading
 import time
 import logging
 from collections import defaultdict
-from typing import Dict, Set, Tuple, Optional
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional, Set, Tuple
+
+from BotAnalytics import metrics
 
 logger = logging.getLogger(__name__)
 
 
-class DeviceManager:  
+class DeviceChanges:
+    """
+    What one refresh changed. Devices are named by their new name, except in
+    `removed`; a device that kept its generated_id under another name is
+    renamed, not removed and added. `regions` are the regions whose device
+    lists changed (keyboards listing them are stale).
+    """
+
+    def __init__(self, added=(), removed=(), renamed=None, moved=None, issues=None, regions=()):
+        self.added = set(added)
+        self.removed = set(removed)
+        self.renamed = dict(renamed or {})  # old name -> new name
+        self.moved = dict(moved or {})  # name -> (old region, new region)
+        self.issues = dict(issues or {})  # name -> (old issues, new issues)
+        self.regions = set(regions)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.renamed or self.moved or self.issues)
+
+    @property
+    def devices(self) -> Set[str]:
+        """Every device name affected, old and new."""
+        return (self.added | self.removed | set(self.renamed) | set(self.renamed.values())
+                | set(self.moved) | set(self.issues))
+
+    def __str__(self) -> str:
+        return (f"{len(self.added)} added, {len(self.removed)} removed, {len(self.renamed)} renamed, "
+                f"{len(self.moved)} moved, {len(self.issues)} with changed issues")
+
+
+class DeviceSnapshot:
+    """
+    The device list as one refresh read it. Never changed once built: a
+    refresh builds a new snapshot and swaps it in, so readers can hold one
+    and look things up without locks or copies. Every lookup is a dict hit.
+
+    locations       region -> tuple of device names, in API order
+    device_ids      device name -> generated_id (devices without one are left out)
+    device_regions  device name -> region
+    device_issues   device name -> tuple of issues (devices with issues only)
+    """
+
+    __slots__ = ('version', 'created_at', 'locations', 'device_ids', 'device_regions',
+                 'device_issues', 'devices_with_issues')
+
+    def __init__(self, version: int = 0, locations=None, device_ids=None, device_regions=None, device_issues=None):
+        self.version = version
+        self.created_at = time.time()
+        self.locations = MappingProxyType({region: tuple(names) for region, names in (locations or {}).items()})
+        self.device_ids = MappingProxyType(dict(device_ids or {}))
+        self.device_regions = MappingProxyType(dict(device_regions or {}))
+        self.device_issues = MappingProxyType({name: tuple(issues) for name, issues in (device_issues or {}).items()})
+        self.devices_with_issues = frozenset(self.device_issues)
+
+    def __len__(self) -> int:
+        return len(self.device_regions)
+
+    def __contains__(self, device_name) -> bool:
+        return device_name in self.device_regions
+
+
+def diff_devices(old: DeviceSnapshot, new: DeviceSnapshot) -> DeviceChanges:
+    old_by_id = {device_id: name for name, device_id in old.device_ids.items()}
+    renamed = {}
+    for name, device_id in new.device_ids.items():
+        old_name = old_by_id.get(device_id)
+        if old_name and old_name != name and old_name not in new:
+            renamed[old_name] = name
+    previous = {new_name: old_name for old_name, new_name in renamed.items()}
+
+    added = {name for name in new.device_regions if name not in old and name not in previous}
+    removed = {name for name in old.device_regions if name not in new and name not in renamed}
+    moved, issues = {}, {}
+    regions = {new.device_regions[name] for name in added} | {old.device_regions[name] for name in removed}
+    for name, region in new.device_regions.items():
+        before = previous.get(name, name)
+        if before not in old:
+            continue
+        if old.device_regions[before] != region:
+            moved[name] = (old.device_regions[before], region)
+            regions |= {old.device_regions[before], region}
+        elif name in previous:
+            regions.add(region)  # Same region, new button label
+        old_issues, new_issues = old.device_issues.get(before, ()), new.device_issues.get(name, ())
+        if old_issues != new_issues:
+            issues[name] = (old_issues, new_issues)
+    return DeviceChanges(added, removed, renamed, moved, issues, regions)
+
+
+class DeviceManager:
+    """
+    Device list of the ClimateNet API, refreshed every `refresh_interval`
+    seconds. Refreshes are conditional (If-None-Match / If-Modified-Since), so
+    an unchanged list costs a 304 and nothing is rebuilt. When the list did
+    change, callbacks registered with subscribe() get the DeviceChanges.
+
+    Readers get the current DeviceSnapshot from snapshot() (or the getters,
+    which read from it) without taking a lock; a refresh replaces it whole.
+    """
+
     def __init__(self, api_url: str, refresh_interval: int = 86400, max_retries: int = 3):
         self.api_url = api_url
         self.refresh_interval = refresh_interval
         self.max_retries = max_retries
         
-        self._lock = threading.RLock()
-        self._locations = defaultdict(list)
-        self._device_ids = {}
-        self._device_issues = {}
-        self._devices_with_issues = set()
+        self._lock = threading.RLock()  # For refreshes and subscribers; readers never take it
+        self._snapshot = DeviceSnapshot()
+        self._etag = None
+        self._last_modified = None
+        self._content_hash = None
+        self._subscribers = []
         
         self._update_thread = None
         self._stop_event = threading.Event()
@@ -46,30 +150,69 @@ class DeviceManager:
             
     def force_update(self) -> bool:
         return self._fetch_device_data()
-        
-    def get_locations(self) -> Dict[str, list]:
+
+    def subscribe(self, callback: Callable[[DeviceChanges], None]) -> Callable[[], None]:
+        """
+        Call `callback(changes)` after every refresh that changed the device
+        list, from the refreshing thread. Returns a function that unsubscribes.
+        """
         with self._lock:
-            return dict(self._locations)
-            
-    def get_device_ids(self) -> Dict[str, str]:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def _notify(self, changes: DeviceChanges) -> None:
         with self._lock:
-            return self._device_ids.copy()
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(changes)
+            except Exception as e:
+                logger.error(f"Device change subscriber {callback!r} failed: {e}")
+        
+    def snapshot(self) -> DeviceSnapshot:
+        """The current device list; read several things from one snapshot to see them consistent."""
+        return self._snapshot
+
+    def get_locations(self) -> Mapping[str, tuple]:
+        return self._snapshot.locations
             
-    def get_device_issues(self) -> Dict[str, list]:
-        with self._lock:
-            return self._device_issues.copy()
+    def get_device_ids(self) -> Mapping[str, str]:
+        return self._snapshot.device_ids
             
-    def get_devices_with_issues(self) -> Set[str]:
-        with self._lock:
-            return self._devices_with_issues.copy()
+    def get_device_issues(self) -> Mapping[str, tuple]:
+        return self._snapshot.device_issues
+            
+    def get_devices_with_issues(self) -> frozenset:
+        return self._snapshot.devices_with_issues
             
     def get_device_id(self, device_name: str) -> Optional[str]:
-        with self._lock:
-            return self._device_ids.get(device_name)
+        return self._snapshot.device_ids.get(device_name)
+
+    def get_device_region(self, device_name: str) -> Optional[str]:
+        return self._snapshot.device_regions.get(device_name)
             
+    def has_device(self, device_name: str) -> bool:
+        return device_name in self._snapshot
+
     def has_device_issues(self, device_name: str) -> bool:
+        return device_name in self._snapshot.devices_with_issues
+
+    def status(self) -> dict:
+        snapshot = self._snapshot
         with self._lock:
-            return device_name in self._devices_with_issues
+            return {
+                "last_update": self._last_update,
+                "update_count": self._update_count,
+                "consecutive_failures": self._consecutive_failures,
+                "version": snapshot.version,
+                "devices": len(snapshot.device_ids),
+                "devices_with_issues": len(snapshot.devices_with_issues),
+            }
 
     def _update_loop(self) -> None:
         #main update loop
@@ -88,8 +231,28 @@ class DeviceManager:
             try:
                 logger.debug(f"Fetching device data from {self.api_url} (attempt {attempt + 1})")
                 
-                response = requests.get(self.api_url, timeout=30)
-                response.raise_for_status()
+                with self._lock:
+                    headers = {}
+                    if self._etag:
+                        headers["If-None-Match"] = self._etag
+                    if self._last_modified:
+                        headers["If-Modified-Since"] = self._last_modified
+                try:
+                    with metrics.upstream_latency.time(service="climatenet", endpoint="device_list"):
+                        response = requests.get(self.api_url, headers=headers, timeout=30)
+                    response.raise_for_status()
+                except requests.RequestException:
+                    metrics.upstream_errors.inc(service="climatenet", endpoint="device_list")
+                    raise
+
+                content_hash = hashlib.sha1(response.content).hexdigest()
+                if response.status_code == 304 or content_hash == self._content_hash:
+                    with self._lock:
+                        self._last_update = time.time()
+                        self._update_count += 1
+                        self._consecutive_failures = 0
+                    logger.debug("Device list unchanged")
+                    return True
                 devices = response.json()
                 
                 if not isinstance(devices, list):
@@ -98,8 +261,8 @@ class DeviceManager:
                     
                 new_locations = defaultdict(list)
                 new_device_ids = {}
+                new_device_regions = {}
                 new_device_issues = {}
-                new_devices_with_issues = set()
                 
                 for device in devices:
                     if not isinstance(device, dict):
@@ -117,34 +280,30 @@ class DeviceManager:
                     
                     parent_name = device.get("parent_name", "Unknown")
                     new_locations[parent_name].append(device_name)
+                    new_device_regions[device_name] = parent_name
                     
                     issues = device.get("issues", [])
                     if issues:
                         new_device_issues[device_name] = issues
-                        new_devices_with_issues.add(device_name)
                 
                 with self._lock:
-                    old_device_count = len(self._device_ids)
-                    old_issues_count = len(self._devices_with_issues)
-                    
-                    self._locations = new_locations
-                    self._device_ids = new_device_ids
-                    self._device_issues = new_device_issues
-                    self._devices_with_issues = new_devices_with_issues
+                    old = self._snapshot
+                    snapshot = DeviceSnapshot(old.version + 1, new_locations, new_device_ids,
+                                              new_device_regions, new_device_issues)
+                    changes = diff_devices(old, snapshot)
+                    self._snapshot = snapshot  # One reference swap; readers see the old or the new list
+                    self._etag = response.headers.get("ETag")
+                    self._last_modified = response.headers.get("Last-Modified")
+                    self._content_hash = content_hash
                     self._last_update = time.time()
                     self._update_count += 1
                     self._consecutive_failures = 0
-                    
-                    new_device_count = len(self._device_ids)
-                    new_issues_count = len(self._devices_with_issues)
                 
-                if old_device_count != new_device_count:
-                    logger.info(f"Device count changed: {old_device_count} -> {new_device_count}")
-                    
-                if old_issues_count != new_issues_count:
-                    logger.info(f"Devices with issues changed: {old_issues_count} -> {new_issues_count}")
+                if changes:
+                    logger.info(f"Device list changed: {changes}")
+                    self._notify(changes)
                 
-                logger.debug(f"Successfully loaded {len(new_device_ids)} devices")
+                logger.debug(f"Successfully loaded {len(snapshot)} devices")
                 return True
                 
             except requests.RequestException as e:
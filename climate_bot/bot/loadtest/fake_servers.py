@@ -0,0 +1,257 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def make_devices(count: int, regions: int = 5, issue_rate: float = 0.1, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+    devices = []
+    for i in range(count):
+        issues = []
+        if rng.random() < issue_rate:
+            issues = [{"name": "Sensor offline"}]
+        devices.append({
+            "generated_id": f"{i + 1:06d}",
+            "name": f"Device {i + 1}",
+            "parent_name": f"Region {i % regions + 1}",
+            "issues": issues,
+        })
+    return devices
+
+
+class _FakeServer:
+    """Threaded local HTTP server with injectable latency and error rate."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rng = random.Random()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+        self.request_count = 0
+        self.error_count = 0
+
+    @property
+    def address(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"{type(self).__name__} listening on {self.address}")
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _delay_and_fail(self) -> bool:
+        self.request_count += 1
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.error_count += 1
+            return True
+        return False
+
+    def handle(self, method: str, path: str, params: Dict[str, str]):
+        raise NotImplementedError
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self, method):
+                parsed = urlparse(self.path)
+                params = dict(parse_qsl(parsed.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode("utf-8")))
+                status, payload = server.handle(method, parsed.path, params)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeClimateNetServer(_FakeServer):
+    """Serves the `device_inner` list and latest-measurement endpoints."""
+
+    _latest_re = re.compile(r"^/device_inner/(?P<device_id>[^/]+)/latest/$")
+
+    def __init__(self, devices: List[dict], **kwargs):
+        super().__init__(**kwargs)
+        self.devices = devices
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.address}/device_inner/"
+
+    def handle(self, method, path, params):
+        if self._delay_and_fail():
+            return 500, {"detail": "Injected error"}
+        if path == "/device_inner/list/":
+            return 200, self.devices
+        match = self._latest_re.match(path)
+        if not match:
+            return 404, {"detail": "Not found"}
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        return 200, [{
+            "time": now,
+            "uv": self._rng.randint(0, 11),
+            "lux": round(self._rng.uniform(0, 50000), 1),
+            "temperature": round(self._rng.uniform(-10, 40), 1),
+            "pressure": round(self._rng.uniform(850, 1030), 1),
+            "humidity": round(self._rng.uniform(10, 100), 1),
+            "pm1": self._rng.randint(0, 120),
+            "pm2_5": self._rng.randint(0, 200),
+            "pm10": self._rng.randint(0, 300),
+            "speed": round(self._rng.uniform(0, 20), 1),
+            "rain": round(self._rng.uniform(0, 5), 1),
+            "direction": self._rng.choice(["N", "NE", "E", "SE", "S", "SW", "W", "NW"]),
+        }]
+
+
+class FakeTelegramServer(_FakeServer):
+    """
+    Minimal Bot API: getUpdates long polling fed by `push_message`, and
+    sendMessage/sendPhoto/getChat answered locally. Every outgoing bot call is
+    passed to `on_reply(chat_id, method, params, received_at)`.
+    """
+
+    _method_re = re.compile(r"^/bot(?P<token>[^/]+)/(?P<method>\w+)$")
+
+    def __init__(self, on_reply: Optional[Callable] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.on_reply = on_reply
+        self._updates = deque()
+        self._cond = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._closed = False
+
+    @property
+    def api_url(self) -> str:
+        return self.address + "/bot{0}/{1}"
+
+    def stop(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        super().stop()
+
+    def push_message(self, chat_id: int, text: str, first_name: str = "Load", username: Optional[str] = None) -> int:
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            self._updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {
+                        "id": chat_id,
+                        "is_bot": False,
+                        "first_name": first_name,
+                        "username": username or f"user{chat_id}",
+                    },
+                    "text": text,
+                },
+            })
+            self._cond.notify_all()
+        return update_id
+
+    def pending_updates(self) -> int:
+        with self._cond:
+            return len(self._updates)
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._updates and self._updates[0]["update_id"] < offset:
+                    self._updates.popleft()
+                if self._updates or self._closed:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [u for _, u in zip(range(limit), self._updates)]
+
+    def _message(self, chat_id, extra):
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "LoadTestBot"},
+        }
+        message.update(extra)
+        return message
+
+    def handle(self, method, path, params):
+        match = self._method_re.match(path)
+        if not match:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        api_method = match.group("method")
+        if api_method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if api_method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}}
+
+        received_at = time.perf_counter()
+        if self._delay_and_fail():
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}
+
+        chat_id = int(params.get("chat_id") or 0)
+        if api_method == "getChat":
+            return 200, {"ok": True, "result": {
+                "id": chat_id, "type": "private", "first_name": "Load", "username": f"user{chat_id}"}}
+
+        if self.on_reply:
+            self.on_reply(chat_id, api_method, params, received_at)
+        if api_method == "sendMessage":
+            return 200, {"ok": True, "result": self._message(chat_id, {"text": params.get("text", "")})}
+        if api_method == "sendPhoto":
+            photo = [{"file_id": "loadtest", "file_unique_id": "loadtest", "width": 1000, "height": 800}]
+            return 200, {"ok": True, "result": self._message(chat_id, {"photo": photo})}
+        return 200, {"ok": True, "result": True}
@@ -0,0 +1,100 @@
+import json
+import zlib
+from collections import Counter
+from typing import Iterator, Tuple
+
+from django.db.models import Count
+
+from BotAnalytics.models import BotAnalytics, LocationsAnalytics
+
+
+def chat_id_for(user_id: str) -> int:
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return zlib.crc32(str(user_id).encode("utf-8"))
+
+
+def build_workload(start, end) -> dict:
+    """
+    Turn the BotAnalytics and LocationsAnalytics rows logged between `start`
+    and `end` into a replayable workload: every interaction with its offset
+    from the first one, plus the devices that were picked in the window.
+    """
+    events = []
+    first = None
+    rows = (
+        BotAnalytics.objects.filter(timestamp__range=(start, end))
+        .order_by("timestamp", "id")
+        .values_list("user_id", "command", "timestamp")
+    )
+    for user_id, command, timestamp in rows.iterator(chunk_size=2000):
+        if not command:
+            continue
+        if first is None:
+            first = timestamp
+        events.append([round((timestamp - first).total_seconds(), 3), user_id, command])
+
+    devices = [
+        {
+            "generated_id": str(row["device_id"]),
+            "name": row["device_name"],
+            "parent_name": row["device_province"] or "Unknown",
+            "issues": [],
+            "picks": row["picks"],
+        }
+        for row in (
+            LocationsAnalytics.objects.filter(timestamp__range=(start, end))
+            .values("device_id", "device_name", "device_province")
+            .annotate(picks=Count("id"))
+            .order_by("-picks")
+        )
+        if row["device_name"]
+    ]
+
+    return {
+        "window": {"start": start.isoformat(), "end": end.isoformat()},
+        "devices": devices,
+        "events": events,
+    }
+
+
+def save_workload(workload: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(workload, f, ensure_ascii=False)
+
+
+def load_workload(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def command_label(text: str, regions: set, devices: set) -> str:
+    if text.startswith("/"):
+        return text.split()[0]
+    if text in regions:
+        return "region"
+    if text in devices:
+        return "device"
+    return "text"
+
+
+def replay_events(workload: dict) -> Iterator[Tuple[float, int, str, str]]:
+    regions = {d["parent_name"] for d in workload["devices"]}
+    devices = {d["name"] for d in workload["devices"]}
+    for offset, user_id, text in workload["events"]:
+        yield offset, chat_id_for(user_id), command_label(text, regions, devices), text
+
+
+def summarize(workload: dict, top: int = 10) -> dict:
+    events = workload["events"]
+    regions = {d["parent_name"] for d in workload["devices"]}
+    devices = {d["name"] for d in workload["devices"]}
+    mix = Counter(command_label(text, regions, devices) for _, _, text in events)
+    return {
+        "events": len(events),
+        "users": len({user_id for _, user_id, _ in events}),
+        "span_s": events[-1][0] if events else 0.0,
+        "command_mix": dict(mix.most_common(top)),
+        "top_devices": {d["name"]: d["picks"] for d in workload["devices"][:top]},
+    }
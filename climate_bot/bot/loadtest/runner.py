@@ -0,0 +1,244 @@
+import logging
+import math
+import os
+import queue
+import random
+import resource
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A step is (label, text). Labels group latencies in the report.
+Step = Tuple[str, str]
+
+
+def current_scenario(catalog: Dict[str, list], rng: random.Random) -> List[Step]:
+    region = rng.choice(list(catalog))
+    device = rng.choice(catalog[region])
+    return [
+        ("/start", "/start"),
+        ("region", region),
+        ("device", device),
+        ("/Current", f"/Current 📍{device}"),
+    ]
+
+
+def compare_scenario(catalog: Dict[str, list], rng: random.Random) -> List[Step]:
+    steps = [("/Compare", "/Compare 🆚")]
+    picked = set()
+    for _ in range(2):
+        region = rng.choice(list(catalog))
+        candidates = [d for d in catalog[region] if d not in picked] or catalog[region]
+        device = rng.choice(candidates)
+        picked.add(device)
+        steps += [("compare_region", region), ("compare_device", device)]
+    steps.append(("/Start_Comparing", "/Start_Comparing ✅"))
+    return steps
+
+
+SCENARIOS = {
+    "current": current_scenario,
+    "compare": compare_scenario,
+}
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = math.ceil(pct / 100.0 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _PendingStep:
+    __slots__ = ("label", "sent_at", "done", "latency")
+
+    def __init__(self, label: str, sent_at: float):
+        self.label = label
+        self.sent_at = sent_at
+        self.done = threading.Event()
+        self.latency = None
+
+
+class LoadRunner:
+    """
+    Drives scripted conversations through a FakeTelegramServer. A step is
+    complete when the bot answers the chat with a message carrying a
+    reply_markup, which every interactive handler in bot.views ends with.
+    With complete_on_markup=False any reply completes the step instead.
+    """
+
+    def __init__(self, telegram, catalog: Dict[str, list], step_timeout: float = 30.0,
+                 think_time: float = 0.0, seed: int = 0, complete_on_markup: bool = True):
+        self.telegram = telegram
+        self.telegram.on_reply = self._on_reply
+        self.catalog = catalog
+        self.complete_on_markup = complete_on_markup
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pending: Dict[int, _PendingStep] = {}
+        self._next_chat_id = 10_000_000
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.conversations = 0
+        self.rss_samples: List[int] = []
+
+    def _on_reply(self, chat_id, method, params, received_at):
+        if self.complete_on_markup and "reply_markup" not in params:
+            return
+        with self._lock:
+            step = self._pending.pop(chat_id, None)
+        if step is not None:
+            step.latency = received_at - step.sent_at
+            step.done.set()
+
+    def _new_chat_id(self) -> int:
+        with self._lock:
+            self._next_chat_id += 1
+            return self._next_chat_id
+
+    def send_step(self, chat_id: int, label: str, text: str) -> Optional[float]:
+        step = _PendingStep(label, time.perf_counter())
+        with self._lock:
+            self._pending[chat_id] = step
+        self.telegram.push_message(chat_id, text)
+        if step.done.wait(self.step_timeout):
+            with self._lock:
+                self.latencies[label].append(step.latency)
+            return step.latency
+        with self._lock:
+            self._pending.pop(chat_id, None)
+            self.timeouts[label] += 1
+        return None
+
+    def run_conversation(self, steps: List[Step], chat_id: Optional[int] = None) -> None:
+        chat_id = chat_id or self._new_chat_id()
+        for label, text in steps:
+            if self.send_step(chat_id, label, text) is None:
+                break
+            if self.think_time:
+                time.sleep(self.think_time)
+        with self._lock:
+            self.conversations += 1
+
+    def _sample_rss(self, stop: threading.Event, interval: float = 0.5) -> None:
+        while not stop.is_set():
+            self.rss_samples.append(current_rss_bytes())
+            stop.wait(interval)
+
+    def run(self, scenarios: Dict[str, Callable], rate: float, duration: float, max_users: int = 200) -> float:
+        """Start `rate` conversations per second for `duration` seconds; return elapsed time."""
+        names = list(scenarios)
+        slots = threading.BoundedSemaphore(max_users)
+        workers = []
+        stop_sampler = threading.Event()
+        sampler = threading.Thread(target=self._sample_rss, args=(stop_sampler,), daemon=True)
+        sampler.start()
+
+        def worker(steps):
+            try:
+                self.run_conversation(steps)
+            finally:
+                slots.release()
+
+        started = time.perf_counter()
+        next_start = started
+        while time.perf_counter() - started < duration:
+            now = time.perf_counter()
+            if now < next_start:
+                time.sleep(next_start - now)
+            next_start += self._rng.expovariate(rate)
+            if not slots.acquire(timeout=self.step_timeout):
+                logger.warning("All virtual users busy; skipping a conversation start")
+                continue
+            steps = scenarios[self._rng.choice(names)](self.catalog, self._rng)
+            thread = threading.Thread(target=worker, args=(steps,), daemon=True)
+            thread.start()
+            workers.append(thread)
+
+        for thread in workers:
+            thread.join()
+        stop_sampler.set()
+        sampler.join()
+        return time.perf_counter() - started
+
+    def replay(self, events: Iterable[Tuple[float, int, str, str]], speedup: float = 1.0) -> float:
+        """
+        Send each (offset, chat_id, label, text) event `offset / speedup` seconds
+        after the start. Events of one chat go out in order, each after the
+        previous one was answered, like a user waiting for the reply.
+        """
+        queues: Dict[int, queue.Queue] = {}
+        workers = []
+        stop_sampler = threading.Event()
+        sampler = threading.Thread(target=self._sample_rss, args=(stop_sampler,), daemon=True)
+        sampler.start()
+
+        def worker(chat_id, inbox):
+            while True:
+                item = inbox.get()
+                if item is None:
+                    break
+                self.send_step(chat_id, *item)
+            with self._lock:
+                self.conversations += 1
+
+        started = time.perf_counter()
+        for offset, chat_id, label, text in events:
+            delay = started + offset / speedup - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            inbox = queues.get(chat_id)
+            if inbox is None:
+                inbox = queues[chat_id] = queue.Queue()
+                thread = threading.Thread(target=worker, args=(chat_id, inbox), daemon=True)
+                thread.start()
+                workers.append(thread)
+            inbox.put((label, text))
+
+        for inbox in queues.values():
+            inbox.put(None)
+        for thread in workers:
+            thread.join()
+        stop_sampler.set()
+        sampler.join()
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        commands = {}
+        total = 0
+        for label in sorted(set(self.latencies) | set(self.timeouts)):
+            values = sorted(self.latencies.get(label, []))
+            total += len(values)
+            commands[label] = {
+                "count": len(values),
+                "timeouts": self.timeouts.get(label, 0),
+                "p50_ms": _ms(percentile(values, 50)),
+                "p95_ms": _ms(percentile(values, 95)),
+                "p99_ms": _ms(percentile(values, 99)),
+            }
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "conversations": self.conversations,
+            "updates": total,
+            "throughput_ups": round(total / elapsed, 2) if elapsed else 0.0,
+            "commands": commands,
+            "rss_peak_mb": round(max(self.rss_samples, default=0) / 2 ** 20, 1),
+            "rss_final_mb": round(current_rss_bytes() / 2 ** 20, 1),
+        }
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 1) if value is not None else None
@@ -0,0 +1,69 @@
+# bot/management/commands/benchmark.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.benchmarks.suite import (BASELINE_PATH, DEFAULT_SIZES, MIN_DELTA_US, compare, load_baseline, run_suite,
+                                  save_baseline)
+
+
+class Command(BaseCommand):
+    help = 'Times the formatting, classification and handler-filter hot paths and compares them to the stored baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                            help='Comma-separated device list sizes')
+        parser.add_argument('--repeat', type=int, default=15, help='Timed runs per benchmark; the median is kept')
+        parser.add_argument('--filter', dest='name_filter', help='Only run benchmarks whose name contains this')
+        parser.add_argument('--baseline', default=BASELINE_PATH)
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Flag benchmarks slower than baseline by more than this fraction (plus their noise)')
+        parser.add_argument('--min-delta', type=float, default=MIN_DELTA_US,
+                            help='Ignore slowdowns smaller than this many microseconds')
+        parser.add_argument('--confirm', type=int, default=2,
+                            help='Re-run flagged benchmarks this many times; a regression must show in every run')
+        parser.add_argument('--save', action='store_true', help='Write the results as the new baseline')
+
+    def _progress(self, name, value):
+        self.stdout.write(f"{name:<60}{value['us']:>12.2f} us  ±{value['spread']:.0%}")
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',') if s]
+        baseline = None
+        if not options['save']:
+            try:
+                baseline = load_baseline(options['baseline'])
+            except FileNotFoundError:
+                raise CommandError(f"No baseline at {options['baseline']}; run with --save first")
+
+        def regressed(name, value):
+            if compare({name: value}, baseline, options['threshold'], options['min_delta'])[0]['status'] != 'REGRESSION':
+                return False
+            self.stdout.write(f"{name} looks slower than the baseline, timing it again")
+            return True
+
+        results = run_suite(
+            sizes=sizes,
+            repeat=options['repeat'],
+            name_filter=options['name_filter'],
+            retry=regressed if baseline is not None else None,
+            retries=options['confirm'],
+            progress=self._progress,
+        )
+
+        if options['save']:
+            save_baseline(results, options['baseline'])
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {options['baseline']}"))
+            return
+
+        rows = compare(results, baseline, options['threshold'], options['min_delta'])
+        self.stdout.write('')
+        self.stdout.write(f"{'benchmark':<60}{'baseline':>12}{'current':>12}{'ratio':>8}  status")
+        for row in rows:
+            base = f"{row['baseline']:.2f}" if row['baseline'] is not None else '-'
+            ratio = f"{row['ratio']:.2f}" if row['ratio'] is not None else '-'
+            line = f"{row['name']:<60}{base:>12}{row['current']:>12.2f}{ratio:>8}  {row['status']}"
+            self.stdout.write(self.style.ERROR(line) if row['status'] == 'REGRESSION' else line)
+
+        regressions = [row['name'] for row in rows if row['status'] == 'REGRESSION']
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmark(s) regressed by more than {options['threshold']:.0%}")
@@ -0,0 +1,170 @@
+# bot/management/commands/loadtest.py
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from BotAnalytics.writer import analytics_writer
+from bot.loadtest.fake_servers import FakeClimateNetServer, FakeTelegramServer, make_devices
+from bot.loadtest.runner import SCENARIOS, LoadRunner
+
+
+def count_analytics_rows():
+    from BotAnalytics.models import BotAnalytics, LocationsAnalytics
+    from users.models import TelegramUser
+    return (
+        BotAnalytics.objects.count()
+        + LocationsAnalytics.objects.count()
+        + TelegramUser.objects.count()
+    )
+
+
+class Command(BaseCommand):
+    help = 'Runs the bot against local fake Telegram and ClimateNet servers and reports throughput and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, default=2.0, help='New conversations per second')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds to keep starting conversations')
+        parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['mixed'], default='mixed')
+        parser.add_argument('--devices', type=int, default=20, help='Number of devices served by the fake API')
+        parser.add_argument('--max-users', type=int, default=200, help='Maximum concurrent conversations')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Pause between steps of a conversation')
+        self.add_harness_arguments(parser)
+
+    def add_harness_arguments(self, parser):
+        parser.add_argument('--step-timeout', type=float, default=30.0)
+        parser.add_argument('--climatenet-latency', type=float, default=0.05, help='Seconds added to each ClimateNet call')
+        parser.add_argument('--climatenet-error-rate', type=float, default=0.0)
+        parser.add_argument('--telegram-latency', type=float, default=0.02, help='Seconds added to each Bot API call')
+        parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--use-configured-db', action='store_true',
+                            help='Write to the configured database instead of a throwaway copy')
+        parser.add_argument('--log-level', default='WARNING')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['scenario'] == 'mixed':
+            scenarios = SCENARIOS
+        else:
+            scenarios = {options['scenario']: SCENARIOS[options['scenario']]}
+
+        def drive(runner):
+            return runner.run(scenarios, rate=options['rate'], duration=options['duration'],
+                              max_users=options['max_users'])
+
+        devices = make_devices(options['devices'], seed=options['seed'])
+        report = self.run_with_fakes(devices, options, drive)
+        self.print_report(report, options['json'])
+
+    def run_with_fakes(self, devices, options, drive):
+        old_db_name = None
+        if not options['use_configured_db']:
+            old_db_name = self._create_scratch_db()
+
+        climatenet = FakeClimateNetServer(
+            devices,
+            latency=options['climatenet_latency'],
+            jitter=options['climatenet_latency'] / 2,
+            error_rate=options['climatenet_error_rate'],
+        )
+        telegram = FakeTelegramServer(
+            latency=options['telegram_latency'],
+            jitter=options['telegram_latency'] / 2,
+            error_rate=options['telegram_error_rate'],
+        )
+        climatenet.start()
+        telegram.start()
+        try:
+            return self.run_load(climatenet, telegram, options, drive)
+        finally:
+            telegram.stop()
+            climatenet.stop()
+            # Late handler threads may still queue rows; write them before the scratch DB goes away
+            analytics_writer.flush()
+            if old_db_name is not None:
+                connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+    def _create_scratch_db(self):
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            # A file database, so concurrent handler threads see real SQLite locking
+            fd, path = tempfile.mkstemp(prefix='loadtest_', suffix='.sqlite3')
+            os.close(fd)
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        return old_name
+
+    def run_load(self, climatenet, telegram, options, drive):
+        """Point bot.views at the fake servers, start polling and call `drive(runner)`."""
+        os.environ['CLIMATENET_API_URL'] = climatenet.api_url
+        os.environ['TELEGRAM_API_URL'] = telegram.api_url
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:loadtest')
+
+        from bot import views  # imported late: the module connects to the APIs on import
+        logging.getLogger().setLevel(options['log_level'])
+        views.device_manager.force_update()
+
+        runner = LoadRunner(
+            telegram,
+            catalog=views.device_manager.get_locations(),
+            step_timeout=options['step_timeout'],
+            think_time=options.get('think_time', 0.0),
+            seed=options['seed'],
+            complete_on_markup=options.get('complete_on_markup', True),
+        )
+
+        rows_before = count_analytics_rows()
+        polling = threading.Thread(target=views.start_bot, daemon=True)
+        polling.start()
+        try:
+            elapsed = drive(runner)
+        finally:
+            views.bot.stop_polling()
+        analytics_writer.flush()
+        rows_after = count_analytics_rows()
+
+        report = runner.report(elapsed)
+        report['db_rows_written'] = rows_after - rows_before
+        report['db_writes_per_s'] = round((rows_after - rows_before) / elapsed, 2) if elapsed else 0.0
+        report['climatenet_requests'] = climatenet.request_count
+        report['climatenet_errors'] = climatenet.error_count
+        report['telegram_requests'] = telegram.request_count
+        report['telegram_errors'] = telegram.error_count
+        report['analytics_writer'] = analytics_writer.stats()
+        return report
+
+    def print_report(self, report, as_json=False):
+        if as_json:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"{report['conversations']} conversations, {report['updates']} updates in {report['elapsed_s']}s "
+            f"({report['throughput_ups']} updates/s)"
+        )
+        self.stdout.write(f"{'command':<20}{'count':>8}{'timeouts':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for label, stats in report['commands'].items():
+            self.stdout.write(
+                f"{label:<20}{stats['count']:>8}{stats['timeouts']:>10}"
+                f"{_fmt(stats['p50_ms']):>10}{_fmt(stats['p95_ms']):>10}{_fmt(stats['p99_ms']):>10}"
+            )
+        self.stdout.write(f"DB writes: {report['db_rows_written']} rows ({report['db_writes_per_s']}/s)")
+        writer = report['analytics_writer']
+        self.stdout.write(
+            f"Analytics writer: {writer['written']} written, {writer['dropped']} dropped, "
+            f"{writer['failed']} failed, queue depth {writer['queue_depth']}"
+        )
+        self.stdout.write(f"RSS: peak {report['rss_peak_mb']} MB, final {report['rss_final_mb']} MB")
+        self.stdout.write(
+            f"Upstream: ClimateNet {report['climatenet_requests']} requests ({report['climatenet_errors']} errors), "
+            f"Telegram {report['telegram_requests']} requests ({report['telegram_errors']} errors)"
+        )
+
+
+def _fmt(value):
+    return '-' if value is None else f"{value:.1f}"
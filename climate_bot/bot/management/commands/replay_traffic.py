@@ -0,0 +1,63 @@
+# bot/management/commands/replay_traffic.py
+
+import json
+from datetime import timedelta
+
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
+
+from bot.loadtest.replay import build_workload, load_workload, replay_events, save_workload, summarize
+from bot.management.commands.loadtest import Command as LoadTestCommand
+
+
+def parse_window_bound(value, name):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError(f"Invalid --{name} datetime: {value}")
+    return make_aware(parsed) if is_naive(parsed) else parsed
+
+
+class Command(LoadTestCommand):
+    help = 'Replays a time window of BotAnalytics traffic against local fake Telegram and ClimateNet servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='Window start (ISO datetime), defaults to 24 hours before --end')
+        parser.add_argument('--end', help='Window end (ISO datetime), defaults to now')
+        parser.add_argument('--speedup', type=float, default=10.0, help='Replay this many times faster than recorded')
+        parser.add_argument('--input', help='Replay a workload file instead of reading the database')
+        parser.add_argument('--output', help='Write the workload to this file')
+        parser.add_argument('--dry-run', action='store_true', help='Only build the workload and print its summary')
+        self.add_harness_arguments(parser)
+
+    def handle(self, *args, **options):
+        if options['speedup'] <= 0:
+            raise CommandError("--speedup must be positive")
+
+        if options['input']:
+            workload = load_workload(options['input'])
+        else:
+            end = parse_window_bound(options['end'], 'end') if options['end'] else now()
+            start = parse_window_bound(options['start'], 'start') if options['start'] else end - timedelta(days=1)
+            workload = build_workload(start, end)
+        if options['output']:
+            save_workload(workload, options['output'])
+
+        summary = summarize(workload)
+        self.stdout.write(
+            f"Workload: {summary['events']} events from {summary['users']} users over {summary['span_s']}s "
+            f"(replayed in ~{summary['span_s'] / options['speedup']:.1f}s)"
+        )
+        self.stdout.write(f"Command mix: {json.dumps(summary['command_mix'], ensure_ascii=False)}")
+        self.stdout.write(f"Top devices: {json.dumps(summary['top_devices'], ensure_ascii=False)}")
+        if options['dry_run'] or not summary['events']:
+            return
+
+        # Replayed commands are not all keyboard steps, so the first reply completes each one
+        options['complete_on_markup'] = False
+        report = self.run_with_fakes(
+            workload['devices'],
+            options,
+            lambda runner: runner.replay(replay_events(workload), speedup=options['speedup']),
+        )
+        self.print_report(report, options['json'])
@@ -2,6 +2,13 @@
 
 from django.core.management.base import BaseCommand
 from bot.views import start_bot_thread
+from BotAnalytics import metrics
+from BotAnalytics.profiling import profile_worker
+from BotAnalytics.writer import analytics_writer
+from users.broadcast import broadcast_worker
+from django.conf import settings
+import signal
+import sys
 import threading
 import time
 
@@ -11,6 +18,20 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         self.stdout.write('Starting bot...')
 
+        # systemd stops the service with SIGTERM; exit normally so queued analytics are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # Profiles requested in the admin, or with `kill -USR1` (stack sampling) / `kill -USR2` (heap)
+        profile_worker.start()
+        broadcast_worker.start()  # Broadcasts queued in the admin; resumes one cut short by a restart
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: profile_worker.request('sampling'))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: profile_worker.request('memory'))
+
+        metrics_port = getattr(settings, 'METRICS_PORT', None)
+        if metrics_port:
+            metrics.serve(metrics_port, getattr(settings, 'METRICS_HOST', '127.0.0.1'))
+
         # Start the bot in a separate thread
         bot_thread = threading.Thread(target=self.start_bot_in_thread)
         bot_thread.daemon = True  # Daemon thread will end when the main program ends
@@ -19,10 +40,16 @@ class Command(BaseCommand):
         self.stdout.write('Bot started.')
 
         # Keep the process alive
-        while True:
-            time.sleep(1)  # Add a small sleep to reduce CPU usage
-            # The loop is needed to keep the management command running
-            # The bot runs in the background thread
+        try:
+            while True:
+                time.sleep(1)  # Add a small sleep to reduce CPU usage
+                # The loop is needed to keep the management command running
+                # The bot runs in the background thread
+        finally:
+            self.stdout.write('Stopping bot, writing queued analytics...')
+            profile_worker.stop()
+            broadcast_worker.stop()
+            analytics_writer.stop()
 
     def start_bot_in_thread(self):
         """ Wrapper to start the bot in a new thread """
@@ -0,0 +1,189 @@
+# bot/management/commands/stress_db.py
+
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from BotAnalytics.models import BotAnalytics
+from BotAnalytics.writer import analytics_writer
+from users.models import TelegramUser
+
+# name: (SQLite pragmas, busy timeout in seconds, CONN_MAX_AGE, writes go through the writer thread)
+SQLITE_PROFILES = {
+    'legacy': ({'journal_mode': 'delete', 'synchronous': 'full'}, 5, 0, False),
+    'wal': (None, None, None, False),
+    'wal-writer': (None, None, None, True),
+}
+SERVER_PROFILES = {
+    'server': (None, None, None, False),
+    'server-writer': (None, None, None, True),
+}
+COMMANDS = ['/start', '/Current 📍', '/Change_location 🔄', '/Help ❓', '/Compare 🆚']
+
+
+class Command(BaseCommand):
+    help = ('Hammers a throwaway copy of the database from many threads with bot-like reads and writes '
+            'and reports throughput and "database is locked" errors for each database profile')
+
+    def add_arguments(self, parser):
+        profiles = sorted(SQLITE_PROFILES) + sorted(SERVER_PROFILES)
+        parser.add_argument('--profiles', nargs='+', choices=profiles,
+                            help='Profiles to run (default: every profile for the configured engine). '
+                                 '"legacy" is rollback journal, 5s timeout, a connection per operation and '
+                                 'direct writes; "wal" uses the configured SQLite settings; "-writer" profiles '
+                                 'queue writes on the analytics writer thread')
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent handler threads')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per profile')
+        parser.add_argument('--rate', type=float, default=0.0,
+                            help='Target operations per second over all threads (default: as fast as possible)')
+        parser.add_argument('--write-ratio', type=float, default=0.7, help='Share of operations that write')
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        available = SQLITE_PROFILES if connection.vendor == 'sqlite' else SERVER_PROFILES
+        names = options['profiles'] or list(available)
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise CommandError(f"{', '.join(unknown)} cannot run on {connection.vendor}")
+
+        reports = [self.run_profile(name, available[name], options) for name in names]
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+        self.stdout.write(f"{'profile':<14}{'ops/s':>10}{'writes':>9}{'errors':>8}{'error %':>9}"
+                          f"{'p50 ms':>9}{'p99 ms':>9}{'rows':>9}")
+        for report in reports:
+            self.stdout.write(
+                f"{report['profile']:<14}{report['ops_per_s']:>10.1f}{report['writes']:>9}{report['errors']:>8}"
+                f"{report['error_rate'] * 100:>9.2f}{report['p50_ms']:>9.1f}{report['p99_ms']:>9.1f}"
+                f"{report['rows_written']:>9}"
+            )
+
+    def run_profile(self, name, profile, options):
+        pragmas, timeout, max_age, use_writer = profile
+        db = connection.settings_dict
+        saved = {'CONN_MAX_AGE': db.get('CONN_MAX_AGE', 0), 'OPTIONS': dict(db.get('OPTIONS', {}))}
+        if max_age is not None:
+            db['CONN_MAX_AGE'] = max_age
+        if timeout is not None:
+            db['OPTIONS'] = {**db.get('OPTIONS', {}), 'timeout': timeout}
+
+        old_db_name = self._create_scratch_db()
+        try:
+            with override_settings(SQLITE_PRAGMAS=pragmas or getattr(settings, 'SQLITE_PRAGMAS', {})):
+                connection.close()  # Reconnect with this profile's pragmas
+                report = self.hammer(use_writer, options)
+                analytics_writer.stop()
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            db.update(saved)
+        report['profile'] = name
+        return report
+
+    def _create_scratch_db(self):
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            # A file database, so threads contend for the real SQLite locks
+            fd, path = tempfile.mkstemp(prefix='stress_', suffix='.sqlite3')
+            os.close(fd)
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        return old_name
+
+    def hammer(self, use_writer, options):
+        TelegramUser.objects.bulk_create(
+            [TelegramUser(telegram_id=10 ** 9 + i, first_name=f"User {i}") for i in range(options['users'])])
+        writer_before = analytics_writer.stats()
+        deadline = time.monotonic() + options['duration']
+        results = []
+        lock = threading.Lock()
+
+        interval = options['threads'] / options['rate'] if options['rate'] else 0.0
+
+        def worker(seed):
+            rng = random.Random(seed)
+            latencies, writes, errors = [], 0, 0
+            next_at = time.monotonic() + rng.random() * interval
+            while time.monotonic() < deadline:
+                if interval:
+                    time.sleep(max(0.0, next_at - time.monotonic()))
+                    next_at += interval
+                telegram_id = 10 ** 9 + rng.randrange(options['users'])
+                write = rng.random() < options['write_ratio']
+                started = time.perf_counter()
+                try:
+                    if write:
+                        self.write(telegram_id, rng, use_writer)
+                        writes += 1
+                    else:
+                        self.read(telegram_id)
+                except OperationalError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+                close_old_connections()  # A request boundary: closes the connection unless it is persistent
+            connection.close()
+            with lock:
+                results.append((latencies, writes, errors))
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        analytics_writer.flush()
+        writer_after = analytics_writer.stats()
+
+        latencies = sorted(latency for result in results for latency in result[0])
+        ops = len(latencies)
+        errors = sum(result[2] for result in results)
+        if use_writer:
+            # Writes that were queued but never made it to the database
+            errors += (writer_after['failed'] - writer_before['failed']) + (writer_after['dropped'] - writer_before['dropped'])
+        return {
+            'threads': options['threads'],
+            'seconds': round(elapsed, 2),
+            'ops': ops,
+            'ops_per_s': ops / elapsed if elapsed else 0.0,
+            'writes': sum(result[1] for result in results),
+            'errors': errors,
+            'error_rate': errors / ops if ops else 0.0,
+            'p50_ms': statistics.median(latencies) * 1000 if latencies else 0.0,
+            'p99_ms': latencies[int(0.99 * (ops - 1))] * 1000 if latencies else 0.0,
+            'rows_written': BotAnalytics.objects.count(),
+        }
+
+    def write(self, telegram_id, rng, use_writer):
+        """What a command handler writes: the analytics event and the user's location."""
+        event = BotAnalytics(user_id=str(telegram_id), command=rng.choice(COMMANDS), success=True,
+                             response_time=rng.lognormvariate(-2, 0.8), timestamp=timezone.now())
+        location = f"{rng.uniform(43, 46):.5f},{rng.uniform(39, 41):.5f}"
+        if use_writer:
+            analytics_writer.submit(event)
+            analytics_writer.call(_save_location, telegram_id, location)
+        else:
+            with transaction.atomic():
+                event.save()
+                _save_location(telegram_id, location)
+
+    def read(self, telegram_id):
+        """What the handlers and admin read: a user's profile and their recent commands."""
+        TelegramUser.objects.filter(telegram_id=telegram_id).first()
+        list(BotAnalytics.objects.filter(user_id=str(telegram_id)).order_by('-timestamp')[:5])
+
+
+def _save_location(telegram_id, location):
+    TelegramUser.objects.filter(telegram_id=telegram_id).update(coordinates=location)
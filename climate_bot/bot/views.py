@@ -11,8 +11,10 @@ from bot.models import Device
 from collections import defaultdict
 import django
 from django.conf import settings
-from users.utils import save_telegram_user, save_users_locations
+from users.utils import save_users_locations, user_profile_cache
 from BotAnalytics.views import log_command_decorator, save_selected_device_to_db
+from BotAnalytics import metrics, profiling
+from BotAnalytics.spans import span, traced
 import uuid
 from string import Template
 import math
@@ -36,25 +38,72 @@ if not TELEGRAM_BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN not set in environment variables")
     raise ValueError("TELEGRAM_BOT_TOKEN not set")
 
+CLIMATENET_API_URL = os.getenv('CLIMATENET_API_URL', 'https://climatenet.am/device_inner/')
+
+# Bot API URL template, e.g. "http://127.0.0.1:8081/bot{0}/{1}" for a local server
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
 
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 
 device_manager = DeviceManager(
-    api_url="https://climatenet.am/device_inner/list/",  
-    refresh_interval= 86400,  #day  
+    api_url=f"{CLIMATENET_API_URL}list/",  
+    refresh_interval=getattr(settings, 'DEVICE_REFRESH_INTERVAL', 600),
     max_retries=3
 )
 
+# Reply keyboards built from the device list, keyed ('regions', extra button) or
+# ('devices', region, extra button), each stored with the snapshot version it was built from
+_keyboards = {}
+
+
+def _on_devices_changed(changes):
+    # Stale entries are rebuilt anyway; this only frees the ones of removed regions
+    _keyboards.clear()
+
+
+device_manager.subscribe(_on_devices_changed)
 device_manager.start_auto_update()
 
+
+def _device_refresh_age():
+    # NaN until the first fetch succeeds, rather than the age of the epoch
+    last_update = device_manager.status()['last_update']
+    return time.time() - last_update if last_update else float('nan')
+
+
+metrics.device_refresh_age.set_function(_device_refresh_age)
+metrics.device_refresh_failures.set_function(lambda: device_manager.status()['consecutive_failures'])
+metrics.devices.set_function(lambda: device_manager.status()['devices'], state='known')
+metrics.devices.set_function(lambda: device_manager.status()['devices_with_issues'], state='with_issues')
+
+
+def count_updates(messages):
+    for message in messages:
+        metrics.updates.inc(content_type=message.content_type)
+
+
+bot.set_update_listener(count_updates)
+
 user_context = {}
+profiling.add_size_probe('user_context', lambda: len(user_context))
 
+@traced('fetch')
 def fetch_latest_measurement(device_id):
-    url = f"https://climatenet.am/device_inner/{device_id}/latest/"
+    url = f"{CLIMATENET_API_URL}{device_id}/latest/"
     logger.debug(f"Fetching measurement for device ID: {device_id}, URL: {url}")
     try:
-        response = requests.get(url, timeout=10)
+        try:
+            with metrics.upstream_latency.time(service='climatenet', endpoint='latest'):
+                response = requests.get(url, timeout=10)
+        except requests.RequestException:
+            metrics.upstream_errors.inc(service='climatenet', endpoint='latest')
+            raise
         logger.debug(f"API response status: {response.status_code}, content: {response.text}")
+        if response.status_code != 200:
+            metrics.upstream_errors.inc(service='climatenet', endpoint='latest')
         if response.status_code == 200:
             data = response.json()
             if data:
@@ -102,15 +151,43 @@ def run_bot():
 
 
 def start_bot_thread():
+    user_profile_cache.warm()
     bot_thread = threading.Thread(target=run_bot)
     bot_thread.start()
 
 
+def _keyboard(key, build):
+    """The cached markup for `key`, rebuilt by `build(snapshot)` when the device list has changed since."""
+    snapshot = device_manager.snapshot()
+    cached = _keyboards.get(key)
+    if cached is None or cached[0] != snapshot.version:
+        cached = _keyboards[key] = (snapshot.version, build(snapshot))
+    return cached[1]
+
+
+def _regions_keyboard(extra=None):
+    def build(snapshot):
+        markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
+        for country in snapshot.locations.keys():
+            markup.add(types.KeyboardButton(country))
+        if extra:
+            markup.add(types.KeyboardButton(extra))
+        return markup
+    return _keyboard(('regions', extra), build)
+
+
+def _devices_keyboard(region, extra):
+    def build(snapshot):
+        markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
+        for device in snapshot.locations.get(region, ()):
+            markup.add(types.KeyboardButton(device))
+        markup.add(types.KeyboardButton(extra))
+        return markup
+    return _keyboard(('devices', region, extra), build)
+
+
 def send_location_selection(chat_id):
-    location_markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    locations = device_manager.get_locations()
-    for country in locations.keys():
-        location_markup.add(types.KeyboardButton(country))
+    location_markup = _regions_keyboard()
     bot.send_message(chat_id, 'Please choose a Region: 📍', reply_markup=location_markup)
 
 
@@ -121,7 +198,6 @@ def start(message):
         message.chat.id,
         '🌤️ Welcome to ClimateNet! 🌧️'
     )
-    save_telegram_user(message.from_user)
     bot.send_message(
         message.chat.id,
         f'''Hello {message.from_user.first_name}! 👋 I am your personal climate assistant.
@@ -148,7 +224,7 @@ def start_compare(message):
         bot.send_message(chat_id, f"Error starting comparison: {e}")
 
 
-@bot.message_handler(func=lambda message: message.text in device_manager.get_locations().keys())
+@bot.message_handler(func=lambda message: message.text in device_manager.get_locations())
 @log_command_decorator
 def handle_country_selection(message):
     selected_country = message.text
@@ -161,58 +237,16 @@ def handle_country_selection(message):
         send_device_selection_for_compare(chat_id, selected_country, device_number)
         return
     user_context[chat_id] = {'selected_country': selected_country}
-    markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    locations = device_manager.get_locations()
-    for device in locations[selected_country]:
-        markup.add(types.KeyboardButton(device))
-    markup.add(types.KeyboardButton('/Change_location'))
+    markup = _devices_keyboard(selected_country, '/Change_location')
     bot.send_message(chat_id, 'Please choose a Location: ✅', reply_markup=markup)
 
 
-def uv_index(uv):
-    if uv is None:
-        return "N/A"
-    if uv < 3:
-        return "Low 🟢"
-    elif 3 <= uv <= 5:
-        return "Moderate 🟡"
-    elif 6 <= uv <= 7:
-        return "High 🟠"
-    elif 8 <= uv <= 10:
-        return "Very High 🔴"
-    else:
-        return "Extreme 🟣"
-
-
-def pm_level(pm, pollutant):
-    if pm is None:
-        return "N/A"
-    thresholds = {
-        "PM1.0": [50, 100, 150, 200, 300],
-        "PM2.5": [12, 36, 56, 151, 251],
-        "PM10": [54, 154, 254, 354, 504]
-    }
-    levels = [
-        "Good 🟢",
-        "Moderate 🟡",
-        "Unhealthy for Sensitive Groups 🟠",
-        "Unhealthy 🟠",
-        "Very Unhealthy 🔴",
-        "Hazardous 🔴"
-    ]
-    thresholds = thresholds.get(pollutant, [])
-    for i, limit in enumerate(thresholds):
-        if pm <= limit:
-            return levels[i]
-    return levels[-1]
-
 def format_device_issues(device_name, html_format=False):
     try:
-        device_issues = device_manager.get_device_issues()
-        if device_name not in device_issues:
+        issues = device_manager.get_device_issues().get(device_name)
+        if issues is None:
             return ""
-        issues = device_issues[device_name]
-        if not isinstance(issues, list):
+        if not isinstance(issues, (list, tuple)):
             logger.error(f"Invalid issues format fpr {device_name}")
             return ""
         if not issues:
@@ -274,6 +308,7 @@ def pm_level(pm, pollutant, with_emoji = True):
     return f"{label} {emoji}" if with_emoji else label
 
 
+@traced('template')
 def get_formatted_data(measurement, selected_device):
     logger.debug(f"Formatting data for device: {selected_device}")
     def safe_value(value, unit="", is_round=False):
@@ -311,6 +346,7 @@ def get_formatted_data(measurement, selected_device):
         f"{technical_issues_message}"
     )
 
+@traced('template')
 def get_comparison_formatted_data(devices, measurements):
     logger.debug(f"Generating comparison data for {len(devices)} devices")
     def safe_value(value, is_round=False):
@@ -473,16 +509,18 @@ def send_comparison_image(chat_id, html_content):
         bot.send_message(chat_id, "⚠️ Error generating comparison table. Please try again.")
         return
     try:
-        css_path = os.path.join(os.path.dirname(__file__), 'templates', 'bot', 'comparison.css')
-        html_content = inline_css_into_html(html_content, css_path)
+        with span('render'):
+            css_path = os.path.join(os.path.dirname(__file__), 'templates', 'bot', 'comparison.css')
+            html_content = inline_css_into_html(html_content, css_path)
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
 
-        temp_image_path = f"temp_comparison_{uuid.uuid4()}.png"
-        loop.run_until_complete(render_html_to_image(html_content, temp_image_path))
+            temp_image_path = f"temp_comparison_{uuid.uuid4()}.png"
+            with metrics.renders_in_progress.track_inprogress(), metrics.render_latency.time():
+                loop.run_until_complete(render_html_to_image(html_content, temp_image_path))
 
-        with open(temp_image_path, 'rb') as photo:
+        with open(temp_image_path, 'rb') as photo, span('send'):
             bot.send_photo(chat_id, photo)
 
         os.remove(temp_image_path)
@@ -496,7 +534,7 @@ def send_comparison_image(chat_id, html_content):
         bot.send_message(chat_id, "⚠️ Error generating comparison image. Please try again.")
 
 
-@bot.message_handler(func=lambda message: message.text in [device for devices in device_manager.get_locations().values() for device in devices]) 
+@bot.message_handler(func=lambda message: device_manager.has_device(message.text))
 @log_command_decorator
 def handle_device_selection(message):
     selected_device = message.text
@@ -646,8 +684,9 @@ def _send_device_data_and_menu(chat_id, selected_device, device_id):
 
     if measurement:
         formatted_data = get_formatted_data(measurement=measurement, selected_device=selected_device)
-        bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
-        bot.send_message(chat_id, '''For the next measurement, select\t
+        with span('send'):
+            bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
+            bot.send_message(chat_id, '''For the next measurement, select\t
 /Current 📍 every quarter of the hour. 🕒''')
     else:
         logger.error(f"Failed to fetch measurement for {selected_device}")
@@ -738,7 +777,6 @@ def get_command_menu(cur=None):
 def get_current_data(message):
     chat_id = message.chat.id
     command_markup = get_command_menu()
-    save_telegram_user(message.from_user)
     logger.debug(f"/Current triggered for chat_id: {chat_id}, User context: {user_context.get(chat_id, 'No context')}")
     if chat_id in user_context and 'device_id' in user_context[chat_id]:
         device_id = user_context[chat_id]['device_id']
@@ -749,8 +787,9 @@ def get_current_data(message):
         if measurement:
             try:
                 formatted_data = get_formatted_data(measurement=measurement, selected_device=selected_device)
-                bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
-                bot.send_message(chat_id, '''For the next measurement, select\n/Current 📍 every quarter of the hour. 🕒''')
+                with span('send'):
+                    bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
+                    bot.send_message(chat_id, '''For the next measurement, select\n/Current 📍 every quarter of the hour. 🕒''')
             except Exception as e:
                 logger.error(f"Failed to send message for {selected_device}: {e}")
                 bot.send_message(chat_id, "⚠️ Error sending data. Please try again later.", reply_markup = command_markup)
@@ -815,15 +854,12 @@ def map(message):
 
 
 def send_location_selection_for_compare(chat_id, device_number):
-    location_markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
     locations = device_manager.get_locations()
     if not locations:
         logger.error("No locations available")
         bot.send_message(chat_id, "⚠️ No locations available. Please try again later.")
         return
-    for country in locations.keys():
-        location_markup.add(types.KeyboardButton(country))
-    location_markup.add(types.KeyboardButton('/Cancel_Compare ❌'))
+    location_markup = _regions_keyboard('/Cancel_Compare ❌')
     if device_number <=5:
         bot.send_message(
             chat_id,
@@ -835,11 +871,7 @@ def send_location_selection_for_compare(chat_id, device_number):
 
 
 def send_device_selection_for_compare(chat_id, selected_country, device_number):
-    markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    locations = device_manager.get_locations()
-    for device in locations[selected_country]:
-        markup.add(types.KeyboardButton(device))
-    markup.add(types.KeyboardButton('/Cancel_Compare ❌'))
+    markup = _devices_keyboard(selected_country, '/Cancel_Compare ❌')
     bot.send_message(
         chat_id,
         f'Please choose Location {device_number}: ✅',
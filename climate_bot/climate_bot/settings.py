@@ -87,11 +87,43 @@ WSGI_APPLICATION = 'climate_bot.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. Set DB_ENGINE=postgresql (or mysql) with DB_NAME, DB_USER,
+# DB_PASSWORD, DB_HOST and DB_PORT to use a server database instead; point
+# DB_HOST at a PgBouncer to pool connections across processes.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite3')
+# Seconds a connection is kept open and reused by its thread (0 closes it after every request).
+# The bot's handlers and worker threads apply it with close_old_connections(), as requests do.
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '600'))
+
+if DB_ENGINE == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            # Seconds a write waits for the lock before failing with "database is locked"
+            'OPTIONS': {'timeout': float(os.getenv('DB_BUSY_TIMEOUT', '20'))},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': f'django.db.backends.{DB_ENGINE}',
+            'NAME': os.getenv('DB_NAME', 'climatenet'),
+            'USER': os.getenv('DB_USER', ''),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', ''),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
+
+# Applied to every new SQLite connection (bot/db.py). WAL lets readers run
+# while the writer thread commits; NORMAL sync is safe with WAL.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
 }
 # DATABASES = {
 #     'default': {
@@ -157,6 +189,52 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Analytics rows are queued by the bot handlers and written in batches
+ANALYTICS_WRITER_BATCH_SIZE = 200
+ANALYTICS_WRITER_FLUSH_INTERVAL = 0.5  # seconds
+ANALYTICS_WRITER_MAX_QUEUE = 10000
+
+# Admin dashboard numbers are cached this long, then served stale while they refresh
+DASHBOARD_METRICS_TTL = 60
+DASHBOARD_METRICS_STALE_TTL = 600
+# analytics-data responses; also how long new events in the current hour can take to show up
+ANALYTICS_DATA_CACHE_TTL = 300
+
+# Raw analytics events older than this are moved to monthly gzip archives by archive_analytics
+ANALYTICS_RETENTION_DAYS = 180
+ANALYTICS_ARCHIVE_DIR = os.path.join(BASE_DIR, 'analytics_archive')
+
+# start_bot serves Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics when
+# METRICS_PORT is set (e.g. 9108); 0, the default, turns it off
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Profiles requested in the admin are collected by start_bot and written here
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_DEFAULT_DURATION = 30  # seconds, for profiles triggered by a signal
+PROFILE_POLL_INTERVAL = 5  # seconds between checks for requested profiles
+
+# Seconds a user's profile is taken as unchanged before the bot writes it again, so
+# edits made in the admin process reach the bot's cache
+USER_PROFILE_CACHE_TTL = 3600
+
+# Broadcasts from the admin are sent by start_bot within Telegram's limit of ~30 messages/s
+BROADCAST_RATE = 25  # messages per second
+BROADCAST_CONCURRENCY = 8  # sender threads
+BROADCAST_CHUNK_SIZE = 200  # recipients per saved chunk
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_MAX_RATE_LIMITED = 10  # 429s in a row before a recipient is marked failed
+BROADCAST_POLL_INTERVAL = 5  # seconds between checks for queued broadcasts
+
+# The device list is re-read this often; unchanged lists cost a 304 and nothing else
+DEVICE_REFRESH_INTERVAL = 600  # seconds
+
+# Username lookups (getChat) for the admin's update_username actions
+USERNAME_LOOKUP_CONCURRENCY = 8  # lookup threads
+USERNAME_LOOKUP_RATE = 20  # getChat calls per second
+USERNAME_CACHE_TTL = 24 * 60 * 60  # seconds a username is reused
+USERNAME_NEGATIVE_TTL = 7 * 24 * 60 * 60  # seconds a "Not Active" answer is reused
+
 CORS_ORIGIN_WHITELIST = [
     "http://localhost:8000",
     "http://localhost:9000",
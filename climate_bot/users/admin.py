@@ -3,13 +3,24 @@ from django.contrib import messages
 from django import forms
 from django.http import JsonResponse
 from django.shortcuts import render
-from .models import TelegramUser
+from django.utils import timezone
+from datetime import timedelta
+import json
+from BotAnalytics import series
+from django.db.models import F, Q
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html
+from .models import Broadcast, BroadcastRecipient, TelegramUser
 import telebot
 import os
-from django.urls import path
-from .views import send_message_to_users_view
+from django.urls import path, reverse
+from .broadcast import create_broadcast, segment_fields
+from .segments import describe
+from .usernames import update_usernames_in_background
+from BotAnalytics.models import LocationRollup
+from .views import broadcast_response, send_message_to_users_view
 from unfold.admin import ModelAdmin
-import requests
 
 # Assuming you have your Telegram Bot Token stored in an environment variable
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -18,16 +29,6 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 class SendMessageForm(forms.Form):
     message = forms.CharField(widget=forms.Textarea)
 
-def get_username(user_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChat?chat_id={user_id}"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("ok"):
-            return data["result"].get("username", "hidden")  # Return None if no username
-        return "Not Active"
-    return "Not Active" 
 
 
 
@@ -40,26 +41,47 @@ class TelegramUserAdmin(ModelAdmin):
         urls = super().get_urls()
         custom_urls = [
             path('hello/', self.admin_site.admin_view(send_message_to_users_view), name='analytics_data'),
+            path('analytics/', self.admin_site.admin_view(self.analytics_view), name='telegramuser_analytics'),
         ]
         return custom_urls + urls
+
+    def joined_series(self):
+        """Users joined per hour (last 2 days), day (last 30 days) and week (last 26 weeks)."""
+        end = timezone.now()
+        users = TelegramUser.objects.all()
+        return {
+            'hourly': series.series(users, 'joined_at', 'hour', end - timedelta(hours=47), end),
+            'daily': series.series(users, 'joined_at', 'day', end - timedelta(days=29), end),
+            'weekly': series.series(users, 'joined_at', 'week', end - timedelta(weeks=25), end),
+        }
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['chart_data'] = json.dumps(self.joined_series())
+        return super().changelist_view(request, extra_context=extra_context)
+
+    def analytics_view(self, request):
+        end = timezone.now()
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Users joined per day',
+            'chart_data': json.dumps(
+                series.series(TelegramUser.objects.all(), 'joined_at', 'day', end - timedelta(days=89), end)
+            ),
+        }
+        return render(request, 'admin/telegramuser_analytics.html', context)
    
     # Custom admin action to send a message
     
     
     def update_username(modeladmin, request, queryset):
-        users_to_update = []
-        for user in queryset:
-            if not user.user_name:  # Only update users with no username
-                username = get_username(user.telegram_id)
-                if username:
-                    user.user_name = username
-                    users_to_update.append(user)
-
-        if users_to_update:
-            TelegramUser.objects.bulk_update(users_to_update, ["user_name"])
-            messages.success(request, f"Updated {len(users_to_update)} usernames successfully.")
-        else:
+        users = queryset.filter(Q(user_name='') | Q(user_name__isnull=True))  # Only update users with no username
+        if not users.exists():
             messages.info(request, "No usernames needed updating.")
+        elif update_usernames_in_background(users, 'telegram_id', 'user_name'):
+            messages.success(request, "Updating usernames in the background; reload the page in a moment.")
+        else:
+            messages.warning(request, "A username update is already running; try again when it is done.")
             
         
     def send_message_to_users(self, request, queryset):
@@ -73,36 +95,155 @@ class TelegramUserAdmin(ModelAdmin):
 
             if form.is_valid():
                 print("Form is valid")
-                message = form.cleaned_data['message']
-                bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
-
-                success_count = 0
-                failure_count = 0
-
-                for user in queryset:
-                    try:
-                        bot.send_message(chat_id=user.telegram_id, text=message)
-                        print(f"Message sent to {user.telegram_id}")
-                        success_count += 1
-                    except Exception as e:
-                        failure_count += 1
-                        print(f"Failed to send message to {user.telegram_id}: {e}")
-
-                return JsonResponse({
-                    "success": True,
-                    "message": f"Successfully sent message to {success_count} users. Failed: {failure_count}"
-                })
+                # Sent in the background by the bot process; see users/broadcast.py
+                broadcast = create_broadcast(
+                    form.cleaned_data['message'],
+                    queryset.values_list('telegram_id', flat=True).iterator(chunk_size=1000),
+                    created_by=request.user.get_username(),
+                )
+                return broadcast_response(broadcast)
 
             print("Form is invalid:", form.errors)
             return JsonResponse({"success": False, "message": "Invalid form data"}, status=400)
 
         # Handle normal (non-AJAX) request
+        # Only a preview is rendered; the users themselves are read in chunks when the form is sent
+        preview = list(queryset[:50])
+        user_count = queryset.count()
         return render(
             request,
             'admin/send_message.html',
-            context={'users': queryset, 'form': SendMessageForm()},
+            context={
+                'users': preview,
+                'user_count': user_count,
+                'remaining': user_count - len(preview),
+                'select_across': request.POST.get('select_across') == '1',
+                'selected_ids': request.POST.getlist('_selected_action'),  # The admin wants them even with select_across
+                'form': SendMessageForm(),
+            },
         )
 
     send_message_to_users.short_description = "Send a message to selected users"
 
 # Register the model with the custom admin class
+
+
+class BroadcastForm(forms.ModelForm):
+    """A message and the segment it goes to; leaving every condition empty sends it to all users."""
+    active_days = forms.IntegerField(required=False, min_value=1, help_text="Used the bot in the last N days")
+    inactive_days = forms.IntegerField(required=False, min_value=1, help_text="Has not used the bot for N days")
+    province = forms.ChoiceField(required=False, help_text="Picked a device in this province")
+    joined_after = forms.DateField(required=False, help_text="Joined on or after this day (YYYY-MM-DD)")
+    joined_before = forms.DateField(required=False, help_text="Joined before this day (YYYY-MM-DD)")
+
+    class Meta:
+        model = Broadcast
+        fields = ['message']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        provinces = (LocationRollup.objects.exclude(device_province='')
+                     .values_list('device_province', flat=True).distinct().order_by('device_province'))
+        self.fields['province'].choices = [('', 'Any')] + [(province, province) for province in provinces]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        self.segment = {name: cleaned_data.get(name) for name in
+                        ('active_days', 'inactive_days', 'province', 'joined_after', 'joined_before')}
+        return cleaned_data
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(ModelAdmin):
+    list_display = ('created_at', 'short_message', 'audience', 'status', 'progress_display', 'sent', 'blocked', 'failed', 'created_by')
+    list_filter = ['status']
+    actions = ['cancel', 'resume', 'retry_failed']
+    readonly_fields = ('message', 'audience', 'status', 'created_by', 'created_at', 'started_at', 'finished_at',
+                       'total', 'sent', 'blocked', 'failed', 'recipients_link')
+
+    def get_form(self, request, obj=None, **kwargs):
+        if obj is None:
+            kwargs['form'] = BroadcastForm
+        return super().get_form(request, obj, **kwargs)
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ['message', 'active_days', 'inactive_days', 'province', 'joined_after', 'joined_before']
+        return self.readonly_fields
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.readonly_fields if obj else ()
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            for name, value in segment_fields(form.segment).items():
+                setattr(obj, name, value)
+            obj.created_by = request.user.get_username()
+        super().save_model(request, obj, form, change)
+        if not change:
+            messages.info(request, f"{describe(obj.segment)}: about {obj.total} recipients. "
+                                   "The bot sends the broadcast in the background.")
+
+    @admin.display(description='Audience')
+    def audience(self, obj):
+        return describe(obj.segment) if obj.segment is not None else 'Selected users'
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('<int:object_id>/progress/', self.admin_site.admin_view(self.progress_view),
+                 name='users_broadcast_progress'),
+        ]
+        return custom_urls + urls
+
+    def progress_view(self, request, object_id):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return JsonResponse(get_object_or_404(Broadcast, pk=object_id).progress())
+
+    @admin.display(description='Message')
+    def short_message(self, obj):
+        return obj.message if len(obj.message) <= 60 else obj.message[:57] + '...'
+
+    @admin.display(description='Progress')
+    def progress_display(self, obj):
+        progress = obj.progress()
+        return f"{progress['percent']}% ({progress['total'] - progress['pending']}/{progress['total']})"
+
+    @admin.display(description='Recipients')
+    def recipients_link(self, obj):
+        url = reverse('admin:users_broadcastrecipient_changelist') + f'?broadcast__id__exact={obj.pk}'
+        return format_html('<a href="{}">{} recipients</a>', url, obj.total)
+
+    @admin.action(description='Cancel selected broadcasts')
+    def cancel(self, request, queryset):
+        count = queryset.filter(status__in=['queued', 'running']).update(status='cancelled', finished_at=timezone.now())
+        messages.success(request, f"Cancelled {count} broadcasts; messages already sent stay sent.")
+
+    @admin.action(description='Resume selected broadcasts')
+    def resume(self, request, queryset):
+        count = queryset.filter(status='cancelled').update(status='queued', finished_at=None)
+        messages.success(request, f"Resumed {count} broadcasts with their pending recipients.")
+
+    @admin.action(description='Retry failed recipients')
+    def retry_failed(self, request, queryset):
+        retried = 0
+        for broadcast in queryset:
+            count = broadcast.recipients.filter(status='failed').update(status='pending', attempts=0, error='')
+            if count:
+                Broadcast.objects.filter(pk=broadcast.pk).update(
+                    failed=F('failed') - count, status='queued', finished_at=None)
+                retried += count
+        messages.success(request, f"Queued {retried} failed recipients again.")
+
+
+@admin.register(BroadcastRecipient)
+class BroadcastRecipientAdmin(ModelAdmin):
+    list_display = ('telegram_id', 'broadcast', 'status', 'attempts', 'error', 'sent_at')
+    list_filter = ['status', 'broadcast']
+    search_fields = ['telegram_id']
+    list_select_related = ['broadcast']
+    readonly_fields = [field.name for field in BroadcastRecipient._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,274 @@
+"""
+Broadcasts. The admin only records a Broadcast: with one BroadcastRecipient
+per selected user (create_broadcast), or with a segment (users/segments.py)
+whose users the worker adds as recipients a chunk at a time as it goes
+(create_segment_broadcast). The BroadcastWorker thread started by start_bot
+sends them. Recipients are taken in id order, `chunk_size` at a time, and sent by
+`concurrency` threads that share one token bucket of `rate` messages per second
+(Telegram allows about 30 per second per bot). A 429 holds every sender back
+for the `retry_after` Telegram asks for and the message is retried, up to
+`max_rate_limited` times in a row before the recipient is marked failed; users
+who blocked the bot are not retried.
+
+Each chunk's outcome is saved before the next chunk starts, so after a restart
+the worker carries on with the recipients still pending. Messages of the chunk
+in flight when the process died may be sent twice.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Optional
+
+import requests
+import telebot
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from BotAnalytics import metrics
+from .models import Broadcast, BroadcastRecipient
+from .segments import clean_segment, segment_chunks, segment_queryset
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+
+def create_broadcast(message: str, telegram_ids: Iterable[int], created_by: str = '', chunk_size: int = 1000) -> Broadcast:
+    """Queue `message` for every id in `telegram_ids` (any iterable, read in chunks)."""
+    with transaction.atomic():
+        broadcast = Broadcast.objects.create(message=message, created_by=created_by)
+        ids = iter(telegram_ids)
+        while True:
+            chunk = list(islice(ids, chunk_size))
+            if not chunk:
+                break
+            BroadcastRecipient.objects.bulk_create(
+                [BroadcastRecipient(broadcast=broadcast, telegram_id=telegram_id) for telegram_id in chunk],
+                ignore_conflicts=True,  # The same user listed twice gets one message
+            )
+        broadcast.total = broadcast.recipients.count()
+        broadcast.save(update_fields=['total'])
+    logger.info(f"Broadcast {broadcast.pk} queued for {broadcast.total} users")
+    return broadcast
+
+
+def segment_fields(segment: dict) -> dict:
+    """Broadcast fields for sending to `segment`; its size is estimated now and fixed once it is resolved."""
+    segment = clean_segment(segment)
+    return {'segment': segment, 'cursor': 0, 'resolved': False, 'total': segment_queryset(segment).count()}
+
+
+def create_segment_broadcast(message: str, segment: dict, created_by: str = '') -> Broadcast:
+    broadcast = Broadcast.objects.create(message=message, created_by=created_by, **segment_fields(segment))
+    logger.info(f"Broadcast {broadcast.pk} queued for segment {broadcast.segment} (about {broadcast.total} users)")
+    return broadcast
+
+
+def queue_next_recipients(broadcast: Broadcast, chunk_size: int) -> bool:
+    """Add the next chunk of the segment's users as pending recipients; False once there are none left."""
+    chunk = next(segment_chunks(broadcast.segment, chunk_size, after=broadcast.cursor), None)
+    with transaction.atomic():
+        if chunk is None:
+            total = broadcast.recipients.count()
+            Broadcast.objects.filter(pk=broadcast.pk).update(resolved=True, total=total)
+            broadcast.resolved, broadcast.total = True, total
+            return False
+        BroadcastRecipient.objects.bulk_create(
+            [BroadcastRecipient(broadcast=broadcast, telegram_id=telegram_id) for _, telegram_id in chunk],
+            ignore_conflicts=True,
+        )
+        broadcast.cursor = chunk[-1][0]
+        Broadcast.objects.filter(pk=broadcast.pk).update(cursor=broadcast.cursor)
+    return True
+
+
+class RateLimiter:
+    """Token bucket shared by the sender threads; pause() holds all of them back after a 429."""
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst  # 1 spaces messages evenly, which keeps clear of Telegram's per-second window
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, stop: Optional[threading.Event] = None) -> bool:
+        """Wait for a token; False if `stop` was set while waiting."""
+        while not (stop and stop.is_set()):
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._resume_at and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._resume_at - now, (1 - self._tokens) / self.rate)
+            time.sleep(min(wait, 1.0))
+        return False
+
+    def pause(self, seconds: float) -> bool:
+        """Hold every sender back for `seconds`; False if an earlier pause already covers it."""
+        with self._lock:
+            resume_at = time.monotonic() + seconds
+            self._tokens = 0
+            if resume_at <= self._resume_at + 0.1:
+                return False
+            self._resume_at = resume_at
+            return True
+
+
+class _Outcome:
+    def __init__(self, status: str, attempts: int, error: str = ''):
+        self.status = status
+        self.attempts = attempts
+        self.error = error[:255]
+
+
+class BroadcastWorker:
+    """Thread in the bot process that sends queued broadcasts, oldest first."""
+
+    def __init__(self, rate: float = 25, concurrency: int = 8, chunk_size: int = 200,
+                 max_attempts: int = 3, max_rate_limited: int = 10, poll_interval: float = 5,
+                 send: Optional[Callable] = None):
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.max_rate_limited = max_rate_limited
+        self.poll_interval = poll_interval
+        self._send = send
+        self._stop = threading.Event()
+        self._thread = None
+
+    def send(self, telegram_id: int, message: str) -> None:
+        if self._send is None:
+            self._send = telebot.TeleBot(TELEGRAM_BOT_TOKEN).send_message
+        self._send(telegram_id, message)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="BroadcastWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Stop after the messages in flight; the rest stay pending for the next start."""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                close_old_connections()
+                broadcast = Broadcast.objects.filter(status__in=['queued', 'running']).order_by('created_at').first()
+                if broadcast is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                self.run_broadcast(broadcast)
+            except Exception as e:
+                logger.error(f"Broadcast worker error: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def run_broadcast(self, broadcast: Broadcast) -> None:
+        Broadcast.objects.filter(pk=broadcast.pk, status='queued').update(
+            status='running', started_at=timezone.now())
+        logger.info(f"Sending broadcast {broadcast.pk} ({broadcast.pending} pending)")
+        pending = broadcast.recipients.filter(status='pending').order_by('id')
+        last_id = 0
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix='BroadcastSender') as pool:
+            while not self._stop.is_set():
+                close_old_connections()  # A broadcast can run for hours; recycle the connection between chunks
+                broadcast.refresh_from_db(fields=['status', 'cursor', 'resolved'])
+                if broadcast.status != 'running':
+                    logger.info(f"Broadcast {broadcast.pk} is {broadcast.status}, stopping")
+                    return
+                chunk = list(pending.filter(id__gt=last_id)[:self.chunk_size])
+                if not chunk and not broadcast.resolved and queue_next_recipients(broadcast, self.chunk_size):
+                    continue
+                if not chunk:
+                    Broadcast.objects.filter(pk=broadcast.pk, status='running').update(
+                        status='done', finished_at=timezone.now())
+                    broadcast.refresh_from_db()
+                    logger.info(f"Broadcast {broadcast.pk} done: {broadcast.progress()}")
+                    return
+                outcomes = list(pool.map(lambda recipient: self._deliver(recipient, broadcast.message), chunk))
+                self._save_chunk(broadcast, chunk, outcomes)
+                last_id = chunk[-1].id
+
+    def _deliver(self, recipient: BroadcastRecipient, message: str) -> Optional[_Outcome]:
+        """Send to one recipient, retrying 429s and transient errors; None if stopped first."""
+        attempts = recipient.attempts
+        rate_limited = 0  # 429s in a row; they do not use up attempts, so they are capped separately
+        error = ''
+        while attempts < self.max_attempts:
+            if not self.limiter.acquire(self._stop):
+                return None
+            attempts += 1
+            try:
+                self.send(recipient.telegram_id, message)
+                metrics.broadcast_messages.inc(outcome='sent')
+                return _Outcome('sent', attempts)
+            except telebot.apihelper.ApiTelegramException as e:
+                error = e.description or str(e)
+                if e.error_code == 429:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    metrics.broadcast_messages.inc(outcome='rate_limited')
+                    rate_limited += 1
+                    if rate_limited >= self.max_rate_limited:
+                        error = f"Rate limited {rate_limited} times in a row: {error}"
+                        break
+                    if self.limiter.pause(retry_after):
+                        logger.warning(f"Telegram rate limit hit, pausing broadcasts for {retry_after}s")
+                    attempts -= 1  # Waiting out a 429 does not use up an attempt
+                    continue
+                rate_limited = 0
+                if e.error_code == 403:  # Blocked the bot or deactivated
+                    metrics.broadcast_messages.inc(outcome='blocked')
+                    return _Outcome('blocked', attempts, error)
+                if e.error_code < 500:
+                    break  # e.g. chat not found; retrying will not help
+            except requests.RequestException as e:
+                error = str(e)
+                rate_limited = 0
+            time.sleep(min(5, 0.5 * 2 ** attempts))
+        metrics.broadcast_messages.inc(outcome='failed')
+        return _Outcome('failed', attempts, error)
+
+    def _save_chunk(self, broadcast: Broadcast, chunk, outcomes) -> None:
+        now = timezone.now()
+        changed = []
+        counts = {'sent': 0, 'blocked': 0, 'failed': 0}
+        for recipient, outcome in zip(chunk, outcomes):
+            if outcome is None:
+                continue  # Stopped before sending; still pending
+            recipient.status = outcome.status
+            recipient.attempts = outcome.attempts
+            recipient.error = outcome.error
+            recipient.sent_at = now if outcome.status == 'sent' else None
+            counts[outcome.status] += 1
+            changed.append(recipient)
+        with transaction.atomic():
+            BroadcastRecipient.objects.bulk_update(changed, ['status', 'attempts', 'error', 'sent_at'])
+            Broadcast.objects.filter(pk=broadcast.pk).update(
+                sent=F('sent') + counts['sent'],
+                blocked=F('blocked') + counts['blocked'],
+                failed=F('failed') + counts['failed'],
+            )
+
+
+broadcast_worker = BroadcastWorker(
+    rate=getattr(settings, 'BROADCAST_RATE', 25),
+    concurrency=getattr(settings, 'BROADCAST_CONCURRENCY', 8),
+    chunk_size=getattr(settings, 'BROADCAST_CHUNK_SIZE', 200),
+    max_attempts=getattr(settings, 'BROADCAST_MAX_ATTEMPTS', 3),
+    max_rate_limited=getattr(settings, 'BROADCAST_MAX_RATE_LIMITED', 10),
+    poll_interval=getattr(settings, 'BROADCAST_POLL_INTERVAL', 5),
+)
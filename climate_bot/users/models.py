@@ -11,6 +11,90 @@ class TelegramUser(models.Model):
                                     help_text="Latitude, Longitude (e.g., 40.7128, -74.0060)", 
                                     default="0.0, 0.0")
     joined_at = models.DateTimeField(auto_now_add=True)
+    last_active_at = models.DateTimeField(null=True, blank=True)  # Timestamp of the latest logged command
+    command_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['joined_at'], name='tu_joined_at_idx'),  # new users per period
+            models.Index(fields=['last_active_at'], name='tu_last_active_idx'),  # active/inactive users
+        ]
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.telegram_id})"
+
+
+BROADCAST_STATUSES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('cancelled', 'Cancelled'),
+]
+RECIPIENT_STATUSES = [
+    ('pending', 'Pending'),
+    ('sent', 'Sent'),
+    ('blocked', 'Blocked the bot'),
+    ('failed', 'Failed'),
+]
+
+
+class Broadcast(models.Model):
+    """A message to many users, sent by the broadcast worker in the bot process (users/broadcast.py)."""
+    message = models.TextField()
+    status = models.CharField(max_length=20, choices=BROADCAST_STATUSES, default='queued', db_index=True)
+    # Audience conditions (users/segments.py); its users become recipients a chunk at a time while sending
+    segment = models.JSONField(null=True, blank=True)
+    cursor = models.BigIntegerField(default=0)  # Last TelegramUser pk of the segment added as a recipient
+    resolved = models.BooleanField(default=True)  # False until every user of the segment has been added
+    created_by = models.CharField(max_length=150, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    total = models.PositiveIntegerField(default=0)  # Estimated from the segment until it is resolved
+    sent = models.PositiveIntegerField(default=0)
+    blocked = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.message[:40]} ({self.status}, {self.sent}/{self.total})"
+
+    @property
+    def pending(self):
+        return max(0, self.total - self.sent - self.blocked - self.failed)
+
+    def progress(self):
+        done = self.total - self.pending
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'total': self.total,
+            'sent': self.sent,
+            'blocked': self.blocked,
+            'failed': self.failed,
+            'pending': self.pending,
+            'percent': round(100 * done / self.total, 1) if self.total else 100.0,
+        }
+
+
+class BroadcastRecipient(models.Model):
+    """Delivery state of a broadcast for one user, so an interrupted broadcast resumes with the pending ones."""
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='recipients')
+    telegram_id = models.BigIntegerField()
+    status = models.CharField(max_length=20, choices=RECIPIENT_STATUSES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'telegram_id'], name='broadcast_recipient_key'),
+        ]
+        indexes = [
+            models.Index(fields=['broadcast', 'status', 'id'], name='broadcast_recipient_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.telegram_id}: {self.status}"
@@ -0,0 +1,95 @@
+"""
+Broadcast audiences described by a few conditions instead of a list of users.
+A segment is a JSON-able dict; every condition given must hold:
+
+    active_days    int   used the bot in the last N days (TelegramUser.last_active_at)
+    inactive_days  int   has not used the bot for N days, or never
+    province       str   picked a device in this province (LocationsAnalytics
+                         rows still in the database, i.e. not yet archived)
+    joined_after   date  joined on or after this day (ISO format)
+    joined_before  date  joined before this day
+
+Recipients are read with segment_chunks() in primary key order, a chunk at a
+time, so an audience is never held in memory.
+"""
+from datetime import datetime, time, timedelta
+
+from django.db.models import CharField
+from django.db.models.functions import Cast
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from BotAnalytics.models import LocationsAnalytics
+from .models import TelegramUser
+
+CONDITIONS = ('active_days', 'inactive_days', 'province', 'joined_after', 'joined_before')
+
+
+def _day_start(value):
+    day = parse_date(value) if isinstance(value, str) else value
+    if day is None:
+        raise ValueError(f"Not a date: {value!r}")
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def clean_segment(segment: dict) -> dict:
+    """The segment without empty conditions; ValueError for unknown or malformed ones."""
+    cleaned = {}
+    for name, value in segment.items():
+        if name not in CONDITIONS:
+            raise ValueError(f"Unknown segment condition: {name}")
+        if value in (None, ''):
+            continue
+        if name in ('active_days', 'inactive_days'):
+            value = int(value)
+            if value < 1:
+                raise ValueError(f"{name} must be at least 1")
+        elif name in ('joined_after', 'joined_before'):
+            value = _day_start(value).date().isoformat()
+        cleaned[name] = value
+    return cleaned
+
+
+def segment_queryset(segment: dict):
+    users = TelegramUser.objects.all()
+    now = timezone.now()
+    if segment.get('active_days'):
+        users = users.filter(last_active_at__gte=now - timedelta(days=segment['active_days']))
+    if segment.get('inactive_days'):
+        cutoff = now - timedelta(days=segment['inactive_days'])
+        users = users.exclude(last_active_at__gte=cutoff)
+    if segment.get('joined_after'):
+        users = users.filter(joined_at__gte=_day_start(segment['joined_after']))
+    if segment.get('joined_before'):
+        users = users.filter(joined_at__lt=_day_start(segment['joined_before']))
+    if segment.get('province'):
+        # LocationsAnalytics keeps the Telegram id as text; the subquery is evaluated once
+        pickers = LocationsAnalytics.objects.filter(device_province=segment['province']).values('user_id')
+        users = users.annotate(telegram_key=Cast('telegram_id', CharField())).filter(telegram_key__in=pickers)
+    return users
+
+
+def segment_chunks(segment: dict, chunk_size: int = 1000, after: int = 0):
+    """Yield lists of (TelegramUser pk, telegram_id) in pk order, starting after pk `after`."""
+    users = segment_queryset(segment).order_by('pk')
+    while True:
+        chunk = list(users.filter(pk__gt=after).values_list('pk', 'telegram_id')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1][0]
+
+
+def describe(segment: dict) -> str:
+    parts = []
+    if segment.get('active_days'):
+        parts.append(f"active in the last {segment['active_days']} days")
+    if segment.get('inactive_days'):
+        parts.append(f"inactive for {segment['inactive_days']} days")
+    if segment.get('province'):
+        parts.append(f"picked a device in {segment['province']}")
+    if segment.get('joined_after'):
+        parts.append(f"joined on or after {segment['joined_after']}")
+    if segment.get('joined_before'):
+        parts.append(f"joined before {segment['joined_before']}")
+    return 'Users ' + ', '.join(parts) if parts else 'All users'
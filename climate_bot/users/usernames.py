@@ -0,0 +1,140 @@
+"""
+Telegram usernames looked up with getChat for the update_username admin
+actions. Each Telegram id is looked up once per run however many rows share
+it, by `concurrency` threads over pooled connections, within `rate` requests
+per second (429s pause every thread for Telegram's retry_after). Answers are
+cached: usernames for USERNAME_CACHE_TTL seconds, "Not Active" (chat not
+found, bot blocked) for USERNAME_NEGATIVE_TTL. Network errors and 5xx answers
+are not cached and leave the rows as they are.
+
+The actions start update_usernames_in_background(), which resolves the rows of
+a queryset in a thread and saves the changed ones with one bulk_update.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from requests.adapters import HTTPAdapter
+
+from .broadcast import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Bot API URL template, as in bot/views.py
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot{0}/{1}')
+
+HIDDEN = 'hidden'  # The chat exists but has no public username
+NOT_ACTIVE = 'Not Active'  # Chat not found or the bot was blocked
+
+
+class UsernameResolver:
+    cache_prefix = 'users:username:'
+
+    def __init__(self, concurrency: int = 8, rate: float = 20, cache_ttl: int = 86400,
+                 negative_ttl: int = 7 * 86400, timeout: float = 10, max_attempts: int = 3):
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+
+    def resolve(self, telegram_ids: Iterable) -> Dict[int, str]:
+        """Username (or HIDDEN/NOT_ACTIVE) per Telegram id; ids that could not be looked up are left out."""
+        ids = {int(telegram_id) for telegram_id in telegram_ids if str(telegram_id).lstrip('-').isdigit()}
+        cached = cache.get_many([self.cache_prefix + str(telegram_id) for telegram_id in ids])
+        found = {int(key[len(self.cache_prefix):]): value for key, value in cached.items()}
+        missing = sorted(ids - found.keys())
+        if not missing:
+            return found
+
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix='UsernameLookup') as pool:
+            fetched = dict(zip(missing, pool.map(self.fetch, missing)))
+        fetched = {telegram_id: name for telegram_id, name in fetched.items() if name is not None}
+        positive = {self.cache_prefix + str(i): name for i, name in fetched.items() if name != NOT_ACTIVE}
+        negative = {self.cache_prefix + str(i): name for i, name in fetched.items() if name == NOT_ACTIVE}
+        cache.set_many(positive, timeout=self.cache_ttl)
+        cache.set_many(negative, timeout=self.negative_ttl)
+        logger.info(f"Looked up {len(missing)} usernames ({len(found)} cached), "
+                    f"{len(negative)} not active, {len(missing) - len(fetched)} failed")
+        return {**found, **fetched}
+
+    def fetch(self, telegram_id: int) -> Optional[str]:
+        url = TELEGRAM_API_URL.format(TELEGRAM_BOT_TOKEN, 'getChat')
+        attempts = 0
+        while attempts < self.max_attempts:
+            self.limiter.acquire()
+            attempts += 1
+            try:
+                response = self.session.get(url, params={'chat_id': telegram_id}, timeout=self.timeout)
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"getChat {telegram_id} failed: {e}")
+                continue
+            if response.status_code == 429:
+                self.limiter.pause(data.get('parameters', {}).get('retry_after', 1))
+                attempts -= 1  # Waiting out a 429 does not use up an attempt
+                continue
+            if response.status_code == 200 and data.get('ok'):
+                return data['result'].get('username', HIDDEN)
+            if response.status_code in (400, 403):
+                return NOT_ACTIVE
+            logger.warning(f"getChat {telegram_id} answered {response.status_code}: {data.get('description')}")
+        return None
+
+
+username_resolver = UsernameResolver(
+    concurrency=getattr(settings, 'USERNAME_LOOKUP_CONCURRENCY', 8),
+    rate=getattr(settings, 'USERNAME_LOOKUP_RATE', 20),
+    cache_ttl=getattr(settings, 'USERNAME_CACHE_TTL', 86400),
+    negative_ttl=getattr(settings, 'USERNAME_NEGATIVE_TTL', 7 * 86400),
+)
+
+
+def update_usernames(queryset, id_field: str, name_field: str, resolver: UsernameResolver = None) -> int:
+    """Look up the username of every row of `queryset` and save the changed ones; returns how many changed."""
+    resolver = resolver or username_resolver
+    rows = list(queryset.values_list('pk', id_field, name_field))
+    names = resolver.resolve(telegram_id for _, telegram_id, _ in rows)
+    model = queryset.model
+    changed = []
+    for pk, telegram_id, current in rows:
+        name = names.get(int(telegram_id)) if str(telegram_id).lstrip('-').isdigit() else None
+        if name is not None and name != current:
+            obj = model(pk=pk)
+            setattr(obj, name_field, name)
+            changed.append(obj)
+    model.objects.bulk_update(changed, [name_field], batch_size=500)
+    return len(changed)
+
+
+_running = threading.Lock()
+
+
+def update_usernames_in_background(queryset, id_field: str, name_field: str) -> bool:
+    """Run update_usernames() in a thread; False if a refresh is already running in this process."""
+    if not _running.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            changed = update_usernames(queryset, id_field, name_field)
+            logger.info(f"Updated {changed} {queryset.model.__name__} usernames")
+        except Exception as e:
+            logger.error(f"Username refresh failed: {e}")
+        finally:
+            connection.close()
+            _running.release()
+
+    threading.Thread(target=run, name='UsernameRefresh', daemon=True).start()
+    return True
@@ -1,41 +1,150 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
 from .models import TelegramUser
+from BotAnalytics import metrics
+from BotAnalytics.writer import analytics_writer
+
+logger = logging.getLogger(__name__)
+
+# Profiles are upserted in batches by the analytics writer thread
+analytics_writer.register(
+    TelegramUser,
+    unique_field='telegram_id',
+    update_conflicts=True,
+    unique_fields=['telegram_id'],
+    update_fields=['user_name', 'first_name', 'last_name'],
+)
+
+
+class UserProfileCache:
+    """
+    Fingerprint of (first name, last name, username) per telegram_id, so a
+    profile is only queued for writing when the user is new or it changed.
+    Saves and deletes in this process forget the user at once; changes made
+    by other processes (the admin) are picked up when the entry's `ttl`
+    seconds are up.
+    """
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._fingerprints = {}  # telegram_id -> (fingerprint, monotonic expiry)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(first_name, last_name, username):
+        return hash((first_name, last_name, username))
+
+    def warm(self):
+        """Load every stored profile; called once at bot startup."""
+        rows = TelegramUser.objects.values_list('telegram_id', 'first_name', 'last_name', 'user_name')
+        expires_at = time.monotonic() + self.ttl
+        fingerprints = {
+            telegram_id: (self.fingerprint(first_name, last_name, username), expires_at)
+            for telegram_id, first_name, last_name, username in rows.iterator(chunk_size=2000)
+        }
+        with self._lock:
+            self._fingerprints.update(fingerprints)
+        logger.info(f"User profile cache warmed with {len(fingerprints)} users")
+
+    def is_current(self, telegram_id, fingerprint):
+        with self._lock:
+            cached = self._fingerprints.get(telegram_id)
+            current = cached is not None and cached[0] == fingerprint and cached[1] > time.monotonic()
+            if current:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return current
+
+    def remember(self, telegram_id, fingerprint):
+        with self._lock:
+            self._fingerprints[telegram_id] = (fingerprint, time.monotonic() + self.ttl)
+
+    def forget(self, telegram_id):
+        with self._lock:
+            self._fingerprints.pop(telegram_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._fingerprints), 'hits': self.hits, 'misses': self.misses}
+
+
+user_profile_cache = UserProfileCache(ttl=getattr(settings, 'USER_PROFILE_CACHE_TTL', 3600))
+
+metrics.cache_requests.set_function(lambda: user_profile_cache.hits, cache='user_profile', result='hit')
+metrics.cache_requests.set_function(lambda: user_profile_cache.misses, cache='user_profile', result='miss')
+
 
 def save_telegram_user(from_user):
-    print(from_user)
-    
     telegram_id = from_user.id
     first_name = from_user.first_name
     last_name = from_user.last_name
     username = from_user.username
 
-    print(f"Processing user: {first_name} {last_name} ({telegram_id})")
+    fingerprint = user_profile_cache.fingerprint(first_name, last_name, username)
+    if user_profile_cache.is_current(telegram_id, fingerprint):
+        return
 
-    user, created = TelegramUser.objects.update_or_create(
+    # Remembered by remember_written_profiles once the write commits
+    analytics_writer.submit(TelegramUser(
         telegram_id=telegram_id,
-        defaults={
-            'user_name' : username,
-            'first_name': first_name,
-            'last_name': last_name,
-        }
-    )
-    if created:
-        print(f"New user created: {first_name} {last_name}")
-    else:
-        print(f"User updated: {first_name} {last_name}")
+        user_name=username,
+        first_name=first_name,
+        last_name=last_name,
+    ))
+
+
+def remember_written_profiles(objs):
+    """Writer listener: remember the profiles' fingerprints if, and only if, their upsert commits."""
+    fingerprints = {
+        obj.telegram_id: user_profile_cache.fingerprint(obj.first_name, obj.last_name, obj.user_name)
+        for obj in objs
+    }
+
+    def remember():
+        for telegram_id, fingerprint in fingerprints.items():
+            user_profile_cache.remember(telegram_id, fingerprint)
+    # Dropped with the savepoint or transaction if the insert fails
+    transaction.on_commit(remember)
+
+
+analytics_writer.add_listener(TelegramUser, remember_written_profiles)
+
+
+def forget_profile(sender, instance, **kwargs):
+    """post_save/post_delete receiver: the next message from the user writes their profile again."""
+    user_profile_cache.forget(instance.telegram_id)
+
+
+post_save.connect(forget_profile, sender=TelegramUser)
+post_delete.connect(forget_profile, sender=TelegramUser)
+
 
 def save_users_locations(from_user, location):
+    # Written by the analytics writer thread, so handlers never wait on a database lock
+    analytics_writer.call(_save_user_location, from_user, location)
+
+
+def _save_user_location(from_user, location):
     # Get the user's ID
     user_id = from_user
     # Update the user's location in the database
-    user, updated = TelegramUser.objects.update_or_create(
+    user, created = TelegramUser.objects.update_or_create(
         telegram_id=user_id,
         defaults={
             'coordinates': location,
            
         }
     )
-    # Check if the location was updated or a new user was created
-    if updated:
-        print(f"User {user.first_name} {user.last_name} location updated: ({location})")
+    if created:
+        logger.info(f"User {user_id} created with location: ({location})")
     else:
-        print(f"User {user.first_name} {user.last_name} created with location: ({location})")
+        logger.debug(f"User {user.first_name} {user.last_name} location updated: ({location})")
@@ -2,7 +2,9 @@
 from django.http import JsonResponse
 from django.shortcuts import render
 from django.contrib import messages
+from django.urls import reverse
 from .models import TelegramUser
+from .broadcast import create_broadcast
 # from .forms import SendMessageForm
 from django import forms
 
@@ -35,30 +37,28 @@ def send_message_to_users_view(request):
         users = TelegramUser.objects.filter(id__in=user_ids)  # Fetch users by IDs
 
         if form.is_valid():
-            message = form.cleaned_data['message']
-            bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
-
-            success_count = 0
-            failure_count = 0
-
-            for user in users:
-                try:
-                    bot.send_message(chat_id=user.telegram_id, text=message)
-                    success_count += 1
-                except Exception as e:
-                    failure_count += 1
-                    print(f"Failed to send message to {user.telegram_id}: {e}")
-
-            return JsonResponse({
-                "success": True,
-                "message": f"Successfully sent message to {success_count} users. Failed: {failure_count}"
-            })
+            # The bot process sends it in the background; the page polls the progress URL
+            broadcast = create_broadcast(
+                form.cleaned_data['message'],
+                users.values_list('telegram_id', flat=True).iterator(chunk_size=1000),
+                created_by=request.user.get_username(),
+            )
+            return broadcast_response(broadcast)
 
         return JsonResponse({"success": False, "message": "Invalid form data"}, status=400)
 
     return JsonResponse({"success": False, "message": "Invalid request"}, status=400)
 
 
+def broadcast_response(broadcast):
+    return JsonResponse({
+        "success": True,
+        "message": f"Sending to {broadcast.total} users in the background.",
+        "broadcast": broadcast.progress(),
+        "progress_url": reverse('admin:users_broadcast_progress', args=[broadcast.pk]),
+    })
+
+
 # def get_username(id):
 #     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN }/getChat?chat_id={id}"
 #     response = requests.get(url)